@@ -0,0 +1,18 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Benchmarks of the hot paths of gcloudoem.
+
+They run against :class:`~gcloudoem.datastore.memory.InMemoryConnection`, so they measure the client's own CPU (and
+memory) cost without a network. Query benchmarks replay responses recorded from it with
+:class:`~gcloudoem.datastore.replay.ReplayHttp`, so the in-memory store's own work isn't timed either. Run them from the
+root of the repo::
+
+    $ python -m benchmarks                        # Run them all and compare them to benchmarks/baseline.json
+    $ python -m benchmarks decode cursor          # Only the benchmarks with names starting with these
+    $ python -m benchmarks --save                 # Run them and make the results the new baseline
+
+Each result is compared to the baseline, and the run fails if any is worse by more than the tolerance (20% by default).
+Rates depend on the machine, so a baseline is only meaningful on the machine it was saved on: save one on your machine
+(or CI runner) before making a change, then compare against it after.
+"""
@@ -0,0 +1,84 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""Run the benchmarks and compare them to a baseline. See :mod:`benchmarks`."""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+
+from .suite import BENCHMARKS
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def compare(benchmark, result, baseline, tolerance):
+    """
+    :rtype: tuple
+    :returns: The relative change from ``baseline`` to ``result`` (positive is better), and whether it's a regression.
+    """
+    if result is None or not baseline:
+        return None, False
+    change = (result - baseline) / baseline
+    if not benchmark.higher_is_better:
+        change = -change
+    return change, change < -tolerance
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the hot paths of gcloudoem.')
+    parser.add_argument('names', nargs='*', help='Only run the benchmarks with names starting with these.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='The baseline results (JSON).')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='The worst change allowed (0.2 = 20%%).')
+    parser.add_argument('--repeat', type=int, default=5, help='How many times to measure each rate.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of items benchmarked.')
+    options = parser.parse_args(args)
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with io.open(options.baseline, encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+
+    results = {}
+    regressions = []
+    print('%-28s %14s %14s %8s' % ('benchmark', 'result', 'baseline', 'change'))
+    for name, benchmark in BENCHMARKS.items():
+        if options.names and not any(name.startswith(prefix) for prefix in options.names):
+            continue
+        result = results[name] = benchmark.run(repeat=options.repeat, scale=options.scale)
+        change, regressed = compare(benchmark, result, baseline.get(name), options.tolerance)
+        if regressed:
+            regressions.append(name)
+        print('%-28s %14s %14s %8s %s%s' % (
+            name,
+            '-' if result is None else '%.1f' % result,
+            '-' if baseline.get(name) is None else '%.1f' % baseline[name],
+            '-' if change is None else '%+.0f%%' % (change * 100),
+            benchmark.unit,
+            '  REGRESSION' if regressed else '',
+        ))
+
+    if options.save:
+        saved = dict(baseline, **{name: round(result, 1) for name, result in results.items() if result is not None})
+        with io.open(options.baseline, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': saved,
+            }, indent=2, sort_keys=True) + '\n')
+        print('Saved the results to %s' % options.baseline)
+    elif regressions:
+        print('%d benchmark(s) regressed by more than %.0f%%: %s' % (
+            len(regressions), options.tolerance * 100, ', '.join(regressions)
+        ))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
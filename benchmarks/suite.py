@@ -0,0 +1,333 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+The benchmarks.
+
+Each benchmark is a function decorated with :func:`benchmark` that sets up its data and returns the function to
+measure, or a ``(prepare, measure)`` tuple if some work has to be redone (untimed) before each measurement. Rate
+benchmarks report how many items a second the measured function gets through (higher is better). Memory benchmarks
+report the peak memory (MB) allocated by the measured function, per 100k items (lower is better).
+
+Query benchmarks are measured against the responses recorded from a run against the in-memory store (see
+:func:`_replayed`), so the time the store spends running the query isn't counted.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import datetime
+import gc
+import timeit
+
+import pytz
+
+from gcloudoem import (
+    DateTimeProperty, Entity, IntegerProperty, ListProperty, PickleProperty, ReferenceProperty, TextProperty
+)
+from gcloudoem.datastore import connection as connection_module
+from gcloudoem.datastore.memory import InMemoryDatastore, connect_in_memory
+from gcloudoem.datastore.query import Query
+from gcloudoem.datastore.replay import Exchange, ReplayHttp
+from gcloudoem.datastore.transaction import Transaction
+from gcloudoem.key import Key
+from gcloudoem.queryset import Avg, Count, Sum
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+BENCHMARKS = collections.OrderedDict()
+
+
+class Benchmark(object):
+    """A registered benchmark."""
+
+    RATE = 'rate'
+    MEMORY = 'memory'
+
+    def __init__(self, name, setup, size, measure):
+        self.name = name
+        self.setup = setup
+        self.size = size
+        self.measure = measure
+
+    @property
+    def unit(self):
+        return 'items/s' if self.measure == self.RATE else 'MB/100k items'
+
+    @property
+    def higher_is_better(self):
+        return self.measure == self.RATE
+
+    def run(self, repeat=5, scale=1.0):
+        """
+        Set up and measure the benchmark.
+
+        :param int repeat: How many times to measure a rate. The best time is used.
+        :param float scale: Multiplies the number of items.
+        :rtype: float
+        :returns: The result, or None if it can't be measured here.
+        """
+        size = max(int(self.size * scale), 1)
+        connection_module.disconnect()
+        connect_in_memory(store=InMemoryDatastore())
+        try:
+            function = self.setup(size)
+            prepare = None
+            if isinstance(function, tuple):
+                prepare, function = function
+            if self.measure == self.MEMORY:
+                return _peak_memory(function, size)
+            best = None
+            for _ in range(repeat):
+                if prepare is not None:
+                    prepare()
+                gc.collect()
+                started = timeit.default_timer()
+                function()
+                elapsed = timeit.default_timer() - started
+                best = elapsed if best is None else min(best, elapsed)
+            return size / best
+        finally:
+            connection_module.disconnect()
+
+
+def benchmark(name, size, measure=Benchmark.RATE):
+    """
+    Register a benchmark.
+
+    :param str name: The name of the benchmark, unique in the suite.
+    :param int size: How many items the measured function processes.
+    :param str measure: :attr:`Benchmark.RATE` or :attr:`Benchmark.MEMORY`.
+    """
+    def register(setup):
+        BENCHMARKS[name] = Benchmark(name, setup, size, measure)
+        return setup
+    return register
+
+
+def _peak_memory(function, size):
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()  # Keep the result alive while measuring
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak / 2 ** 20 * 100000 / size
+
+
+##
+# Entities with different mixes of properties
+##
+class BenchAuthor(Entity):
+    name = TextProperty()
+
+
+class BenchText(Entity):
+    title = TextProperty()
+    body = TextProperty()
+    email = TextProperty()
+
+
+class BenchPickle(Entity):
+    data = PickleProperty()
+
+
+class BenchList(Entity):
+    tags = ListProperty(TextProperty())
+    scores = ListProperty(IntegerProperty())
+
+
+class BenchDateTime(Entity):
+    created = DateTimeProperty()
+    updated = DateTimeProperty()
+
+
+class BenchReference(Entity):
+    author = ReferenceProperty(BenchAuthor)
+    editor = ReferenceProperty(BenchAuthor)
+
+
+class BenchMixed(Entity):
+    title = TextProperty()
+    count = IntegerProperty()
+    data = PickleProperty()
+    tags = ListProperty(TextProperty())
+    created = DateTimeProperty()
+    author = ReferenceProperty(BenchAuthor)
+
+
+_NOW = datetime.datetime(2016, 1, 1, tzinfo=pytz.utc)
+
+
+def _make_text(i):
+    return BenchText(key=i + 1, title='Title %d' % i, body='Some body text ' * 20, email='person%d@example.com' % i)
+
+
+def _make_pickle(i):
+    return BenchPickle(key=i + 1, data={'id': i, 'values': list(range(10)), 'name': 'pickled %d' % i})
+
+
+def _make_list(i):
+    return BenchList(key=i + 1, tags=['tag%d' % j for j in range(10)], scores=list(range(i % 10, i % 10 + 10)))
+
+
+def _make_datetime(i):
+    return BenchDateTime(key=i + 1, created=_NOW, updated=_NOW + datetime.timedelta(seconds=i))
+
+
+def _make_reference(i):
+    return BenchReference(key=i + 1, author=Key('BenchAuthor', value=i % 50 + 1), editor=Key('BenchAuthor', value=1))
+
+
+def _make_mixed(i):
+    return BenchMixed(
+        key=i + 1, title='Title %d' % i, count=i, data={'id': i}, tags=['a', 'b', 'c'], created=_NOW,
+        author=Key('BenchAuthor', value=i % 50 + 1)
+    )
+
+
+MIXES = collections.OrderedDict([
+    ('text', _make_text),
+    ('pickle', _make_pickle),
+    ('list', _make_list),
+    ('datetime', _make_datetime),
+    ('reference', _make_reference),
+    ('mixed', _make_mixed),
+])
+
+
+def _encode(entities):
+    """Encode ``entities`` into a commit request."""
+    transaction = Transaction(Transaction.NONE)
+    for entity in entities:
+        transaction._assign_entity_to_mutation(entity)
+    return transaction._mutation
+
+
+def _entity_pbs(make, size):
+    return [mutation.upsert for mutation in _encode([make(i) for i in range(size)]).mutations]
+
+
+def _replayed(function):
+    """
+    Run ``function`` once against the in-memory store, recording the responses, then make a connection that replays
+    them. Measuring ``function`` then only times the client's work: building the requests, decoding the responses and
+    everything done with the results.
+
+    :returns: A ``(prepare, measure)`` tuple for :func:`benchmark`.
+    """
+    memory = connection_module.get_connection()
+    exchanges = []
+    call = memory.store.call
+
+    def record(method, request_pb):
+        response_pb = call(method, request_pb)
+        exchanges.append(Exchange(method, request_pb.SerializeToString(), 200, response_pb.SerializeToString(), 0.0))
+        return response_pb
+    memory.store.call = record
+    try:
+        function()
+    finally:
+        del memory.store.call
+
+    http = ReplayHttp(exchanges)
+    connection_module.register_connection(memory.dataset, memory.namespace, None, http=http)
+    return http.rewind, function
+
+
+##
+# The benchmarks
+##
+def _decode_benchmark(mix, make):
+    @benchmark('decode.%s' % mix, 5000)
+    def setup(size):
+        entity_cls = type(make(0))
+        pbs = _entity_pbs(make, size)
+        return lambda: [entity_cls.from_protobuf(pb) for pb in pbs]
+
+
+def _encode_benchmark(mix, make):
+    @benchmark('encode.%s' % mix, 5000)
+    def setup(size):
+        entities = [make(i) for i in range(size)]
+        return lambda: _encode(entities)
+
+
+for _mix, _make in MIXES.items():
+    _decode_benchmark(_mix, _make)
+    _encode_benchmark(_mix, _make)
+
+
+@benchmark('query.to_protobuf', 5000)
+def query_to_protobuf(size):
+    def build():
+        for i in range(size):
+            query = Query(BenchMixed, order=('-count', 'title'))
+            query.add_filter('count', '>', i)
+            query.add_filter('title', '=', 'Title')
+            query.add_filter('tags', '=', 'a')
+            query.to_protobuf()
+    return build
+
+
+@benchmark('cursor.iterate', 10000)
+def cursor_iterate(size):
+    with Transaction(Transaction.NONE) as transaction:
+        for i in range(size):
+            transaction.put(_make_mixed(i))
+    query = Query(BenchMixed)
+    return _replayed(lambda: sum(1 for _ in query()))
+
+
+@benchmark('queryset.values_list', 10000)
+def values_list(size):
+    with Transaction(Transaction.NONE) as transaction:
+        for i in range(size):
+            transaction.put(_make_mixed(i))
+    return _replayed(lambda: len(BenchMixed.objects.values_list('title', 'count')))
+
+
+@benchmark('queryset.to_columns', 10000)
+def to_columns(size):
+    with Transaction(Transaction.NONE) as transaction:
+        for i in range(size):
+            transaction.put(_make_mixed(i))
+    return _replayed(lambda: BenchMixed.objects.to_columns(['count', 'created']))
+
+
+@benchmark('queryset.aggregate', 10000)
+def aggregate(size):
+    with Transaction(Transaction.NONE) as transaction:
+        for i in range(size):
+            transaction.put(_make_mixed(i))
+    return _replayed(lambda: BenchMixed.objects.aggregate(Sum('count'), Avg('count'), n=Count()))
+
+
+@benchmark('queryset.bulk_create', 2000)
+def bulk_create(size):
+    store = connection_module.get_connection().store
+    entities = [_make_mixed(i) for i in range(size)]
+    return store.clear, lambda: BenchMixed.objects.bulk_create(entities)
+
+
+@benchmark('queryset.delete', 2000)
+def delete(size):
+    entities = [_make_mixed(i) for i in range(size)]
+
+    def prepare():
+        with Transaction(Transaction.NONE) as transaction:
+            for entity in entities:
+                transaction.put(entity)
+    return prepare, lambda: BenchMixed.objects.filter(count__gte=0).delete()
+
+
+@benchmark('memory.decode.mixed', 100000, measure=Benchmark.MEMORY)
+def memory_decode(size):
+    pbs = _entity_pbs(_make_mixed, size)
+    return lambda: [BenchMixed.from_protobuf(pb) for pb in pbs]
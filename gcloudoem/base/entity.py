@@ -23,6 +23,7 @@ class BaseEntity(object):
         """
         self._initialised = False
         self._data = {}  # Property values will be stored here by the property descriptors
+        self._version = None  # The Datastore version this entity was last read or written at, if known
 
         # Set attribute values
         for name in self._properties:
@@ -35,6 +36,16 @@ class BaseEntity(object):
     def pk(self):
         return self.key.name_or_id
 
+    @property
+    def version(self):
+        """
+        The Datastore version of this entity when it was last read or saved.
+
+        Used for optimistic concurrency (see :meth:`~gcloudoem.entity.Entity.save`). None if this entity hasn't been
+        read from or written to Datastore.
+        """
+        return self._version
+
     def clean(self):
         """
         Hook for doing document level data cleaning before validation is run.
@@ -149,8 +149,10 @@ class ContainerBaseProperty(BaseProperty):
 
             if self.property and isinstance(self.property, ReferenceProperty):
                 from .. import Entity, Key
+                from ..queryset.nplusone import record_fetch
                 for i, k in enumerate(value):
                     if not isinstance(k, Entity):
+                        record_fetch(instance, self)
                         value[i] = self.property.entity_cls.objects.get(pk=k.name_or_id)
                 setattr(instance, self.name, value)  # cache any fetched entities
             return value
@@ -0,0 +1,214 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Accounting of the billed Datastore operations made by a block of code.
+
+Datastore bills by operation rather than by request: every entity read by a lookup or returned by a query, every entity
+written or deleted, plus a read for each query. Keys-only and projection queries are billed as small operations instead
+of entity reads. A :class:`CostAccountant` adds up those operations for the RPCs made inside it, in total, by kind and
+by the line of code that led to each RPC::
+
+    >>> with CostAccountant() as accountant:
+    ...     handle_request()
+    >>> accountant.total
+    <Usage entity_reads=12 small_ops=100 entity_writes=1 entity_deletes=0 index_writes=8 rpcs=4>
+    >>> accountant.by_kind['Person'].entity_reads
+    11
+    >>> sorted(accountant.by_caller.items(), key=lambda item: accountant.cost(item[1]), reverse=True)[0]
+    ('views.py:12 in person_list', <Usage ...>)
+
+An accountant only counts RPCs made by the thread (or asyncio task) it is active in, so one can wrap each request of a
+web application. RPCs made in the background for work started inside it, like
+:meth:`~gcloudoem.entity.Entity.save_async` or prefetching a block of IDs, are counted too. Accountants can be nested;
+the RPCs are counted by all of them. It's built on
+:mod:`~gcloudoem.datastore.instrumentation` and, like it, costs nothing when no accountant is active.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+from . import instrumentation
+from .profiler import caller_site
+from .utils import _resource_stack
+
+
+_ACCOUNTANTS = _resource_stack('gcloudoem_cost_accountants')
+_active = 0  # The number of accountants active on any thread. The listener is only added while there are some.
+_active_lock = threading.Lock()
+
+
+class Usage(object):
+    """
+    Counts of billed operations.
+
+    :ivar int entity_reads: Entities read by lookups and queries, plus one for each query.
+    :ivar int small_ops: Results of keys-only and projection queries, and allocated IDs.
+    :ivar int entity_writes: Entities inserted, updated or upserted.
+    :ivar int entity_deletes: Entities deleted.
+    :ivar int index_writes: Index entries written by commits, as reported by Datastore.
+    :ivar int rpcs: RPCs made (that touched the kind, for usage by kind).
+    """
+
+    FIELDS = ('entity_reads', 'small_ops', 'entity_writes', 'entity_deletes', 'index_writes', 'rpcs')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, **counts):
+        for field, count in counts.items():
+            setattr(self, field, getattr(self, field) + count)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return '<Usage %s>' % ' '.join('%s=%d' % (field, getattr(self, field)) for field in self.FIELDS)
+
+
+class CostAccountant(object):
+    """
+    Adds up the billed operations of the RPCs made while used as a context manager.
+
+    :ivar total: The :class:`Usage` of all RPCs.
+    :ivar dict by_kind: The :class:`Usage` for each kind. Index writes are only attributed to a kind when a commit only
+        touches a single kind, otherwise they're counted against the kind ``None``.
+    :ivar dict by_caller: The :class:`Usage` for each line of code outside gcloudoem that led to an RPC (eg.
+        ``views.py:12 in person_list``).
+    """
+
+    PRICES = {'entity_reads': 0.06e-5, 'small_ops': 0.0, 'entity_writes': 0.18e-5, 'entity_deletes': 0.02e-5}
+    """The default price (USD) of each type of operation, for :meth:`cost`."""
+
+    def __init__(self, prices=None):
+        """
+        :param dict prices: The price of each type of operation, for :meth:`cost`. Defaults to :attr:`PRICES`.
+        """
+        self.prices = dict(self.PRICES, **(prices or {}))
+        self.total = Usage()
+        self.by_kind = {}
+        self.by_caller = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        global _active
+        _ACCOUNTANTS.push(self)
+        with _active_lock:
+            if not _active:
+                instrumentation.add_listener(_account)
+            _active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _active
+        _ACCOUNTANTS.pop()
+        with _active_lock:
+            _active -= 1
+            if not _active:
+                instrumentation.remove_listener(_account)
+
+    def cost(self, usage=None):
+        """
+        Estimate what ``usage`` cost.
+
+        :param usage: A :class:`Usage`. Defaults to :attr:`total`.
+        :rtype: float
+        """
+        usage = usage or self.total
+        return sum(getattr(usage, field) * price for field, price in self.prices.items())
+
+    def record(self, caller, kinds, **counts):
+        """
+        Add operations to the totals.
+
+        :param str caller: The line of code that led to the operations.
+        :param dict kinds: The counts of operations for each kind.
+        :param counts: The counts of operations for all kinds.
+        """
+        with self._lock:
+            self.total.add(**counts)
+            usage = self.by_caller.get(caller)
+            if usage is None:
+                usage = self.by_caller[caller] = Usage()
+            usage.add(**counts)
+            for kind, kind_counts in kinds.items():
+                usage = self.by_kind.get(kind)
+                if usage is None:
+                    usage = self.by_kind[kind] = Usage()
+                usage.add(**kind_counts)
+
+
+def _account(event):
+    """The instrumentation listener that passes the operations in each RPC to the active accountants."""
+    accountants = list(_ACCOUNTANTS)
+    if not accountants or event.error is not None:
+        return
+    operations = _OPERATIONS.get(event.method)
+    if operations is None:
+        return
+    kinds = {}
+    counts = operations(event.request_pb, event.response_pb, kinds)
+    counts['rpcs'] = 1
+    for kind_counts in kinds.values():
+        kind_counts['rpcs'] = 1
+    caller = caller_site()
+    for accountant in accountants:
+        accountant.record(caller, kinds, **counts)
+
+
+def _add(kinds, kind, field, count=1):
+    counts = kinds.setdefault(kind, {})
+    counts[field] = counts.get(field, 0) + count
+
+
+def _lookup_operations(request_pb, response_pb, kinds):
+    """Every entity found or missing is a read. Deferred keys aren't read, and are looked up again."""
+    results = list(response_pb.found) + list(response_pb.missing)
+    for result in results:
+        _add(kinds, result.entity.key.path[-1].kind, 'entity_reads')
+    return {'entity_reads': len(results)}
+
+
+def _run_query_operations(request_pb, response_pb, kinds):
+    """Each query is a read, plus a read per entity returned, or a small op per result of keys-only or projections."""
+    query = request_pb.query
+    kind = query.kind[0].name if query.kind else None
+    results = len(response_pb.batch.entity_results)
+    field = 'small_ops' if query.projection else 'entity_reads'
+    _add(kinds, kind, 'entity_reads')
+    _add(kinds, kind, field, results)
+    if field == 'entity_reads':
+        return {'entity_reads': results + 1}
+    return {'entity_reads': 1, 'small_ops': results}
+
+
+def _commit_operations(request_pb, response_pb, kinds):
+    counts = {'entity_writes': 0, 'entity_deletes': 0}
+    for mutation in request_pb.mutations:
+        operation = mutation.WhichOneof('operation')
+        if operation is None:
+            continue
+        if operation == 'delete':
+            field, kind = 'entity_deletes', mutation.delete.path[-1].kind
+        else:
+            field, kind = 'entity_writes', getattr(mutation, operation).key.path[-1].kind
+        counts[field] += 1
+        _add(kinds, kind, field)
+    counts['index_writes'] = response_pb.index_updates
+    if response_pb.index_updates:
+        _add(kinds, next(iter(kinds)) if len(kinds) == 1 else None, 'index_writes', response_pb.index_updates)
+    return counts
+
+
+def _allocate_ids_operations(request_pb, response_pb, kinds):
+    for key in response_pb.keys:
+        _add(kinds, key.path[-1].kind, 'small_ops')
+    return {'small_ops': len(response_pb.keys)}
+
+
+_OPERATIONS = {
+    'lookup': _lookup_operations,
+    'runQuery': _run_query_operations,
+    'commit': _commit_operations,
+    'allocateIds': _allocate_ids_operations,
+}
@@ -0,0 +1,185 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Client side allocation of entity IDs.
+
+Entities with a partial key normally only get an ID once the ``commit`` that inserts them returns. An
+:class:`IdAllocator` instead reserves blocks of IDs for a kind up front using the ``allocateIds`` RPC and hands them out
+locally, so entities can have a complete key before they are ever written. That means they can be upserted, written in
+parallel batches and referenced by other entities (eg. as a parent) before they exist in Datastore.
+
+Most of the time you'll want to enable this per entity via the ``id_block_size`` Meta option::
+
+    class LogEntry(Entity):
+        message = TextProperty()
+
+        class Meta:
+            id_block_size = 500
+
+Every partial root key of that kind is then completed from a prefetched block when it's added to a
+:class:`~gcloudoem.datastore.transaction.Transaction`. You can also complete keys yourself::
+
+    >>> parent = Parent()  # Only root keys can be completed
+    >>> get_id_allocator(Parent).assign(parent)
+    >>> child = Child(key=(parent, None))  # parent.key is complete, even though it hasn't been saved yet
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import deque
+import threading
+
+from . import utils
+from .connection import get_connection
+from ..key import Key
+
+
+DEFAULT_BLOCK_SIZE = 100
+"""The number of IDs fetched from Datastore in each ``allocateIds`` call."""
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_id_allocator(entity, block_size=None, connection=None):
+    """
+    Get the shared :class:`IdAllocator` for an entity kind on a connection, creating it if needed.
+
+    :param entity: An :class:`~gcloudoem.entity.Entity` subclass or the kind (str) to get the allocator for.
+    :param int block_size: The block size to use if the allocator needs to be created. Defaults to the entity's
+        ``id_block_size`` Meta option, or :data:`DEFAULT_BLOCK_SIZE`.
+    :param connection: The connection to allocate IDs with. Defaults to the current connection.
+
+    :rtype: :class:`IdAllocator`
+    """
+    if isinstance(entity, type):
+        kind = entity._meta.kind
+        block_size = block_size or entity._meta.id_block_size
+    else:
+        kind = entity
+    connection = connection or get_connection()
+    alias = (connection.dataset, connection.namespace, kind)
+    with _allocators_lock:
+        allocator = _allocators.get(alias)
+        if allocator is None:
+            allocator = _allocators[alias] = IdAllocator(kind, block_size=block_size, connection=connection)
+    return allocator
+
+
+def clear_id_allocators():
+    """Forget all shared allocators. Any IDs they hold that haven't been handed out are simply never used."""
+    with _allocators_lock:
+        _allocators.clear()
+
+
+class IdAllocator(object):
+    """
+    Hands out Datastore reserved IDs for a single kind.
+
+    IDs are reserved in blocks of ``block_size`` with :meth:`~gcloudoem.datastore.connection.Connection.allocate_ids`.
+    When the number of unused IDs drops to ``low_water_mark`` the next block is fetched on a background thread, so
+    callers rarely wait on an RPC. IDs are reserved for root keys of the kind: Datastore allocates the IDs of keys with
+    a parent separately for each parent, so they can't be completed from the same blocks.
+
+    Instances are thread safe.
+    """
+    def __init__(self, kind, block_size=None, low_water_mark=None, connection=None, prefetch=True):
+        """
+        :param str kind: The kind to allocate IDs for.
+        :param int block_size: How many IDs to reserve per RPC. Defaults to :data:`DEFAULT_BLOCK_SIZE`.
+        :param int low_water_mark: Prefetch the next block once this many IDs are left. Defaults to a quarter of
+            ``block_size``.
+        :param connection: The connection to allocate IDs with. Defaults to the current connection.
+        :param bool prefetch: Fetch blocks in the background before the current one runs out. Defaults to True.
+        """
+        self._kind = kind
+        self._block_size = block_size or DEFAULT_BLOCK_SIZE
+        self._low_water_mark = self._block_size // 4 if low_water_mark is None else low_water_mark
+        self._connection = connection or get_connection()
+        self._prefetch = prefetch
+        self._ids = deque()
+        self._lock = threading.Condition(threading.Lock())
+        self._fetching = False
+        self._fetch_error = None
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def available(self):
+        """The number of reserved IDs that haven't been handed out yet."""
+        return len(self._ids)
+
+    def next_id(self):
+        """
+        Get the next reserved ID, fetching a new block if necessary.
+
+        :rtype: int
+        :raises: :class:`~gcloudoem.exceptions.GCloudError` if the ``allocateIds`` RPC fails.
+        """
+        with self._lock:
+            while not self._ids:
+                if self._fetching:
+                    self._lock.wait()
+                    continue
+                if self._fetch_error is not None:
+                    error, self._fetch_error = self._fetch_error, None
+                    raise error
+                self._fetching = True
+                self._lock.release()
+                try:
+                    ids = self._fetch_block()
+                finally:
+                    self._lock.acquire()
+                    self._fetching = False
+                    self._lock.notify_all()
+                self._ids.extend(ids)
+
+            next_id = self._ids.popleft()
+            if self._prefetch and not self._fetching and len(self._ids) <= self._low_water_mark:
+                self._fetching = True
+                thread = threading.Thread(
+                    target=utils.in_current_context(self._prefetch_block), name='gcloudoem-id-allocator'
+                )
+                thread.daemon = True
+                thread.start()
+            return next_id
+
+    def assign(self, entity):
+        """
+        Complete ``entity``'s key with a reserved ID if it's partial.
+
+        :param entity: The :class:`~gcloudoem.entity.Entity` to complete the key of.
+        :rtype: :class:`~gcloudoem.key.Key`
+        :returns: The entity's (now complete) key.
+        :raises: ValueError if the key isn't a root key of our kind.
+        """
+        key = entity.key
+        if key.is_partial:
+            if key.kind != self._kind:
+                raise ValueError("This allocator allocates IDs for %s, not %s" % (self._kind, key.kind))
+            if len(key.path) > 1:
+                raise ValueError("Can't allocate an ID for a key with a parent")
+            key._complete(self.next_id())
+        return key
+
+    def _fetch_block(self):
+        """Reserve a block of IDs with a single ``allocateIds`` RPC."""
+        key_pb = Key(self._kind).to_protobuf(self._connection.dataset, self._connection.namespace)
+        key_pbs = self._connection.allocate_ids([key_pb] * self._block_size)
+        return [key_pb.path[-1].id for key_pb in key_pbs]
+
+    def _prefetch_block(self):
+        """Background thread target. Errors are kept and raised by the next :meth:`next_id` that needs the block."""
+        ids = error = None
+        try:
+            ids = self._fetch_block()
+        except Exception as e:
+            error = e
+        with self._lock:
+            if ids:
+                self._ids.extend(ids)
+            elif not self._ids:
+                self._fetch_error = error
+            self._fetching = False
+            self._lock.notify_all()
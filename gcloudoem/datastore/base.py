@@ -78,6 +78,7 @@ class BaseConnection(object):
         self._namespace = namespace
         self._http = http
         self._credentials = credentials
+        self.timeout = None  # Socket timeout (seconds) for the default http object
 
     @property
     def dataset(self):
@@ -109,7 +110,7 @@ class BaseConnection(object):
             return self._http
 
         if not hasattr(self._local, "http"):
-            self._local.http = httplib2.Http()
+            self._local.http = httplib2.Http(timeout=self.timeout)
             if self._credentials:
                 self._local.http = self._credentials.authorize(self._local.http)
         return self._local.http
@@ -26,12 +26,16 @@ used internally but could be later on.
 from __future__ import absolute_import, division, print_function
 
 import os
-import random
+import threading
 import time
 
+import six
+
+from . import instrumentation
 from .base import BaseConnection
 from ._generated import datastore_pb2 as datastore_pb
-from ..exceptions import ConnectionError, make_exception
+from .retry import RetryPolicy, _clock
+from ..exceptions import ConnectionError, DeadlineExceeded, make_exception
 
 
 DEFAULT_NAMESPACE = 'default'
@@ -45,13 +49,22 @@ _connections = {}
 _default_connection = None
 
 
-def register_connection(dataset, namespace, credentials):
-    """Shortcut to create a new connection."""
+def register_connection(dataset, namespace, credentials, connection_cls=None, **kwargs):
+    """
+    Shortcut to create a new connection, and make it the default.
+
+    :param connection_cls: The class of the connection. Defaults to :class:`Connection`.
+
+    Any other keyword arguments are passed on to ``connection_cls``.
+
+    :returns: The new connection.
+    """
     global _connections, _default_connection
 
-    connection = Connection(dataset, namespace, credentials)
+    connection = (connection_cls or Connection)(dataset, namespace, credentials=credentials, **kwargs)
     _connections[namespace] = connection
     _default_connection = connection
+    return connection
 
 
 def get_connection(alias=None):
@@ -94,13 +107,20 @@ class Connection(BaseConnection):
     API_URL_TEMPLATE = ('{api_base}/{api_version}/projects/{dataset_id}:{method}')
     """A template for the URL of a particular API call."""
 
-    RETRY_STATUSES = [500, 502, 503, 504]
-    """Automatically retry a request when we encounter any of these status codes."""
+    RETRY_STATUSES = list(RetryPolicy.RETRY_STATUSES)
+    """
+    Deprecated, pass a ``retry_policy`` instead. The statuses the default
+    :class:`~gcloudoem.datastore.retry.RetryPolicy` retries.
+    """
 
-    MAX_RETRIES = 2
-    """Number of times to try a request when a RETRY_STATUSES code is encountered."""
+    MAX_RETRIES = RetryPolicy().max_attempts - 1
+    """
+    Deprecated, pass a ``retry_policy`` instead. The number of times the default
+    :class:`~gcloudoem.datastore.retry.RetryPolicy` retries a request.
+    """
 
-    def __init__(self, dataset_id, namespace, credentials=None, http=None, api_base_url=None):
+    def __init__(self, dataset_id, namespace, credentials=None, http=None, api_base_url=None, rate_limiter=None,
+                 retry_policy=None, circuit_breaker=None, hedging_policy=None):
         """
         :param str dataset_id: The gcloud Datastore dataset identified.
         :param str namespace: The gcloud Datastore namesapce to use.
@@ -110,53 +130,144 @@ class Connection(BaseConnection):
             method that accepts the following arguments: ``uri``, ``method``, ``body`` and ``headers``.
         :param str api_base_url: The base of the API call URL. Defaults to
             :attr:`~gcloudoem.datastore.base.BaseConnection.API_BASE_URL`.
+        :param rate_limiter: A :class:`~gcloudoem.datastore.ratelimit.WriteRateLimiter` every commit has to wait for.
+            Can also be set later via the ``rate_limiter`` attribute. Defaults to no limit.
+        :param retry_policy: The :class:`~gcloudoem.datastore.retry.RetryPolicy` for failed requests. Defaults to
+            ``RetryPolicy()``, with :attr:`MAX_RETRIES` and :attr:`RETRY_STATUSES` if they've been changed.
+        :param circuit_breaker: A :class:`~gcloudoem.datastore.retry.CircuitBreaker` to fail requests fast while
+            Datastore is down. Defaults to None.
+        :param hedging_policy: A :class:`~gcloudoem.datastore.hedging.HedgingPolicy` to send a second copy of slow
+            reads. Defaults to None.
         """
         super(Connection, self).__init__(dataset_id, namespace, credentials=credentials, http=http)
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or self._default_retry_policy()
+        self.circuit_breaker = circuit_breaker
+        self.hedging_policy = hedging_policy
         try:
             self.host = os.environ[GCD_HOST]
             self.api_base_url = 'http://' + self.host
         except KeyError:
             self.host = DATASTORE_API_HOST
             self.api_base_url = self.__class__.API_BASE_URL
-
-    def _request(self, method, data):
+        if api_base_url is not None:
+            self.api_base_url = api_base_url
+
+    def _default_retry_policy(self):
+        """The default :class:`~gcloudoem.datastore.retry.RetryPolicy`, honouring the deprecated class attributes."""
+        policy = RetryPolicy(max_attempts=self.MAX_RETRIES + 1)
+        statuses = tuple(int(status) for status in self.RETRY_STATUSES)
+        if statuses != policy.RETRY_STATUSES:
+            policy.RETRY_STATUSES = statuses
+        return policy
+
+    @property
+    def retry_policy(self):
+        """The :class:`~gcloudoem.datastore.retry.RetryPolicy` for failed requests."""
+        return self._retry_policy
+
+    @retry_policy.setter
+    def retry_policy(self, policy):
+        self._retry_policy = policy
+        if policy.attempt_timeout != self.timeout:
+            self.timeout = policy.attempt_timeout
+            self._local = threading.local()  # Drop the http objects made with the old timeout
+
+    def _request(self, method, data, idempotent=False, event=None):
         """Make a request over the Http transport to the Cloud Datastore API.
 
+        Failed requests are retried according to :attr:`retry_policy`.
+
         :param str method: The API call method name (ie, ``runQuery``, ``lookup``, etc)
 
         :param str data: The data to send with the API call. Typically this is a serialized Protobuf string.
 
+        :param bool idempotent: Is it safe to send the request again when we don't know if it was processed?
+
+        :param event: An :class:`~gcloudoem.datastore.instrumentation.RpcEvent` to record the attempts made in.
+
         :rtype: str
         :returns: The str response content from the API call.
-        :raises: :class:`~gcloudoem.exceptions.GCloudError` if the response code is not 200 OK.
+        :raises: :class:`~gcloudoem.exceptions.GCloudError` if the response code is not 200 OK,
+            :class:`~gcloudoem.exceptions.DeadlineExceeded` if retrying would go past the method's deadline or
+            :class:`~gcloudoem.exceptions.CircuitOpen` if the :attr:`circuit_breaker` is open.
         """
-        retries = 0
+        policy, breaker = self.retry_policy, self.circuit_breaker
+        deadline = policy.deadline_for(method)
+        started = _clock()
+        attempt = 0
         headers = {
             'Content-Type': 'application/x-protobuf',
             'Content-Length': str(len(data)),
             'User-Agent': self.USER_AGENT,
         }
         while True:
-            #try:
-            headers, content = self.http.request(
-                uri=self.build_api_url(method=method),
-                method='POST',
-                headers=headers,
-                body=data
-            )
-            #except ssl.SSLError as e:
-                #import pdb
-                #pdb.set_trace()
-
-            status = headers['status']
-            if status != '200':
-                if status in self.RETRY_STATUSES and retries < self.MAX_RETRIES:
-                    retries += 1
-                    time.sleep(random.random() * retries)
-                    continue
-                raise make_exception(headers, content, use_json=False)
+            if breaker is not None:
+                breaker.before_request()
+            attempt += 1
+            if event is not None:
+                event.attempts += 1
+                event.request_bytes = len(data)
+                event.status = None
+            try:
+                response, content = self.http.request(
+                    uri=self.build_api_url(method=method),
+                    method='POST',
+                    headers=headers,
+                    body=data
+                )
+                if event is not None:
+                    event.status = int(response['status'])
+                    event.response_bytes = len(content)
+                if int(response['status']) != 200:
+                    raise make_exception(response, content, use_json=False)
+            except Exception as e:
+                if breaker is not None:
+                    if policy.is_failure(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not policy.should_retry(e, attempt, idempotent):
+                    raise
+                delay = policy.backoff(attempt)
+                if deadline is not None and _clock() - started + delay > deadline:
+                    six.raise_from(
+                        DeadlineExceeded('%s deadline of %ss exceeded after %d attempts: %s' % (
+                            method, deadline, attempt, e
+                        )),
+                        e
+                    )
+                time.sleep(delay)
+                continue
+
+            if breaker is not None:
+                breaker.record_success()
             return content
 
+    def _hedged_request(self, method, data, idempotent, event):
+        """
+        Make a request through the :attr:`hedging_policy`.
+
+        The copies of the request run on different threads, each with its own (thread-local) http object, and record
+        their attempts separately. The attempts of the copy whose response is used are then added to ``event``.
+        """
+        records = []
+
+        def request():
+            record = _Attempts()
+            records.append(record)
+            return self._request(method, data, idempotent, record), record
+
+        try:
+            response, record = self.hedging_policy.call(method, request)
+        except Exception:
+            if event is not None and records:
+                records[0].copy_to(event)
+            raise
+        if event is not None:
+            record.copy_to(event)
+        return response
+
     def _rpc(self, method, request_pb, response_pb_cls):
         """
         Make a protobuf RPC request.
@@ -168,11 +279,22 @@ class Connection(BaseConnection):
         :param :class:`google.protobuf.message.Message` response_pb_cls: The class used to unmarshall the response
             protobuf.
         """
-        response = self._request(
-            method=method,
-            data=request_pb.SerializeToString()
-        )
-        return response_pb_cls.FromString(response)
+        event = instrumentation.RpcEvent(method, self, request_pb) if instrumentation.has_listeners() else None
+        try:
+            data = request_pb.SerializeToString()
+            idempotent = self.retry_policy.is_idempotent(method, request_pb)
+            if self.hedging_policy is not None and method in self.hedging_policy.METHODS and self._http is None:
+                response = self._hedged_request(method, data, idempotent, event)
+            else:
+                response = self._request(method=method, data=data, idempotent=idempotent, event=event)
+            response_pb = response_pb_cls.FromString(response)
+        except Exception as e:
+            if event is not None:
+                event.finish(error=e)
+            raise
+        if event is not None:
+            event.finish(response_pb)
+        return response_pb
 
     def build_api_url(self, method, base_url=None, api_version=None):
         """Construct the URL for a particular API call.
@@ -195,7 +317,7 @@ class Connection(BaseConnection):
             method=method,
         )
 
-    def lookup(self, key_pbs, eventual=False, transaction_id=None):
+    def lookup(self, key_pbs, eventual=False, transaction_id=None, entity_results=False):
         """
         Lookup keys from in the Cloud Datastore.
 
@@ -212,6 +334,10 @@ class Connection(BaseConnection):
         :param str transaction_id: If passed, make the request in the scope of the given transaction.  Incompatible with
             ``eventual==True``.
 
+        :param bool entity_results: If True, ``results`` and ``missing`` contain the
+            :class:`~gcloudoem.datastore._generated.query_pb2.EntityResult`s (which include the entity ``version``)
+            rather than just the entities. Defaults to False.
+
         :rtype: tuple
         :returns: A triple of (``results``, ``missing``, ``deferred``) where both ``results`` and ``missing`` are lists
             of :class:`gcloud.datastore._datastore_v1_pb2.Entity` and ``deferred`` is a list of
@@ -219,16 +345,20 @@ class Connection(BaseConnection):
         """
         lookup_request = datastore_pb.LookupRequest()
         _set_read_options(lookup_request, eventual, transaction_id)
-        _add_keys_to_request(lookup_request.key, key_pbs)
+        _add_keys_to_request(lookup_request.keys, key_pbs)
 
         lookup_response = self._rpc('lookup', lookup_request, datastore_pb.LookupResponse)
 
+        if entity_results:
+            return list(lookup_response.found), list(lookup_response.missing), list(lookup_response.deferred)
+
         results = [result.entity for result in lookup_response.found]
         missing = [result.entity for result in lookup_response.missing]
 
         return results, missing, list(lookup_response.deferred)
 
-    def run_query(self, query_pb, namespace=None, eventual=False, transaction_id=None):
+    def run_query(self, query_pb, namespace=None, eventual=False, transaction_id=None, entity_results=False,
+                  start_cursor=None, end_cursor=None, limit=None, offset=None):
         """Run a query on the Cloud Datastore.
 
         Maps the ``DatastoreService.RunQuery`` protobuf RPC.
@@ -252,6 +382,18 @@ class Connection(BaseConnection):
         :type transaction_id: string
         :param transaction_id: If passed, make the request in the scope of the given transaction.  Incompatible with
             ``eventual==True``.
+
+        :type entity_results: boolean
+        :param entity_results: If True, return the :class:`~gcloudoem.datastore._generated.query_pb2.EntityResult`s
+            (which include the entity ``version``) rather than just the entities. Defaults to False.
+
+        :param bytes start_cursor: If passed, overrides the query's ``start_cursor``.
+        :param bytes end_cursor: If passed, overrides the query's ``end_cursor``.
+        :param int limit: If passed, overrides the query's ``limit``.
+        :param int offset: If passed, overrides the query's ``offset``.
+
+        The overrides are set on the request's copy of ``query_pb``, so the same ``query_pb`` can be used for every
+        page of results.
         """
         request = datastore_pb.RunQueryRequest()
         _set_read_options(request, eventual, transaction_id)
@@ -260,9 +402,18 @@ class Connection(BaseConnection):
             request.partition_id.namespace_id = namespace
 
         request.query.CopyFrom(query_pb)
+        if start_cursor is not None:
+            request.query.start_cursor = start_cursor
+        if end_cursor is not None:
+            request.query.end_cursor = end_cursor
+        if limit is not None:
+            request.query.limit.value = limit
+        if offset is not None:
+            request.query.offset = offset
         response = self._rpc('runQuery', request, datastore_pb.RunQueryResponse)
+        results = response.batch.entity_results
         return (
-            [e.entity for e in response.batch.entity_results],
+            list(results) if entity_results else [e.entity for e in results],
             response.batch.end_cursor,  # Assume response always has cursor.
             response.batch.more_results,
             response.batch.skipped_results,
@@ -306,6 +457,8 @@ class Connection(BaseConnection):
         :returns': the result protobuf for the mutation.
         """
         # request = datastore_pb.CommitRequest()
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(request)
 
         if transaction_id:
             request.mode = datastore_pb.CommitRequest.TRANSACTIONAL
@@ -343,10 +496,24 @@ class Connection(BaseConnection):
         :returns: An equal number of keys,  with IDs filled in by the backend.
         """
         request = datastore_pb.AllocateIdsRequest()
-        _add_keys_to_request(request.key, key_pbs)
-        # Nothing to do with this response, so just execute the method.
+        _add_keys_to_request(request.keys, key_pbs)
         response = self._rpc('allocateIds', request, datastore_pb.AllocateIdsResponse)
-        return list(response.key)
+        return list(response.keys)
+
+
+class _Attempts(object):
+    """The attempts of one copy of a hedged request, recorded like an :class:`~.instrumentation.RpcEvent`."""
+    def __init__(self):
+        self.attempts = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.status = None
+
+    def copy_to(self, event):
+        event.attempts += self.attempts
+        event.request_bytes = self.request_bytes
+        event.response_bytes = self.response_bytes
+        event.status = self.status
 
 
 def _set_read_options(request, eventual, transaction_id):
@@ -0,0 +1,309 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+A local, fake Datastore server.
+
+:class:`FakeDatastoreServer` serves an :class:`~gcloudoem.datastore.memory.InMemoryDatastore` over the same HTTP
+protobuf API as Datastore (``POST /v1/projects/{project}:{method}``), and optionally over gRPC too. Unlike an
+:class:`~gcloudoem.datastore.memory.InMemoryConnection`, requests go through the whole client stack (serialisation,
+HTTP, retries, connection pooling), so it can be used to load test that stack end to end without the emulator or a
+network.
+
+A :class:`FaultInjector` adds latency, errors and throttling to the server's responses, to see how the client copes::
+
+    >>> faults = FaultInjector(latency=0.02, jitter=0.05, error_rate=0.01, throttle_rate=500)
+    >>> with FakeDatastoreServer(faults=faults) as server:
+    ...     connection = Connection('project', 'default', api_base_url=server.http_url)
+    ...     run_load_test(connection)
+    >>> faults.stats()
+    {'requests': 10000, 'errors': 98, 'throttled': 112}
+
+It can also be run on its own, and used by setting ``DATASTORE_EMULATOR_HOST`` to the address it prints::
+
+    $ python -m gcloudoem.datastore.fakeserver --port 8081 --latency 0.01 --error-rate 0.01
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import random
+import re
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+from ._generated import datastore_pb2 as datastore_pb
+from .memory import InMemoryDatastore
+from .ratelimit import TokenBucket
+from ..exceptions import _HTTP_CODE_TO_EXCEPTION, GCloudError, TooManyRequests
+
+try:
+    from concurrent import futures
+    import grpc
+    from ._generated import datastore_grpc_pb2
+except ImportError:  # gRPC is optional
+    grpc = datastore_grpc_pb2 = None
+
+
+REQUEST_CLASSES = {
+    'lookup': datastore_pb.LookupRequest,
+    'runQuery': datastore_pb.RunQueryRequest,
+    'beginTransaction': datastore_pb.BeginTransactionRequest,
+    'commit': datastore_pb.CommitRequest,
+    'rollback': datastore_pb.RollbackRequest,
+    'allocateIds': datastore_pb.AllocateIdsRequest,
+}
+"""The request protobuf class of each API method."""
+
+_PATH = re.compile(r'^/v1/projects/(?P<project>[^/:]+):(?P<method>\w+)$')
+
+_GRPC_METHODS = {
+    'Lookup': 'lookup', 'RunQuery': 'runQuery', 'BeginTransaction': 'beginTransaction', 'Commit': 'commit',
+    'Rollback': 'rollback', 'AllocateIds': 'allocateIds',
+}
+
+_GRPC_STATUSES = {
+    400: 'INVALID_ARGUMENT', 401: 'UNAUTHENTICATED', 403: 'PERMISSION_DENIED', 404: 'NOT_FOUND', 409: 'ABORTED',
+    412: 'FAILED_PRECONDITION', 429: 'RESOURCE_EXHAUSTED', 500: 'INTERNAL', 501: 'UNIMPLEMENTED', 503: 'UNAVAILABLE',
+    504: 'DEADLINE_EXCEEDED',
+}
+
+
+class FaultInjector(object):
+    """
+    Makes a fake server slow and unreliable.
+
+    Every request is delayed by ``latency`` plus a random amount up to ``jitter``. Then it's throttled with a ``429`` if
+    the server is over ``throttle_rate``, or fails with ``error_code`` with a probability of ``error_rate``. The
+    attributes can be changed while the server is running.
+
+    Instances are thread safe.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_code=503, throttle_rate=None,
+                 throttle_burst=None, methods=None, seed=None):
+        """
+        :param float latency: Seconds to delay every request by.
+        :param float jitter: The most seconds to randomly add to the delay.
+        :param float error_rate: The probability (0 to 1) of a request failing.
+        :param int error_code: The HTTP status requests fail with.
+        :param float throttle_rate: The most requests per second to accept. The rest fail with ``429``. Defaults to no
+            limit.
+        :param float throttle_burst: How many requests can be accepted in a burst. Defaults to ``throttle_rate``.
+        :param methods: The API methods (eg. ``commit``) to inject faults into. Defaults to all of them.
+        :param seed: Seeds the random numbers, to make the faults reproducible.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.methods = frozenset(methods) if methods is not None else None
+        self._throttle = TokenBucket(throttle_rate, throttle_burst) if throttle_rate else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._requests = self._errors = self._throttled = 0
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: How many ``requests`` faults could be injected into, how many failed with ``errors`` and how many
+            were ``throttled``.
+        """
+        with self._lock:
+            return {'requests': self._requests, 'errors': self._errors, 'throttled': self._throttled}
+
+    def inject(self, method):
+        """
+        Delay a request to ``method``, and maybe fail it.
+
+        :raises: :class:`~gcloudoem.exceptions.GCloudError` to fail the request.
+        """
+        if self.methods is not None and method not in self.methods:
+            return
+        with self._lock:
+            self._requests += 1
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self.error_rate and self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if self._throttle is not None and not self._throttle.try_acquire():
+            with self._lock:
+                self._throttled += 1
+            raise TooManyRequests('Throttled by the fake server')
+        if fail:
+            with self._lock:
+                self._errors += 1
+            error = _HTTP_CODE_TO_EXCEPTION.get(self.error_code, GCloudError)('Error injected by the fake server')
+            error.code = self.error_code
+            raise error
+
+
+class FakeDatastoreServer(object):
+    """
+    Serves an :class:`~gcloudoem.datastore.memory.InMemoryDatastore` over HTTP (and gRPC).
+
+    Use it as a context manager, or call :meth:`start` and :meth:`stop`.
+    """
+    def __init__(self, store=None, host='127.0.0.1', port=0, grpc_port=None, faults=None, grpc_workers=16):
+        """
+        :param store: The :class:`~gcloudoem.datastore.memory.InMemoryDatastore` to serve. Defaults to a new one.
+        :param str host: The address to listen on.
+        :param int port: The port for HTTP. Defaults to any free port.
+        :param int grpc_port: The port for gRPC (0 for any free port). Defaults to not serving gRPC, which needs the
+            ``grpcio`` package.
+        :param faults: A :class:`FaultInjector` for the requests. Defaults to no faults.
+        :param int grpc_workers: The number of threads serving gRPC requests.
+        """
+        if grpc_port is not None and grpc is None:
+            raise ImportError('Serving gRPC needs the grpcio package')
+        self.store = store if store is not None else InMemoryDatastore()
+        self.faults = faults
+        self._host = host
+        self._port = port
+        self._grpc_port = grpc_port
+        self._grpc_workers = grpc_workers
+        self._http_server = self._grpc_server = None
+
+    @property
+    def http_url(self):
+        """The base URL for HTTP requests, to use as a connection's ``api_base_url``."""
+        return 'http://%s:%d' % (self._host, self._port)
+
+    @property
+    def host(self):
+        """The ``host:port`` of the HTTP server, to use as ``DATASTORE_EMULATOR_HOST``."""
+        return '%s:%d' % (self._host, self._port)
+
+    @property
+    def grpc_target(self):
+        """The ``host:port`` of the gRPC server."""
+        return '%s:%d' % (self._host, self._grpc_port)
+
+    def handle(self, method, request):
+        """
+        Answer a request, injecting faults.
+
+        :param str method: The API method (eg. ``runQuery``).
+        :param request: The request protobuf.
+        :returns: The response protobuf.
+        :raises: :class:`~gcloudoem.exceptions.GCloudError` if the request failed.
+        """
+        if self.faults is not None:
+            self.faults.inject(method)
+        return self.store.call(method, request)
+
+    def start(self):
+        """Start serving, in background threads."""
+        self._http_server = _HTTPServer((self._host, self._port), _HTTPHandler)
+        self._http_server.fake = self
+        self._port = self._http_server.server_address[1]
+        thread = threading.Thread(target=self._http_server.serve_forever, name='gcloudoem-fake-datastore')
+        thread.daemon = True
+        thread.start()
+
+        if self._grpc_port is not None:
+            self._grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=self._grpc_workers))
+            datastore_grpc_pb2.add_DatastoreServicer_to_server(_servicer(self), self._grpc_server)
+            self._grpc_port = self._grpc_server.add_insecure_port('%s:%d' % (self._host, self._grpc_port))
+            self._grpc_server.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        if self._grpc_server is not None:
+            self._grpc_server.stop(None)
+            self._grpc_server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive, like the real API
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        match = _PATH.match(self.path)
+        if match is None or match.group('method') not in REQUEST_CLASSES:
+            return self._respond(404, b'Not found: ' + self.path.encode('utf-8'), 'text/plain')
+        method = match.group('method')
+        try:
+            request = REQUEST_CLASSES[method].FromString(body)
+            response = self.server.fake.handle(method, request)
+        except GCloudError as e:
+            return self._respond(e.code, e.message.encode('utf-8'), 'text/plain')
+        except Exception as e:
+            return self._respond(400, ('Bad request: %s' % e).encode('utf-8'), 'text/plain')
+        self._respond(200, response.SerializeToString(), 'application/x-protobuf')
+
+    def _respond(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # Don't log every request
+
+
+def _servicer(server):
+    """Make a gRPC ``DatastoreServicer`` for ``server``."""
+    servicer = datastore_grpc_pb2.DatastoreServicer()
+
+    def rpc(method):
+        def call(request, context):
+            try:
+                return server.handle(method, request)
+            except GCloudError as e:
+                context.abort(getattr(grpc.StatusCode, _GRPC_STATUSES.get(e.code, 'UNKNOWN')), e.message)
+        return call
+
+    for name, method in _GRPC_METHODS.items():
+        setattr(servicer, name, rpc(method))
+    return servicer
+
+
+def main(args=None):
+    """Run a fake server until interrupted."""
+    parser = argparse.ArgumentParser(description='Run a fake Datastore server, in memory.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081, help='The port for HTTP.')
+    parser.add_argument('--grpc-port', type=int, default=None, help='The port for gRPC. Not served by default.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to delay every request by.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='The most seconds to randomly add to the delay.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The probability of a request failing.')
+    parser.add_argument('--error-code', type=int, default=503, help='The HTTP status failed requests get.')
+    parser.add_argument('--throttle-rate', type=float, default=None, help='The most requests per second to accept.')
+    options = parser.parse_args(args)
+
+    faults = FaultInjector(
+        latency=options.latency, jitter=options.jitter, error_rate=options.error_rate, error_code=options.error_code,
+        throttle_rate=options.throttle_rate
+    )
+    server = FakeDatastoreServer(host=options.host, port=options.port, grpc_port=options.grpc_port, faults=faults)
+    server.start()
+    print('Serving Datastore over HTTP at %s (set DATASTORE_EMULATOR_HOST=%s)' % (server.http_url, server.host))
+    if options.grpc_port is not None:
+        print('Serving Datastore over gRPC at %s' % server.grpc_target)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
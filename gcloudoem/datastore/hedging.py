@@ -0,0 +1,173 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Hedged read requests.
+
+Most reads are fast, but now and then one lands on a slow backend and takes many times longer than usual. Hedging
+bounds that tail: if a read hasn't finished by the time most reads have (a percentile of recently measured latencies),
+the same request is sent again on another HTTP connection, and whichever response arrives first is used. Only
+idempotent reads (``lookup`` and ``runQuery``) are hedged, and the number of extra requests is capped at a fraction
+of all requests so that hedging can't swamp an already struggling backend. Each copy of a request is sent from its own
+thread, with that thread's own HTTP object, so a connection given a (shared) ``http`` object isn't hedged::
+
+    >>> connection = get_connection()
+    >>> connection.hedging_policy = HedgingPolicy(percentile=95)
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import threading
+import time
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class LatencyTracker(object):
+    """
+    Keeps the most recent latencies of each RPC method.
+
+    Instances are thread safe.
+    """
+    def __init__(self, window=1000):
+        """
+        :param int window: How many latencies to keep for each method.
+        """
+        self._window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, latency):
+        """
+        :param str method: The API method (eg. ``lookup``).
+        :param float latency: How long (seconds) a request took.
+        """
+        with self._lock:
+            latencies = self._latencies.get(method)
+            if latencies is None:
+                latencies = self._latencies[method] = deque(maxlen=self._window)
+            latencies.append(latency)
+
+    def count(self, method):
+        """The number of latencies kept for ``method``."""
+        with self._lock:
+            return len(self._latencies.get(method, ()))
+
+    def percentile(self, method, percentile):
+        """
+        :param str method: The API method.
+        :param float percentile: Between 0 and 100.
+        :rtype: float or None
+        :returns: The ``percentile`` of the recent latencies of ``method`` (nearest rank), or None if there are none.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(method, ()))
+        if not latencies:
+            return None
+        rank = int(round(percentile / 100.0 * len(latencies))) - 1
+        return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+
+class HedgingPolicy(object):
+    """
+    Sends a second copy of slow read requests.
+
+    Instances are thread safe and can be shared between connections.
+    """
+
+    METHODS = ('lookup', 'runQuery')
+    """The methods that are hedged. They must be idempotent."""
+
+    def __init__(self, percentile=95, min_samples=20, min_delay=0.0, max_hedge_ratio=0.1, tracker=None,
+                 max_workers=16):
+        """
+        :param float percentile: Hedge a request once it has taken longer than this percentile of recent requests.
+        :param int min_samples: Don't hedge until this many latencies have been recorded for the method.
+        :param float min_delay: Never hedge before this many seconds.
+        :param float max_hedge_ratio: The most hedged requests allowed, as a fraction of all requests.
+        :param tracker: The :class:`LatencyTracker` to use. Defaults to a new one.
+        :param int max_workers: The size of the thread pool the requests are sent from.
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.tracker = tracker or LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The number of ``requests`` made, how many were ``hedged`` and how many times the hedge was faster
+            (``hedge_wins``).
+        """
+        with self._lock:
+            return {'requests': self._requests, 'hedged': self._hedged, 'hedge_wins': self._hedge_wins}
+
+    def delay(self, method):
+        """
+        :param str method: The API method.
+        :rtype: float or None
+        :returns: How long (seconds) to wait for a response before hedging, or None to not hedge.
+        """
+        if method not in self.METHODS or self.tracker.count(method) < self.min_samples:
+            return None
+        return max(self.min_delay, self.tracker.percentile(method, self.percentile))
+
+    def call(self, method, request):
+        """
+        Make a request, hedging it if it's slow.
+
+        If the request can't be hedged yet (see :meth:`delay`), it's made on the calling thread. Otherwise it's made
+        from a pool thread, so that the caller can take the response of the hedged copy if that arrives first.
+
+        :param str method: The API method.
+        :param request: A callable making the request. Copies of it may run at the same time on different threads, so
+            each call must use its own resources (eg. HTTP object).
+        :returns: The result of the first call of ``request`` to succeed. If every call fails, the first error.
+        """
+        delay = self.delay(method)
+        with self._lock:
+            self._requests += 1
+        if delay is None:
+            return self._timed(method, request)
+
+        first = self._executor.submit(self._timed, method, request)
+        done, _ = wait([first], timeout=delay)
+        if done or not self._take_hedge():
+            return first.result()
+
+        hedge = self._executor.submit(self._timed, method, request)
+        pending = [first, hedge]
+        error = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return future.result()
+                if error is None or future is first:
+                    error = future.exception()
+        raise error
+
+    def _take_hedge(self):
+        """Is another hedged request within the budget? If so, count it."""
+        with self._lock:
+            if self._hedged + 1 > self._requests * self.max_hedge_ratio:
+                return False
+            self._hedged += 1
+            return True
+
+    def _timed(self, method, request):
+        started = _clock()
+        result = request()
+        self.tracker.record(method, _clock() - started)
+        return result
@@ -0,0 +1,226 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Instrumentation of the RPCs made to Datastore.
+
+Every RPC a :class:`~gcloudoem.datastore.connection.Connection` makes produces an :class:`RpcEvent` that is passed to
+each registered listener. A listener is any callable taking the event, so forwarding to a metrics system is a few
+lines::
+
+    >>> def to_statsd(event):
+    ...     statsd.timing('datastore.%s' % event.method, event.latency * 1000)
+    >>> add_listener(to_statsd)
+
+A :class:`HistogramCollector` is included, which keeps latency histograms and totals for each method in memory::
+
+    >>> collector = HistogramCollector()
+    >>> with listening(collector):
+    ...     do_some_work()
+    >>> collector.to_dict()['runQuery']['count']
+    12
+
+When there are no listeners, no events are created, so instrumentation costs nothing unless it's used.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+import warnings
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_listeners = ()
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener):
+    """
+    Call ``listener`` with an :class:`RpcEvent` after every RPC.
+
+    :param listener: A callable taking a single argument. It's called on the thread that made the RPC.
+    """
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+
+
+def remove_listener(listener):
+    """
+    Stop calling ``listener``.
+
+    :raises: ValueError if ``listener`` wasn't added.
+    """
+    global _listeners
+    with _listeners_lock:
+        listeners = list(_listeners)
+        listeners.remove(listener)
+        _listeners = tuple(listeners)
+
+
+@contextmanager
+def listening(listener):
+    """A context manager that calls ``listener`` for the RPCs made inside it (on any thread)."""
+    add_listener(listener)
+    try:
+        yield listener
+    finally:
+        remove_listener(listener)
+
+
+def has_listeners():
+    """:rtype: bool"""
+    return bool(_listeners)
+
+
+def _emit(event):
+    for listener in _listeners:
+        try:
+            listener(event)
+        except Exception as e:  # Metrics shouldn't break the application
+            warnings.warn('RPC listener %r failed: %r' % (listener, e), RuntimeWarning)
+
+
+class RpcEvent(object):
+    """
+    A record of a single RPC.
+
+    :ivar str method: The API method (eg. ``runQuery``).
+    :ivar str dataset: The dataset (project) of the connection.
+    :ivar str namespace: The namespace of the connection.
+    :ivar float latency: How long (seconds) the RPC took, including any retries.
+    :ivar int request_bytes: The size of the serialised request.
+    :ivar int response_bytes: The size of the serialised response, or 0 if there wasn't one.
+    :ivar int attempts: How many times the request was sent. ``attempts - 1`` are retries.
+    :ivar int status: The HTTP status of the last attempt, or None if it didn't get a response.
+    :ivar error: The exception the RPC failed with, or None.
+    :ivar int entity_count: The number of entities (or keys) found, returned, written or allocated.
+    :ivar transaction_id: The ID of the transaction the RPC was part of (or began), if any.
+    :ivar request_pb: The request protobuf.
+    :ivar response_pb: The response protobuf, or None if the RPC failed.
+    """
+    def __init__(self, method, connection, request_pb):
+        self.method = method
+        self.dataset = connection.dataset
+        self.namespace = connection.namespace
+        self.request_pb = request_pb
+        self.response_pb = None
+        self.latency = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.attempts = 0
+        self.status = None
+        self.error = None
+        self.entity_count = 0
+        self.transaction_id = None
+        self._started = _clock()
+
+    @property
+    def retries(self):
+        return max(self.attempts - 1, 0)
+
+    def finish(self, response_pb=None, error=None):
+        """Record the outcome of the RPC and pass the event to the listeners."""
+        self.latency = _clock() - self._started
+        self.response_pb = response_pb
+        self.error = error
+        self.entity_count = _entity_count(self.method, self.request_pb, response_pb)
+        self.transaction_id = _transaction_id(self.method, self.request_pb, response_pb)
+        _emit(self)
+
+    def __repr__(self):
+        return '<RpcEvent %s %.1fms %d entities%s>' % (
+            self.method, (self.latency or 0) * 1000, self.entity_count, ' error' if self.error else ''
+        )
+
+
+def _entity_count(method, request_pb, response_pb):
+    if response_pb is None:
+        return 0
+    if method == 'lookup':
+        return len(response_pb.found)
+    if method == 'runQuery':
+        return len(response_pb.batch.entity_results)
+    if method == 'commit':
+        return len(response_pb.mutation_results)
+    if method == 'allocateIds':
+        return len(response_pb.keys)
+    return 0
+
+
+def _transaction_id(method, request_pb, response_pb):
+    if method in ('lookup', 'runQuery'):
+        return request_pb.read_options.transaction or None
+    if method in ('commit', 'rollback'):
+        return request_pb.transaction or None
+    if method == 'beginTransaction' and response_pb is not None:
+        return response_pb.transaction or None
+    return None
+
+
+class HistogramCollector(object):
+    """
+    A listener that keeps a latency histogram and totals for each method.
+
+    Instances are thread safe.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    """The upper bounds (seconds) of the latency histogram buckets. There's an extra bucket for anything slower."""
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: Increasing upper bounds (seconds) of the latency histogram buckets.
+        """
+        self._buckets = tuple(buckets)
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            stats = self._methods.get(event.method)
+            if stats is None:
+                stats = self._methods[event.method] = {
+                    'count': 0, 'errors': 0, 'retries': 0, 'latency_sum': 0.0, 'latency_min': None,
+                    'latency_max': None, 'request_bytes': 0, 'response_bytes': 0, 'entities': 0,
+                    'buckets': [0] * (len(self._buckets) + 1),
+                }
+            stats['count'] += 1
+            stats['errors'] += event.error is not None
+            stats['retries'] += event.retries
+            stats['latency_sum'] += event.latency
+            if stats['count'] == 1:
+                stats['latency_min'] = stats['latency_max'] = event.latency
+            else:
+                stats['latency_min'] = min(stats['latency_min'], event.latency)
+                stats['latency_max'] = max(stats['latency_max'], event.latency)
+            stats['request_bytes'] += event.request_bytes
+            stats['response_bytes'] += event.response_bytes
+            stats['entities'] += event.entity_count
+            stats['buckets'][bisect.bisect_left(self._buckets, event.latency)] += 1
+
+    def reset(self):
+        """Forget everything collected so far."""
+        with self._lock:
+            self._methods.clear()
+
+    def to_dict(self):
+        """
+        Export what has been collected.
+
+        :rtype: dict
+        :returns: A dict for each method with the ``count`` of RPCs, ``errors``, ``retries``, the ``latency_sum``,
+            ``latency_min`` and ``latency_max`` (seconds), total ``request_bytes``, ``response_bytes`` and
+            ``entities``, and a ``histogram``: a list of ``(upper bound, count)`` pairs where the last upper bound is
+            ``float('inf')``.
+        """
+        with self._lock:
+            result = {}
+            for method, stats in self._methods.items():
+                stats = dict(stats)
+                bounds = self._buckets + (float('inf'),)
+                stats['histogram'] = list(zip(bounds, stats.pop('buckets')))
+                result[method] = stats
+            return result
@@ -0,0 +1,746 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+An in-memory Datastore.
+
+:class:`InMemoryDatastore` answers the Datastore RPCs (lookup, runQuery, commit, beginTransaction, rollback and
+allocateIds) from memory, with the same semantics as the real thing where it matters to an application:
+
+* every indexed property value is kept in a sorted index, and queries scan those indexes, so entities missing a
+  property that is filtered or sorted on are left out of the results, multi-valued properties match a filter if any of
+  their values do, and values of different types sort in Datastore's order;
+* filters (including ``__key__`` and ancestor filters), sort orders, projections (including keys-only), ``distinct_on``,
+  cursors, offsets and limits are supported;
+* transactions are snapshot isolated: reads in a transaction see Datastore as it was when the transaction began, and
+  the commit fails with :class:`~gcloudoem.exceptions.Conflict` if anything the transaction read or wrote has changed
+  since;
+* inserts of existing entities, updates of missing ones and conditional writes (``base_version``) fail like they do
+  in Datastore.
+
+Results are always strongly consistent, and composite index definitions aren't needed (or checked).
+
+:class:`InMemoryConnection` is a :class:`~gcloudoem.datastore.connection.Connection` backed by an
+:class:`InMemoryDatastore`, so everything built on a connection works without a network. It's handy for unit tests,
+and as a baseline for measuring the overhead of the client separately from the server::
+
+    >>> connect_in_memory()
+    >>> Person(name='Alice').save()
+    >>> Person.objects.filter(name='Alice').count()
+    1
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import bisect
+import collections
+import functools
+import itertools
+import json
+import threading
+
+import six
+
+from . import instrumentation
+from ._generated import datastore_pb2 as datastore_pb
+from ._generated import entity_pb2 as entity_pb
+from ._generated import query_pb2 as query_pb
+from .connection import DEFAULT_NAMESPACE, Connection, register_connection
+from ..exceptions import BadRequest, Conflict, NotFound
+
+
+_FILTER = query_pb.PropertyFilter
+_BATCH = query_pb.QueryResultBatch
+_KEY_PROPERTY = '__key__'
+
+# The order Datastore sorts values of different types in.
+_NULL, _INTEGER, _BOOLEAN, _BLOB, _STRING, _DOUBLE, _GEO_POINT, _KEY = range(8)
+
+
+def _path(key_pb):
+    """
+    The path of a key, as a tuple that sorts like Datastore sorts keys.
+
+    Each element of the path is ``(kind, 0, id)`` or ``(kind, 1, name)``; IDs sort before names. The last element of a
+    partial key is ``(kind, 0, 0)``.
+    """
+    return tuple(
+        (element.kind, 1, element.name) if element.name else (element.kind, 0, element.id)
+        for element in key_pb.path
+    )
+
+
+def _value_keys(value_pb):
+    """
+    The index entries for a property value: a list of ``(type, value)`` tuples that sort in Datastore's order.
+
+    Array values have an entry for each element. Values that are excluded from indexes (and entity values, which can't
+    be indexed) have none.
+    """
+    value_type = value_pb.WhichOneof('value_type')
+    if value_type == 'array_value':
+        return [key for value in value_pb.array_value.values for key in _value_keys(value)]
+    if value_pb.exclude_from_indexes or value_type == 'entity_value':
+        return []
+    return [_value_key(value_pb, value_type)]
+
+
+def _value_key(value_pb, value_type=None):
+    value_type = value_type or value_pb.WhichOneof('value_type')
+    if value_type == 'integer_value':
+        return _INTEGER, value_pb.integer_value
+    if value_type == 'timestamp_value':  # Sorted with integers, as microseconds
+        return _INTEGER, value_pb.timestamp_value.seconds * 1000000 + value_pb.timestamp_value.nanos // 1000
+    if value_type == 'string_value':
+        return _STRING, value_pb.string_value
+    if value_type == 'boolean_value':
+        return _BOOLEAN, value_pb.boolean_value
+    if value_type == 'double_value':
+        return _DOUBLE, value_pb.double_value
+    if value_type == 'blob_value':
+        return _BLOB, value_pb.blob_value
+    if value_type == 'key_value':
+        return _KEY, _path(value_pb.key_value)
+    if value_type == 'geo_point_value':
+        return _GEO_POINT, (value_pb.geo_point_value.latitude, value_pb.geo_point_value.longitude)
+    if value_type in (None, 'null_value'):
+        return _NULL, None
+    raise BadRequest('Can not filter or sort on a value of type %s' % value_type)
+
+
+def _index_rows(entity):
+    """The index rows written for ``entity`` (one for the kind, and one each way for each indexed value)."""
+    rows = {(_KEY_PROPERTY,)}
+    for name, value_pb in entity.properties.items():
+        for key in _value_keys(value_pb):
+            rows.add((name, key, False))
+            rows.add((name, key, True))
+    return rows
+
+
+@functools.total_ordering
+class _Descending(object):
+    """Wraps a value so that it sorts in reverse."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _to_json(value):
+    if isinstance(value, tuple):
+        return [_to_json(item) for item in value]
+    if isinstance(value, six.binary_type):
+        return {'b': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _from_json(value):
+    if isinstance(value, list):
+        return tuple(_from_json(item) for item in value)
+    if isinstance(value, dict):
+        return base64.b64decode(value['b'])
+    return value
+
+
+def _encode_cursor(position):
+    return json.dumps(_to_json(position), separators=(',', ':')).encode('utf-8')
+
+
+def _decode_cursor(cursor):
+    try:
+        return _from_json(json.loads(cursor.decode('utf-8')))
+    except (ValueError, TypeError, KeyError):
+        raise BadRequest('Invalid query cursor')
+
+
+class _Transaction(object):
+    """The state of an open transaction."""
+    __slots__ = ('snapshot', 'keys')
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot  # The version of Datastore the transaction reads
+        self.keys = set()  # The (namespace, path)s of the entities it read or wrote
+
+
+class InMemoryDatastore(object):
+    """
+    An in-memory implementation of the Datastore RPCs. See the module documentation for what it supports.
+
+    Each method takes a request protobuf and returns a response protobuf, like the API. Errors are raised as
+    :class:`~gcloudoem.exceptions.GCloudError`\\s. Instances are thread safe.
+
+    :ivar int max_batch_size: The most results returned by a single ``runQuery``. If there are more (and the query
+        doesn't have a smaller limit), the batch ends with ``NOT_FINISHED`` and the rest are fetched using its cursor.
+    """
+
+    METHODS = {
+        'lookup': 'lookup', 'runQuery': 'run_query', 'commit': 'commit', 'beginTransaction': 'begin_transaction',
+        'rollback': 'rollback', 'allocateIds': 'allocate_ids',
+    }
+    """The method implementing each API method."""
+
+    def __init__(self, max_batch_size=1000):
+        """
+        :param int max_batch_size: The most results returned by a single ``runQuery``.
+        """
+        self.max_batch_size = max_batch_size
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Delete everything."""
+        with self._lock:
+            self._version = 0  # The version of the last commit
+            self._entities = {}  # (namespace, path) -> (version, entity pb or None once deleted)
+            self._history = {}  # (namespace, path) -> older (version, entity pb) still visible to a transaction
+            self._kinds = {}  # (namespace, kind) -> sorted paths of the entities of the kind
+            self._indexes = {}  # (namespace, kind, property) -> sorted (value key, path)s
+            self._transactions = {}
+            self._next_transaction = 1
+            self._next_id = 1
+            self._query_cache = collections.OrderedDict()  # (namespace, query, snapshot) -> (rows, sort keys)
+
+    def call(self, method, request):
+        """
+        Call an API method.
+
+        :param str method: The API method (eg. ``runQuery``).
+        :param request: The request protobuf.
+        :returns: The response protobuf.
+        """
+        try:
+            implementation = getattr(self, self.METHODS[method])
+        except KeyError:
+            raise NotFound('Unknown method %s' % method)
+        return implementation(request)
+
+    def __len__(self):
+        """The number of entities stored."""
+        with self._lock:
+            return sum(1 for _, entity in self._entities.values() if entity is not None)
+
+    ##
+    # API methods
+    ##
+    def lookup(self, request):
+        """:rtype: :class:`~gcloudoem.datastore._generated.datastore_pb2.LookupResponse`"""
+        response = datastore_pb.LookupResponse()
+        with self._lock:
+            transaction = self._read_transaction(request.read_options)
+            snapshot = transaction.snapshot if transaction else self._version
+            for key_pb in request.keys:
+                path = _path(key_pb)
+                if not path or not (path[-1][2]):
+                    raise BadRequest('Lookup keys must be complete')
+                namespace = key_pb.partition_id.namespace_id
+                if transaction:
+                    transaction.keys.add((namespace, path))
+                version, entity = self._read(namespace, path, snapshot)
+                if entity is None:
+                    result = response.missing.add()
+                    result.entity.key.CopyFrom(key_pb)
+                    result.version = snapshot
+                else:
+                    result = response.found.add()
+                    result.entity.CopyFrom(entity)
+                    result.version = version
+        return response
+
+    def run_query(self, request):
+        """:rtype: :class:`~gcloudoem.datastore._generated.datastore_pb2.RunQueryResponse`"""
+        if request.HasField('gql_query'):
+            raise BadRequest('GQL queries are not supported')
+        query = request.query
+        namespace = request.partition_id.namespace_id
+        response = datastore_pb.RunQueryResponse()
+        batch = response.batch
+        with self._lock:
+            transaction = self._read_transaction(request.read_options)
+            snapshot = transaction.snapshot if transaction else self._version
+            rows, sort_keys = self._results(namespace, query, snapshot)
+            self._page(query, rows, sort_keys, batch)
+            batch.snapshot_version = snapshot
+            if transaction:
+                transaction.keys.update((namespace, _path(result.entity.key)) for result in batch.entity_results)
+        return response
+
+    def begin_transaction(self, request):
+        """:rtype: :class:`~gcloudoem.datastore._generated.datastore_pb2.BeginTransactionResponse`"""
+        with self._lock:
+            transaction_id = ('%d' % self._next_transaction).encode('ascii')
+            self._next_transaction += 1
+            self._transactions[transaction_id] = _Transaction(self._version)
+        return datastore_pb.BeginTransactionResponse(transaction=transaction_id)
+
+    def rollback(self, request):
+        """:rtype: :class:`~gcloudoem.datastore._generated.datastore_pb2.RollbackResponse`"""
+        with self._lock:
+            self._end_transaction(request.transaction)
+        return datastore_pb.RollbackResponse()
+
+    def allocate_ids(self, request):
+        """:rtype: :class:`~gcloudoem.datastore._generated.datastore_pb2.AllocateIdsResponse`"""
+        response = datastore_pb.AllocateIdsResponse()
+        with self._lock:
+            for key_pb in request.keys:
+                if not key_pb.path or key_pb.path[-1].id or key_pb.path[-1].name:
+                    raise BadRequest('Only partial keys can have IDs allocated')
+                key = response.keys.add()
+                key.CopyFrom(key_pb)
+                key.path[-1].id = self._allocate_id()
+        return response
+
+    def commit(self, request):
+        """:rtype: :class:`~gcloudoem.datastore._generated.datastore_pb2.CommitResponse`"""
+        response = datastore_pb.CommitResponse()
+        with self._lock:
+            transaction = None
+            if request.mode == datastore_pb.CommitRequest.TRANSACTIONAL:
+                transaction = self._end_transaction(request.transaction)
+
+            # Work out every change before making any of them, so that the commit is atomic
+            changes = []
+            seen = set()
+            for mutation in request.mutations:
+                operation = mutation.WhichOneof('operation')
+                if operation is None:
+                    raise BadRequest('A mutation must have an operation')
+                key_pb = mutation.delete if operation == 'delete' else getattr(mutation, operation).key
+                namespace = key_pb.partition_id.namespace_id
+                path = _path(key_pb)
+                if not path:
+                    raise BadRequest('A key must have a path')
+                allocate = not path[-1][2]
+                if allocate and operation not in ('insert', 'upsert'):
+                    raise BadRequest('Key must be complete to %s an entity' % operation)
+                if (namespace, path) in seen and not allocate:
+                    raise BadRequest('A commit may not contain multiple mutations affecting the same entity')
+                seen.add((namespace, path))
+
+                version, entity = self._entities.get((namespace, path), (0, None))
+                if transaction and not allocate:
+                    transaction.keys.add((namespace, path))
+                if operation == 'insert' and entity is not None:
+                    raise Conflict('Entity already exists: %s' % (path,))
+                if operation == 'update' and entity is None:
+                    raise NotFound('No entity to update: %s' % (path,))
+                conflict = mutation.HasField('base_version') and mutation.base_version != version
+                changes.append((mutation, operation, namespace, path, allocate, conflict))
+
+            if transaction is not None:
+                for namespace, path in transaction.keys:
+                    if self._entities.get((namespace, path), (0, None))[0] > transaction.snapshot:
+                        raise Conflict('Too much contention on these datastore entities. Please try again.')
+
+            self._version += 1
+            index_updates = 0
+            for mutation, operation, namespace, path, allocate, conflict in changes:
+                result = response.mutation_results.add()
+                if conflict:
+                    result.conflict_detected = True
+                    result.version = self._entities.get((namespace, path), (0, None))[0]
+                    continue
+                if operation == 'delete':
+                    entity = None
+                else:
+                    entity = entity_pb.Entity()
+                    entity.CopyFrom(getattr(mutation, operation))
+                    if allocate:
+                        entity.key.path[-1].id = self._allocate_id()
+                        path = _path(entity.key)
+                        result.key.CopyFrom(entity.key)
+                    elif not path[-1][1]:
+                        self._next_id = max(self._next_id, path[-1][2] + 1)
+                index_updates += self._write(namespace, path, entity)
+                result.version = self._version
+            response.index_updates = index_updates
+        return response
+
+    ##
+    # Storage
+    ##
+    def _allocate_id(self):
+        allocated = self._next_id
+        self._next_id += 1
+        return allocated
+
+    def _read_transaction(self, read_options):
+        """The transaction a read is part of, if any."""
+        if not read_options.transaction:
+            return None
+        transaction = self._transactions.get(read_options.transaction)
+        if transaction is None:
+            raise BadRequest('Invalid transaction')
+        return transaction
+
+    def _end_transaction(self, transaction_id):
+        transaction = self._transactions.pop(transaction_id, None)
+        if transaction is None:
+            raise BadRequest('Invalid transaction')
+        if not self._transactions:  # Nothing can see the old versions any more
+            self._history.clear()
+        return transaction
+
+    def _read(self, namespace, path, snapshot):
+        """
+        Read an entity as it was at version ``snapshot``.
+
+        :rtype: tuple
+        :returns: ``(version, entity pb)``. The entity is None if it didn't exist.
+        """
+        version, entity = self._entities.get((namespace, path), (0, None))
+        if version <= snapshot:
+            return version, entity
+        for version, entity in reversed(self._history.get((namespace, path), ())):
+            if version <= snapshot:
+                return version, entity
+        return 0, None
+
+    def _write(self, namespace, path, entity):
+        """
+        Store a new version of an entity (or delete it if ``entity`` is None), updating the indexes.
+
+        :rtype: int
+        :returns: The number of index rows written.
+        """
+        old = self._entities.get((namespace, path))
+        if self._transactions and old is not None:
+            self._history.setdefault((namespace, path), []).append(old)
+        old_entity = old[1] if old else None
+        self._entities[(namespace, path)] = (self._version, entity)
+
+        kind = path[-1][0]
+        if old_entity is not None:
+            self._remove(self._kinds[(namespace, kind)], path)
+            for name, value_pb in old_entity.properties.items():
+                index = self._indexes[(namespace, kind, name)]
+                for key in set(_value_keys(value_pb)):
+                    self._remove(index, (key, path))
+        if entity is not None:
+            bisect.insort(self._kinds.setdefault((namespace, kind), []), path)
+            for name, value_pb in entity.properties.items():
+                keys = set(_value_keys(value_pb))
+                if keys:
+                    index = self._indexes.setdefault((namespace, kind, name), [])
+                    for key in keys:
+                        bisect.insort(index, (key, path))
+
+        old_rows = _index_rows(old_entity) if old_entity is not None else set()
+        new_rows = _index_rows(entity) if entity is not None else set()
+        return len(old_rows ^ new_rows)
+
+    @staticmethod
+    def _remove(index, row):
+        position = bisect.bisect_left(index, row)
+        if position < len(index) and index[position] == row:
+            del index[position]
+
+    ##
+    # Queries
+    ##
+    QUERY_CACHE_SIZE = 16
+    """How many queries' results are kept, so that fetching the next page doesn't run the whole query again."""
+
+    def _results(self, namespace, query, snapshot):
+        """
+        The results of ``query`` as of ``snapshot``, ignoring its cursors, offset and limit. Nothing visible at a
+        snapshot ever changes, so the results are cached and each page of a query only has to find where it starts.
+
+        :returns: The rows from :meth:`_query`, and their sort keys.
+        """
+        unpaged = query_pb.Query()
+        unpaged.CopyFrom(query)
+        for field in ('start_cursor', 'end_cursor', 'offset', 'limit'):
+            unpaged.ClearField(field)
+        cache_key = namespace, unpaged.SerializeToString(), snapshot
+        results = self._query_cache.pop(cache_key, None)
+        if results is None:
+            rows = self._query(namespace, query, snapshot)
+            results = rows, [row[0] for row in rows]
+        self._query_cache[cache_key] = results
+        while len(self._query_cache) > self.QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+        return results
+
+    def _query(self, namespace, query, snapshot):
+        """
+        Find the results of ``query``, in order.
+
+        :rtype: list
+        :returns: ``(sort key, position, version, entity pb, projected values)`` for each result. The position is what
+            a cursor for the result holds.
+        """
+        if len(query.kind) > 1:
+            raise BadRequest('A query can only have one kind')
+        kind = query.kind[0].name if query.kind else None
+        filters = self._filters(query.filter) if query.HasField('filter') else []
+        orders = [(order.property.name, order.direction == query_pb.PropertyOrder.DESCENDING) for order in query.order]
+        projection = [projection.property.name for projection in query.projection]
+        if projection == [_KEY_PROPERTY]:
+            projection = []  # Keys only
+        distinct_on = [reference.name for reference in query.distinct_on]
+        needed = set(name for name, _, _ in filters) | set(name for name, _ in orders) | set(projection)
+        needed.discard(_KEY_PROPERTY)
+
+        rows = []
+        for path in self._candidates(namespace, kind, filters, orders, snapshot):
+            version, entity = self._read(namespace, path, snapshot)
+            if entity is None:
+                continue
+            values = {}
+            for name in needed:
+                value_pb = entity.properties.get(name)
+                values[name] = sorted(set(_value_keys(value_pb))) if value_pb is not None else []
+                if not values[name]:
+                    break  # Not in the index for this property, so the query can't find it
+            else:
+                if all(self._matches(path, values, name, op, value) for name, op, value in filters):
+                    order_values = tuple(
+                        path if name == _KEY_PROPERTY else (values[name][-1] if descending else values[name][0])
+                        for name, descending in orders
+                    )
+                    projections = itertools.product(*[values[name] for name in projection]) if projection else [()]
+                    for number, projected in enumerate(projections):
+                        position = (order_values, path, number)
+                        rows.append((self._sort_key(position, orders), position, version, entity, projected))
+        rows.sort(key=lambda row: row[0])
+
+        if distinct_on:
+            seen = set()
+            distinct = []
+            for row in rows:
+                entity = row[3]
+                group = tuple(
+                    tuple(sorted(set(_value_keys(entity.properties[name])))) if name in entity.properties else ()
+                    for name in distinct_on
+                )
+                if group not in seen:
+                    seen.add(group)
+                    distinct.append(row)
+            rows = distinct
+        return rows
+
+    @staticmethod
+    def _sort_key(position, orders):
+        order_values, path, number = position
+        return tuple(
+            _Descending(value) if descending else value for value, (_, descending) in zip(order_values, orders)
+        ) + (path, number)
+
+    def _filters(self, filter_pb):
+        """Flatten a filter into a list of ``(property name, operator, value key)``."""
+        if filter_pb.WhichOneof('filter_type') == 'composite_filter':
+            return [f for sub_filter in filter_pb.composite_filter.filters for f in self._filters(sub_filter)]
+        property_filter = filter_pb.property_filter
+        name = property_filter.property.name
+        if property_filter.op == _FILTER.HAS_ANCESTOR:
+            if name != _KEY_PROPERTY or property_filter.value.WhichOneof('value_type') != 'key_value':
+                raise BadRequest('An ancestor filter must be on __key__ with a key value')
+            return [(name, property_filter.op, _path(property_filter.value.key_value))]
+        if property_filter.op not in (_FILTER.LESS_THAN, _FILTER.LESS_THAN_OR_EQUAL, _FILTER.GREATER_THAN,
+                                      _FILTER.GREATER_THAN_OR_EQUAL, _FILTER.EQUAL):
+            raise BadRequest('Unsupported filter operator %s' % property_filter.op)
+        value = _value_key(property_filter.value)
+        if name == _KEY_PROPERTY:
+            if value[0] != _KEY:
+                raise BadRequest('A __key__ filter must have a key value')
+            value = value[1]
+        return [(name, property_filter.op, value)]
+
+    @staticmethod
+    def _matches(path, values, name, op, value):
+        if name == _KEY_PROPERTY:
+            if op == _FILTER.HAS_ANCESTOR:
+                return path[:len(value)] == value
+            candidates = (path,)
+        else:
+            candidates = values[name]
+        if op == _FILTER.EQUAL:
+            return value in candidates
+        if op == _FILTER.LESS_THAN:
+            return any(candidate < value for candidate in candidates)
+        if op == _FILTER.LESS_THAN_OR_EQUAL:
+            return any(candidate <= value for candidate in candidates)
+        if op == _FILTER.GREATER_THAN:
+            return any(candidate > value for candidate in candidates)
+        return any(candidate >= value for candidate in candidates)
+
+    def _candidates(self, namespace, kind, filters, orders, snapshot):
+        """
+        The paths of the entities that might match a query, from the narrowest index available.
+
+        Every candidate is checked against all the filters afterwards, so this only needs to leave out entities that
+        can't match.
+        """
+        if snapshot < self._version:
+            # Something has changed since the snapshot, so the indexes don't reflect it. Check everything that exists
+            # now or did then.
+            return [
+                path for entity_namespace, path in list(self._entities)
+                if entity_namespace == namespace and (kind is None or path[-1][0] == kind)
+            ]
+        if kind is None:
+            return [
+                path for (index_namespace, _), paths in self._kinds.items() if index_namespace == namespace
+                for path in paths
+            ]
+
+        # Prefer an equality filter, then the inequality filters, then the first sort order
+        for name, op, value in filters:
+            if op == _FILTER.EQUAL and name != _KEY_PROPERTY:
+                return self._scan(namespace, kind, name, value, True, value, True)
+        for name, op, value in filters:
+            if op != _FILTER.EQUAL and op != _FILTER.HAS_ANCESTOR and name != _KEY_PROPERTY:
+                low = high = None
+                low_inclusive = high_inclusive = True
+                for other_name, other_op, other_value in filters:
+                    if other_name != name:
+                        continue
+                    if other_op in (_FILTER.GREATER_THAN, _FILTER.GREATER_THAN_OR_EQUAL):
+                        if low is None or other_value >= low:
+                            low, low_inclusive = other_value, other_op == _FILTER.GREATER_THAN_OR_EQUAL
+                    elif other_op in (_FILTER.LESS_THAN, _FILTER.LESS_THAN_OR_EQUAL):
+                        if high is None or other_value <= high:
+                            high, high_inclusive = other_value, other_op == _FILTER.LESS_THAN_OR_EQUAL
+                return self._scan(namespace, kind, name, low, low_inclusive, high, high_inclusive)
+        if orders and orders[0][0] != _KEY_PROPERTY:
+            return self._scan(namespace, kind, orders[0][0], None, True, None, True)
+
+        paths = self._kinds.get((namespace, kind), [])
+        for name, op, value in filters:
+            if op == _FILTER.HAS_ANCESTOR:
+                start = bisect.bisect_left(paths, value)
+                return list(itertools.takewhile(lambda path: path[:len(value)] == value, paths[start:]))
+        return list(paths)
+
+    def _scan(self, namespace, kind, name, low, low_inclusive, high, high_inclusive):
+        """The paths of the entities with a value of property ``name`` in a range, from its index."""
+        index = self._indexes.get((namespace, kind, name), [])
+        start = 0 if low is None else bisect.bisect_left(index, (low,))
+        paths = set()
+        for key, path in itertools.islice(index, start, None):
+            if high is not None and (key > high or (key == high and not high_inclusive)):
+                break
+            if low is not None and key == low and not low_inclusive:
+                continue
+            paths.add(path)
+        return paths
+
+    def _page(self, query, rows, sort_keys, batch):
+        """Fill in ``batch`` with the page of ``rows`` (sorted by ``sort_keys``) that ``query`` asks for."""
+        orders = [(order.property.name, order.direction == query_pb.PropertyOrder.DESCENDING) for order in query.order]
+        projection = [projection.property.name for projection in query.projection]
+        if projection == [_KEY_PROPERTY]:
+            batch.entity_result_type = query_pb.EntityResult.KEY_ONLY
+        elif projection:
+            batch.entity_result_type = query_pb.EntityResult.PROJECTION
+        else:
+            batch.entity_result_type = query_pb.EntityResult.FULL
+
+        start = 0
+        if query.start_cursor:
+            start = bisect.bisect_right(sort_keys, self._sort_key(_decode_cursor(query.start_cursor), orders))
+        end = len(rows)
+        if query.end_cursor:
+            end = bisect.bisect_right(sort_keys, self._sort_key(_decode_cursor(query.end_cursor), orders))
+        end = max(start, end)
+
+        skipped = min(query.offset, end - start)
+        batch.skipped_results = skipped
+        if skipped:
+            batch.skipped_cursor = _encode_cursor(rows[start + skipped - 1][1])
+        start += skipped
+
+        limit = query.limit.value if query.HasField('limit') else None
+        count = min(end - start, self.max_batch_size if limit is None else min(limit, self.max_batch_size))
+        for _, position, version, entity, projected in rows[start:start + count]:
+            result = batch.entity_results.add()
+            result.entity.key.CopyFrom(entity.key)
+            if batch.entity_result_type == query_pb.EntityResult.FULL:
+                result.entity.CopyFrom(entity)
+            elif batch.entity_result_type == query_pb.EntityResult.PROJECTION:
+                for name, value in zip(projection, projected):
+                    self._set_projected(result.entity.properties[name], entity.properties[name], value)
+            result.version = version
+            result.cursor = _encode_cursor(position)
+
+        if count:
+            batch.end_cursor = batch.entity_results[-1].cursor
+        else:
+            batch.end_cursor = batch.skipped_cursor or query.start_cursor
+
+        if limit is not None and count == limit:
+            batch.more_results = _BATCH.MORE_RESULTS_AFTER_LIMIT
+        elif start + count < end:
+            batch.more_results = _BATCH.NOT_FINISHED
+        elif query.end_cursor:
+            batch.more_results = _BATCH.MORE_RESULTS_AFTER_CURSOR
+        else:
+            batch.more_results = _BATCH.NO_MORE_RESULTS
+
+    @staticmethod
+    def _set_projected(value_pb, stored_pb, key):
+        """Set ``value_pb`` to the value of ``stored_pb`` (or the element of it) with the index entry ``key``."""
+        if stored_pb.WhichOneof('value_type') == 'array_value':
+            for element in stored_pb.array_value.values:
+                if key in _value_keys(element):
+                    stored_pb = element
+                    break
+        value_pb.CopyFrom(stored_pb)
+        value_pb.ClearField('exclude_from_indexes')
+
+
+class InMemoryConnection(Connection):
+    """
+    A :class:`~gcloudoem.datastore.connection.Connection` to an :class:`InMemoryDatastore` rather than the Datastore
+    API. Rate limiters and RPC instrumentation work as they do for a normal connection; there's nothing to retry, so
+    retry policies, circuit breakers and hedging are ignored.
+    """
+    def __init__(self, dataset_id='memory', namespace=DEFAULT_NAMESPACE, store=None, **kwargs):
+        """
+        :param str dataset_id: The dataset (project) ID.
+        :param str namespace: The namespace to use.
+        :param store: The :class:`InMemoryDatastore` to use. Connections sharing a store see the same data. Defaults to
+            a new, empty one.
+
+        The other keyword arguments are passed on to :class:`~gcloudoem.datastore.connection.Connection`.
+        """
+        super(InMemoryConnection, self).__init__(dataset_id, namespace, **kwargs)
+        self.store = store if store is not None else InMemoryDatastore()
+
+    def _rpc(self, method, request_pb, response_pb_cls):
+        event = instrumentation.RpcEvent(method, self, request_pb) if instrumentation.has_listeners() else None
+        try:
+            response_pb = self.store.call(method, request_pb)
+        except Exception as e:
+            if event is not None:
+                event.attempts = 1
+                event.status = getattr(e, 'code', None)
+                event.finish(error=e)
+            raise
+        if event is not None:
+            event.attempts = 1
+            event.status = 200
+            event.request_bytes = request_pb.ByteSize()
+            event.response_bytes = response_pb.ByteSize()
+            event.finish(response_pb)
+        return response_pb
+
+
+def connect_in_memory(dataset_id='memory', namespace=DEFAULT_NAMESPACE, store=None):
+    """
+    Like :func:`~gcloudoem.datastore.connect`, but connect to an :class:`InMemoryDatastore`.
+
+    :param str dataset_id: The dataset (project) ID.
+    :param str namespace: The namespace to use.
+    :param store: The :class:`InMemoryDatastore` to use. Defaults to a new, empty one.
+
+    :rtype: :class:`InMemoryConnection`
+    """
+    return register_connection(dataset_id, namespace, None, connection_cls=InMemoryConnection, store=store)
@@ -0,0 +1,254 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+A profiler for queries.
+
+While profiling is enabled, every execution of a :class:`~gcloudoem.datastore.query.Cursor` is recorded against the
+*shape* of its query: the kind, the properties and operators it filters on, its order and its projection, with the
+filter values stripped out. Queries that only differ by the values they filter on have the same shape, so the report
+shows which query patterns cost the most in total, and where they're run from::
+
+    >>> profiler = enable_profiling(slow_threshold=0.5)
+    >>> run_the_app()
+    >>> for shape in profiler.report(limit=5):
+    ...     print(shape['total_time'], shape['count'], shape['shape'], shape['callers'])
+    >>> profiler.slow_queries()  # The individual executions that took longer than slow_threshold
+    >>> disable_profiling()
+
+Slow executions are also logged to the ``gcloudoem.datastore.profiler`` logger at ``WARNING`` level.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+
+from ._generated import query_pb2 as query_pb
+
+
+logger = logging.getLogger(__name__)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_OPERATORS = {
+    query_pb.PropertyFilter.LESS_THAN: '<',
+    query_pb.PropertyFilter.LESS_THAN_OR_EQUAL: '<=',
+    query_pb.PropertyFilter.GREATER_THAN: '>',
+    query_pb.PropertyFilter.GREATER_THAN_OR_EQUAL: '>=',
+    query_pb.PropertyFilter.EQUAL: '=',
+    query_pb.PropertyFilter.HAS_ANCESTOR: 'HAS ANCESTOR',
+}
+
+_profiler = None
+
+
+def enable_profiling(slow_threshold=1.0, slow_log_size=100):
+    """
+    Start recording query executions, replacing any profiler already running.
+
+    :param float slow_threshold: Executions taking longer than this (seconds) go in the slow query log.
+    :param int slow_log_size: How many slow executions to keep.
+    :rtype: :class:`QueryProfiler`
+    """
+    global _profiler
+    _profiler = QueryProfiler(slow_threshold=slow_threshold, slow_log_size=slow_log_size)
+    return _profiler
+
+
+def disable_profiling():
+    """
+    Stop recording query executions.
+
+    :rtype: :class:`QueryProfiler` or None
+    :returns: The profiler that was running, if any.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_profiler():
+    """:returns: The running :class:`QueryProfiler`, or None."""
+    return _profiler
+
+
+@contextmanager
+def profiling(**kwargs):
+    """Profile the queries run inside a ``with`` block. Takes the same arguments as :func:`enable_profiling`."""
+    profiler = enable_profiling(**kwargs)
+    try:
+        yield profiler
+    finally:
+        if _profiler is profiler:
+            disable_profiling()
+
+
+def query_shape(pb):
+    """
+    Describe a query with its values stripped out, eg. ``Person WHERE age > ? AND name = ? ORDER BY -age``.
+
+    :param pb: A :class:`~gcloudoem.datastore._generated.query_pb2.Query`.
+    :rtype: str
+    """
+    parts = [', '.join(kind.name for kind in pb.kind) or '*']
+    if pb.projection:
+        parts.insert(0, 'SELECT %s FROM' % ', '.join(p.property.name for p in pb.projection))
+    if pb.distinct_on:
+        parts.insert(0, 'DISTINCT ON (%s)' % ', '.join(p.name for p in pb.distinct_on))
+    if pb.HasField('filter'):
+        parts.append('WHERE ' + _filter_shape(pb.filter))
+    if pb.order:
+        parts.append('ORDER BY ' + ', '.join(
+            ('-' if order.direction == query_pb.PropertyOrder.DESCENDING else '') + order.property.name
+            for order in pb.order
+        ))
+    return ' '.join(parts)
+
+
+def _filter_shape(filter_pb):
+    if filter_pb.WhichOneof('filter_type') == 'composite_filter':
+        # Sorted, so that the order filters were added in doesn't matter
+        return ' AND '.join(sorted(_filter_shape(f) for f in filter_pb.composite_filter.filters))
+    property_filter = filter_pb.property_filter
+    return '%s %s ?' % (property_filter.property.name, _OPERATORS.get(property_filter.op, property_filter.op))
+
+
+def fingerprint(shape):
+    """A short, stable ID for a query shape (from :func:`query_shape`)."""
+    return hashlib.sha1(shape.encode('utf-8')).hexdigest()[:12]
+
+
+def caller_site():
+    """
+    Where the code outside gcloudoem that led to the current call is.
+
+    :rtype: str
+    :returns: ``<file>:<line> in <function>``.
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename.startswith(_PACKAGE_DIR):
+        frame = frame.f_back
+    if frame is None:
+        return '<unknown>'
+    return '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+class QueryExecution(object):
+    """
+    The record of one execution of a query (all the pages fetched by a single cursor).
+
+    :ivar str shape: See :func:`query_shape`.
+    :ivar str fingerprint: See :func:`fingerprint`.
+    :ivar str caller: The code that ran the query (see :func:`caller_site`).
+    :ivar int pages: The number of ``runQuery`` RPCs.
+    :ivar int entities: The number of entities returned.
+    :ivar int bytes: The size of the entity results received.
+    :ivar float network_time: Seconds spent waiting on ``runQuery``.
+    :ivar float decode_time: Seconds spent turning results into entities.
+    :ivar float total_time: Seconds from the first page being requested until the execution finished.
+    """
+    def __init__(self, pb):
+        self.shape = query_shape(pb)
+        self.fingerprint = fingerprint(self.shape)
+        self.caller = caller_site()
+        self.pages = 0
+        self.entities = 0
+        self.bytes = 0
+        self.network_time = 0.0
+        self.decode_time = 0.0
+        self.total_time = None
+        self.started = time.time()
+        self._started = _clock()
+
+    def to_dict(self):
+        return {
+            'shape': self.shape, 'fingerprint': self.fingerprint, 'caller': self.caller, 'pages': self.pages,
+            'entities': self.entities, 'bytes': self.bytes, 'network_time': self.network_time,
+            'decode_time': self.decode_time, 'total_time': self.total_time, 'started': self.started,
+        }
+
+    def __repr__(self):
+        return '<QueryExecution %s %.1fms %d entities>' % (self.shape, (self.total_time or 0) * 1000, self.entities)
+
+
+class QueryProfiler(object):
+    """
+    Aggregates :class:`QueryExecution` records by query shape and keeps a log of slow ones.
+
+    Instances are thread safe.
+    """
+    def __init__(self, slow_threshold=1.0, slow_log_size=100):
+        """
+        :param float slow_threshold: Executions taking longer than this (seconds) go in the slow query log.
+        :param int slow_log_size: How many slow executions to keep.
+        """
+        self.slow_threshold = slow_threshold
+        self._slow = deque(maxlen=slow_log_size)
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def start(self, pb):
+        """Start recording an execution of the query ``pb``. :rtype: :class:`QueryExecution`"""
+        return QueryExecution(pb)
+
+    def finish(self, execution):
+        """Record a finished :class:`QueryExecution`."""
+        execution.total_time = _clock() - execution._started
+        with self._lock:
+            stats = self._shapes.get(execution.fingerprint)
+            if stats is None:
+                stats = self._shapes[execution.fingerprint] = {
+                    'shape': execution.shape, 'fingerprint': execution.fingerprint, 'count': 0, 'total_time': 0.0,
+                    'max_time': 0.0, 'network_time': 0.0, 'decode_time': 0.0, 'pages': 0, 'entities': 0, 'bytes': 0,
+                    'callers': Counter(),
+                }
+            stats['count'] += 1
+            stats['total_time'] += execution.total_time
+            stats['max_time'] = max(stats['max_time'], execution.total_time)
+            stats['network_time'] += execution.network_time
+            stats['decode_time'] += execution.decode_time
+            stats['pages'] += execution.pages
+            stats['entities'] += execution.entities
+            stats['bytes'] += execution.bytes
+            stats['callers'][execution.caller] += 1
+            slow = execution.total_time > self.slow_threshold
+            if slow:
+                self._slow.append(execution)
+        if slow:
+            logger.warning(
+                'Slow query (%.3fs, %d pages, %d entities) from %s: %s',
+                execution.total_time, execution.pages, execution.entities, execution.caller, execution.shape
+            )
+
+    def slow_queries(self):
+        """:rtype: list of :class:`QueryExecution`, oldest first."""
+        with self._lock:
+            return list(self._slow)
+
+    def report(self, limit=None):
+        """
+        Query shapes ranked by the total time spent running them.
+
+        :param int limit: Only return this many shapes.
+        :rtype: list of dict
+        :returns: For each shape, its ``shape`` and ``fingerprint``, the ``count`` of executions, their
+            ``total_time``, ``max_time``, ``network_time`` and ``decode_time`` (seconds), total ``pages``, ``entities``
+            and ``bytes``, and ``callers``: a list of ``(caller, count)`` pairs, most common first.
+        """
+        with self._lock:
+            shapes = [dict(stats, callers=stats['callers'].most_common()) for stats in self._shapes.values()]
+        shapes.sort(key=lambda stats: stats['total_time'], reverse=True)
+        return shapes[:limit] if limit is not None else shapes
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._shapes.clear()
+            self._slow.clear()
@@ -24,7 +24,7 @@ import base64
 
 import six
 
-from . import utils
+from . import profiler, utils
 from ._generated import query_pb2 as query_pb
 from .connection import get_connection
 from ..exceptions import InvalidQueryError
@@ -75,7 +75,8 @@ class Query(object):
             order.
 
         :type group_by: sequence of str
-        :param group_by: field names used to group query results.
+        :param group_by: field names used to group query results (Datastore's ``distinct_on``). Only the first result
+            for each combination of their values is returned.
 
         :type limit: int
         :param limit: number of entity results to limit this query to. None means don't limit. Defaults to None.
@@ -97,6 +98,7 @@ class Query(object):
         self._limit = limit
         self._offset = offset
         self._has_inequality_filter = None
+        self._pb = None  # The protobuf, built when it's first needed and kept until the query is changed
 
         for f in filters:
             self.add_filter(*f)
@@ -215,6 +217,7 @@ class Query(object):
                 )
 
         self._filters.append((property_name, operator, value))
+        self._pb = None
 
     @property
     def projection(self):
@@ -239,10 +242,12 @@ class Query(object):
                 raise InvalidQueryError("Entity %s used in this Query doesn't have a property %s" %
                                         (self.entity._meta.kind, projection))
         self._projection[:] = value
+        self._pb = None
 
     def keys_only(self):
         """Set the projection to include only keys."""
         self._projection[:] = ['__key__']
+        self._pb = None
 
     @property
     def order(self):
@@ -275,12 +280,16 @@ class Query(object):
                 raise InvalidQueryError("Entity %s used in this Query doesn't have a property %s" %
                                         (self._entity._meta.kind, prop_name))
         self._order[:] = value
+        self._pb = None
 
     @property
     def group_by(self):
         """
         Names of fields used to group query results.
 
+        These are sent as the query's ``distinct_on``: Datastore only returns the first result for each combination of
+        their values. They must be in the :attr:`projection` too.
+
         :rtype: sequence of str
         """
         return self._group_by[:]
@@ -303,8 +312,9 @@ class Query(object):
                 raise InvalidQueryError("Entity %s used in this Query doesn't have a property %s" %
                                         (self._entity._meta.kind, prop_name))
         self._group_by[:] = value
+        self._pb = None
 
-    def __call__(self):
+    def __call__(self, row_factory=None):
         """
         Execute the Query; return a :class:`Cursor` for the matching entities.
 
@@ -322,12 +332,14 @@ class Query(object):
         For an explication of the options, see
         https://cloud.google.com/datastore/docs/concepts/queries#Datastore_Query_cursors.
 
+        :param row_factory: Builds each result from its entity protobuf, instead of an entity. See :class:`Cursor`.
+
         :rtype: :class:`Cursor`
         :raises: :class:`~gcloudoem.exceptions.ConnectionError` if there is no active connection.
         """
         connection = get_connection()
 
-        return Cursor(self, connection, self.limit, self.offset)
+        return Cursor(self, connection, self.limit, self.offset, row_factory=row_factory)
 
     def clone(self):
         return self.__class__(
@@ -335,6 +347,19 @@ class Query(object):
             self._limit, self._offset
         )
 
+    def cached_protobuf(self):
+        """
+        The protobuf from :meth:`to_protobuf`, built the first time it's needed and kept until the query is changed.
+
+        Executions of the query share it, so that long paginated scans don't re-encode the filters and ancestor key
+        for every page. It mustn't be changed: use :meth:`to_protobuf` for a protobuf of your own.
+
+        :rtype: :class:`~gcloudoem.datastore.datastore_v1_pb2.Query`
+        """
+        if self._pb is None:
+            self._pb = self.to_protobuf()
+        return self._pb
+
     def to_protobuf(self):
         """
         Convert this Query instance to the corresponding protobuf representation.
@@ -393,8 +418,8 @@ class Query(object):
                 property_order.property.name = prop
                 property_order.direction = property_order.ASCENDING
 
-        for group_by_name in self.group_by:
-            pb.group_by.add().name = group_by_name
+        for group_by_name in self._group_by:
+            pb.distinct_on.add().name = group_by_name
 
         return pb
 
@@ -411,16 +436,25 @@ class Cursor(object):
     _FINISHED = (
         query_pb.QueryResultBatch.NO_MORE_RESULTS,
         query_pb.QueryResultBatch.MORE_RESULTS_AFTER_LIMIT,
+        query_pb.QueryResultBatch.MORE_RESULTS_AFTER_CURSOR,
     )
 
-    def __init__(self, query, connection, limit=None, offset=0, start_cursor=None, end_cursor=None):
+    def __init__(self, query, connection, limit=None, offset=0, start_cursor=None, end_cursor=None,
+                 row_factory=None):
+        """
+        :param row_factory: A function that builds each result from its entity protobuf. Defaults to building an
+            instance of the query's entity class. A lighter weight result (eg. a tuple of a projection's values) saves
+            constructing and validating entities.
+        """
         self._query = query
+        self._row_factory = row_factory
         self._connection = connection
         self._limit = limit
         self._offset = offset
         self._start_cursor = start_cursor
         self._end_cursor = end_cursor
         self._page = self._more_results = None
+        self._execution = None  # The profiler's record of this execution, when profiling
 
     def next_page(self):
         """
@@ -428,60 +462,95 @@ class Cursor(object):
 
         Low-level API for fine control: the more convenient API is to iterate on the current Iterator.
 
+        The query's protobuf is only built once (see :meth:`Query.cached_protobuf`). Each page sends it with the cursor
+        to continue from and what's left of the offset and limit.
+
         :rtype: tuple, (entities, more_results, cursor)
         """
-        pb = self._query.to_protobuf()
-
-        start_cursor = self._start_cursor
-        if start_cursor is not None:
-            pb.start_cursor = base64.b64decode(start_cursor)
-
-        end_cursor = self._end_cursor
-        if end_cursor is not None:
-            pb.end_cursor = base64.b64decode(end_cursor)
-
-        if self._limit is not None:
-            pb.limit = self._limit
-
-        pb.offset = self._offset
+        pb = self._query.cached_protobuf()
+        start_cursor = base64.b64decode(self._start_cursor) if self._start_cursor is not None else None
+        end_cursor = base64.b64decode(self._end_cursor) if self._end_cursor is not None else None
 
         transaction = Transaction.current()
 
+        query_profiler = profiler.get_profiler()
+        if query_profiler is not None:
+            if self._execution is None:
+                self._execution = query_profiler.start(pb)
+            started = profiler._clock()
+
         query_results = self._connection.run_query(
             query_pb=pb,
             namespace=self._connection.namespace,
-            transaction_id=transaction and transaction.id,
+            transaction_id=getattr(transaction, 'id', None),
+            entity_results=True,
+            start_cursor=start_cursor,
+            end_cursor=end_cursor,
+            limit=self._limit,
+            offset=self._offset,
         )
-        # NOTE: `query_results` contains an extra value that we don't use, namely `skipped_results`.
-        #
         # NOTE: The value of `more_results` is not currently useful because the back-end always returns an enum value of
         #       MORE_RESULTS_AFTER_LIMIT even if there are no more results. See
         #       https://github.com/GoogleCloudPlatform/gcloud-python/issues/280 for discussion.
-        entity_pbs, cursor_as_bytes, more_results_enum = query_results[:3]
+        entity_result_pbs, cursor_as_bytes, more_results_enum, skipped_results = query_results
 
+        # The next page carries on from the cursor, so it only needs what's left of the offset and limit.
         self._start_cursor = base64.b64encode(cursor_as_bytes)
-        self._end_cursor = None
+        self._offset = max(self._offset - skipped_results, 0)
+        if self._limit is not None:
+            self._limit = max(self._limit - len(entity_result_pbs), 0)
 
         if more_results_enum == self._NOT_FINISHED:
-            self._more_results = True
+            self._more_results = self._limit != 0
         elif more_results_enum in self._FINISHED:
             self._more_results = False
         else:
             raise RuntimeError('Unexpected value returned for `more_results`.')
 
-        self._page = [self._query.entity.from_protobuf(pb) for pb in entity_pbs]
+        if query_profiler is None:
+            self._page = [self._from_entity_result(result) for result in entity_result_pbs]
+        else:
+            decode_started = profiler._clock()
+            self._page = [self._from_entity_result(result) for result in entity_result_pbs]
+            execution = self._execution
+            execution.network_time += decode_started - started
+            execution.decode_time += profiler._clock() - decode_started
+            execution.pages += 1
+            execution.entities += len(self._page)
+            execution.bytes += sum(result.ByteSize() for result in entity_result_pbs)
+            if not self._more_results:
+                self._finish_execution()
         return self._page, self._more_results, self._start_cursor
 
+    def _finish_execution(self):
+        """Hand the record of this execution to the profiler."""
+        execution, self._execution = self._execution, None
+        query_profiler = profiler.get_profiler()
+        if execution is not None and query_profiler is not None:
+            query_profiler.finish(execution)
+
+    def _from_entity_result(self, result):
+        """Build an entity from an ``EntityResult`` protobuf, remembering the version it was read at."""
+        if self._row_factory is not None:
+            return self._row_factory(result.entity)
+        entity = self._query.entity.from_protobuf(result.entity)
+        entity._version = result.version or None
+        return entity
+
     def __iter__(self):
         """
         Generator yielding all results matching our query.
 
         :rtype: sequence of :class:`gcloud.datastore.entity.Entity`
         """
-        self.next_page()
-        while True:
-            for entity in self._page:
-                yield entity
-            if not self._more_results:
-                break
+        try:
             self.next_page()
+            while True:
+                for entity in self._page:
+                    yield entity
+                if not self._more_results:
+                    break
+                self.next_page()
+        finally:
+            if self._execution is not None:  # Stopped early, or failed
+                self._finish_execution()
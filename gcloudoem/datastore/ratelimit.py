@@ -0,0 +1,211 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Client side limits on the rate of writes to Datastore.
+
+Datastore copes with almost any write rate, but only once it has had time to split the key ranges of a kind across
+enough servers. Google's guidance (the "500/50/5" rule) is to start a new kind at no more than 500 writes per second and
+increase that by at most 50% every 5 minutes. Separately, an entity group only sustains about one write per second.
+Writing faster than either mostly produces contention and ``503`` errors that just get retried.
+
+A :class:`WriteRateLimiter` enforces both limits on the client. Give one to a connection and every commit waits until it
+is within them, which also slows down whatever is producing the writes (eg. ``bulk_create`` or a
+:class:`~gcloudoem.datastore.transaction.BufferedWriter`)::
+
+    >>> connection = get_connection()
+    >>> connection.rate_limiter = WriteRateLimiter()
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+import threading
+import time
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter.
+
+    Tokens are added at ``rate`` per second up to ``capacity``. Taking more tokens than are available puts the bucket
+    into debt, and the caller should wait until the debt would be paid off. That way callers are served in the order
+    they asked, no matter how many tokens they take.
+
+    Instances are thread safe.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param float rate: Tokens added per second.
+        :param float capacity: The most tokens the bucket holds (ie. the largest burst). Defaults to ``rate``.
+        """
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated = _clock()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+
+    def _refill(self):
+        now = _clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self, tokens=1):
+        """
+        Take ``tokens`` from the bucket without waiting.
+
+        :rtype: float
+        :returns: How long (seconds) the caller should wait before going ahead.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self._rate)
+
+    def try_acquire(self, tokens=1):
+        """
+        Take ``tokens`` from the bucket if they are available now.
+
+        :rtype: bool
+        :returns: Whether the tokens were taken.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """
+        Take ``tokens`` from the bucket, waiting until they are available.
+
+        :rtype: float
+        :returns: How long (seconds) we waited.
+        """
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class WriteRateLimiter(object):
+    """
+    Limits commits to the 500/50/5 ramp up for each kind, and to about one write per second per entity group.
+
+    The ramp up for a kind starts on its first write, and starts again if the kind isn't written to for a whole
+    ``ramp_interval``. Every mutation counts as a write to its kind. Each commit counts as a single write to each entity
+    group it touches.
+
+    Instances are thread safe.
+    """
+    def __init__(self, initial_rate=500, ramp_factor=1.5, ramp_interval=300, max_rate=None, entity_group_rate=1.0,
+                 entity_group_burst=5, max_entity_groups=10000):
+        """
+        :param float initial_rate: Writes per second allowed for a kind to begin with.
+        :param float ramp_factor: What the rate for a kind is multiplied by every ``ramp_interval``.
+        :param float ramp_interval: Seconds between each increase of the rate for a kind.
+        :param float max_rate: The most writes per second allowed for a kind. Defaults to no limit.
+        :param float entity_group_rate: Writes per second allowed to each entity group.
+        :param float entity_group_burst: How many writes to an entity group are allowed in a burst.
+        :param int max_entity_groups: How many entity groups to track. The least recently written are forgotten first.
+        """
+        self._initial_rate = initial_rate
+        self._ramp_factor = ramp_factor
+        self._ramp_interval = ramp_interval
+        self._max_rate = max_rate
+        self._entity_group_rate = entity_group_rate
+        self._entity_group_burst = entity_group_burst
+        self._max_entity_groups = max_entity_groups
+
+        self._kinds = {}  # kind -> [bucket, ramp start, last write]
+        self._entity_groups = OrderedDict()  # root key -> bucket, least recently written first
+        self._lock = threading.Lock()
+        self._throttled = 0
+        self._waited = 0.0
+
+    def kind_rate(self, kind):
+        """
+        The writes per second currently allowed for ``kind``.
+
+        :rtype: float
+        """
+        with self._lock:
+            state = self._kinds.get(kind)
+            return self._initial_rate if state is None else state[0].rate
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: How many commits were ``throttled``, and how long (seconds) they ``waited`` in total.
+        """
+        with self._lock:
+            return {'throttled': self._throttled, 'waited': self._waited}
+
+    def acquire(self, request):
+        """
+        Wait until ``request`` can be committed without going over the limits.
+
+        :param request: The :class:`~gcloudoem.datastore._generated.datastore_pb2.CommitRequest` about to be sent.
+        :rtype: float
+        :returns: How long (seconds) we waited.
+        """
+        kinds = {}
+        groups = set()
+        for mutation in request.mutations:
+            operation = mutation.WhichOneof('operation')
+            if operation is None:
+                continue
+            key = mutation.delete if operation == 'delete' else getattr(mutation, operation).key
+            kind = key.path[-1].kind
+            kinds[kind] = kinds.get(kind, 0) + 1
+            root = key.path[0]
+            if len(key.path) > 1 or root.id or root.name:  # A new root entity is in an entity group of its own
+                groups.add((key.partition_id.namespace_id, root.kind, root.id, root.name))
+
+        with self._lock:
+            buckets = [(self._kind_bucket(kind), count) for kind, count in kinds.items()]
+            buckets.extend((self._entity_group_bucket(group), 1) for group in groups)
+
+        wait = max([bucket.reserve(tokens) for bucket, tokens in buckets] or [0.0])
+        if wait:
+            with self._lock:
+                self._throttled += 1
+                self._waited += wait
+            time.sleep(wait)
+        return wait
+
+    def _kind_bucket(self, kind):
+        """Get the bucket for ``kind``, with its rate brought up to date. Call with the lock held."""
+        now = _clock()
+        state = self._kinds.get(kind)
+        if state is None or now - state[2] > self._ramp_interval:
+            state = self._kinds[kind] = [TokenBucket(self._initial_rate), now, now]
+        state[2] = now
+        rate = self._initial_rate * self._ramp_factor ** int((now - state[1]) // self._ramp_interval)
+        if self._max_rate is not None:
+            rate = min(rate, self._max_rate)
+        if rate != state[0].rate:
+            state[0].rate = rate
+        return state[0]
+
+    def _entity_group_bucket(self, group):
+        """Get the bucket for an entity group. Call with the lock held."""
+        bucket = self._entity_groups.pop(group, None)
+        if bucket is None:
+            bucket = TokenBucket(self._entity_group_rate, self._entity_group_burst)
+            while len(self._entity_groups) >= self._max_entity_groups:
+                self._entity_groups.popitem(last=False)
+        self._entity_groups[group] = bucket
+        return bucket
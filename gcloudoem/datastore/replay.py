@@ -0,0 +1,189 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Recording and replaying the traffic between a connection and Datastore.
+
+:class:`RecordingHttp` wraps the HTTP object of a :class:`~gcloudoem.datastore.connection.Connection` and saves every
+request and response (the protobuf bytes, the status and how long it took) to a file. :class:`ReplayHttp` reads that
+file and serves the responses back without a network, either as fast as possible or with the recorded latency. Replaying
+real traffic makes client side benchmarks (encoding, decoding and queryset logic) reproducible and runnable offline.
+:func:`~gcloudoem.datastore.connection.register_connection` passes the HTTP object on to the connection::
+
+    >>> http = RecordingHttp('traffic.rec', credentials.authorize(httplib2.Http()))
+    >>> register_connection('project', 'default', None, http=http)
+    >>> handle_requests()
+    >>> http.close()
+
+    >>> register_connection('project', 'default', None, http=ReplayHttp('traffic.rec'))
+    >>> timeit.timeit(handle_requests, number=1)
+
+Responses are served in the order they were recorded, separately for each API method, so the replayed code must make
+the same RPCs as the recorded code did. :meth:`ReplayHttp.rewind` starts over, to replay the same traffic many times.
+
+The file is gzipped, and each exchange in it is a small binary header followed by the request and response bytes.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import gzip
+import struct
+import threading
+import time
+
+import httplib2
+
+from .retry import _clock
+from ..exceptions import ReplayError
+
+
+_MAGIC = b'GCOEREC1'
+_HEADER = struct.Struct('>HdHII')  # status, elapsed, then the lengths of the method, request and response
+
+Exchange = collections.namedtuple('Exchange', ['method', 'request', 'status', 'response', 'elapsed'])
+"""
+A recorded request (``method`` and ``request`` bytes) with its ``status``, ``response`` bytes and ``elapsed`` time.
+"""
+
+
+def _method(uri):
+    """The API method (eg. ``runQuery``) of a request URI."""
+    return uri.rsplit(':', 1)[-1]
+
+
+def load_recording(path):
+    """
+    Read the exchanges saved by a :class:`RecordingHttp`.
+
+    :param str path: The file to read.
+    :rtype: list of :class:`Exchange`
+    """
+    exchanges = []
+    with gzip.open(path, 'rb') as stream:
+        try:
+            magic = stream.read(len(_MAGIC))
+        except (IOError, OSError, EOFError):  # Not gzipped
+            magic = None
+        if magic != _MAGIC:
+            raise ReplayError("%s isn't a recording" % path)
+        while True:
+            header = stream.read(_HEADER.size)
+            if not header:
+                break
+            if len(header) != _HEADER.size:
+                raise ReplayError('%s is truncated' % path)
+            status, elapsed, method_len, request_len, response_len = _HEADER.unpack(header)
+            method = stream.read(method_len).decode('ascii')
+            request = stream.read(request_len)
+            response = stream.read(response_len)
+            if len(response) != response_len:
+                raise ReplayError('%s is truncated' % path)
+            exchanges.append(Exchange(method, request, status, response, elapsed))
+    return exchanges
+
+
+class RecordingHttp(object):
+    """
+    An HTTP object that records the requests made through it, and their responses, to a file.
+
+    Use it as the ``http`` of a :class:`~gcloudoem.datastore.connection.Connection`. The recording is complete once
+    :meth:`close` is called (or the ``with`` block it's used in ends). Instances are thread safe if ``http`` is.
+    """
+    def __init__(self, path, http=None):
+        """
+        :param str path: The file to record to. It's overwritten.
+        :param http: The HTTP object that makes the requests. Since a connection doesn't authorize an ``http`` it's
+            given, this should be authorized already (eg. ``credentials.authorize(httplib2.Http())``). Defaults to an
+            unauthorized :class:`httplib2.Http`, which is enough for the emulator.
+        """
+        self.http = http if http is not None else httplib2.Http()
+        self.count = 0
+        self._stream = gzip.open(path, 'wb')
+        self._stream.write(_MAGIC)
+        self._lock = threading.Lock()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        started = _clock()
+        response, content = self.http.request(uri, method=method, body=body, headers=headers, **kwargs)
+        elapsed = _clock() - started
+        api_method = _method(uri).encode('ascii')
+        body = body or b''
+        with self._lock:
+            if self._stream is None:
+                raise ReplayError('The recording is closed')
+            self._stream.write(_HEADER.pack(int(response.status), elapsed, len(api_method), len(body), len(content)))
+            self._stream.write(api_method + body + content)
+            self.count += 1
+        return response, content
+
+    def close(self):
+        """Finish the recording."""
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ReplayHttp(object):
+    """
+    An HTTP object that answers requests with the responses saved by a :class:`RecordingHttp`.
+
+    Requests for each API method are answered with the responses recorded for that method, in order. Instances are
+    thread safe.
+    """
+    def __init__(self, path_or_exchanges, realtime=False, check_requests=False):
+        """
+        :param path_or_exchanges: The file to replay, or a list of :class:`Exchange`.
+        :param bool realtime: Wait as long as the recorded request took before responding. Otherwise respond
+            straight away.
+        :param bool check_requests: Raise :class:`~gcloudoem.exceptions.ReplayError` if a request isn't byte for byte
+            the same as the recorded one. Off by default since requests can legitimately differ between runs (eg.
+            transaction IDs and timestamps).
+        """
+        if isinstance(path_or_exchanges, (list, tuple)):
+            self.exchanges = list(path_or_exchanges)
+        else:
+            self.exchanges = load_recording(path_or_exchanges)
+        self.realtime = realtime
+        self.check_requests = check_requests
+        self._lock = threading.Lock()
+        self.rewind()
+
+    def rewind(self):
+        """Start replaying from the beginning again."""
+        by_method = collections.defaultdict(collections.deque)
+        for exchange in self.exchanges:
+            by_method[exchange.method].append(exchange)
+        with self._lock:
+            self._remaining = by_method
+
+    def remaining(self):
+        """
+        :rtype: int
+        :returns: The number of responses that haven't been replayed yet.
+        """
+        with self._lock:
+            return sum(len(exchanges) for exchanges in self._remaining.values())
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        api_method = _method(uri)
+        with self._lock:
+            exchanges = self._remaining.get(api_method)
+            if not exchanges:
+                raise ReplayError('No more %s responses were recorded' % api_method)
+            exchange = exchanges.popleft()
+        if self.check_requests and (body or b'') != exchange.request:
+            raise ReplayError('The %s request differs from the recorded one' % api_method)
+        if self.realtime:
+            time.sleep(exchange.elapsed)
+        response = httplib2.Response({
+            'status': exchange.status,
+            'content-type': 'application/x-protobuf' if exchange.status == 200 else 'text/plain',
+            'content-length': str(len(exchange.response)),
+        })
+        return response, exchange.response
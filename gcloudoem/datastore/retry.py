@@ -0,0 +1,207 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+How a :class:`~gcloudoem.datastore.connection.Connection` retries failed requests.
+
+Every connection has a :class:`RetryPolicy`. It retries requests that failed for reasons that are likely to be
+temporary (``429``, ``5xx`` and network errors) with exponential backoff and full jitter, as long as retrying is safe
+and the method's deadline hasn't passed. Retrying is safe when the request is idempotent (eg. lookups and queries), or
+when the error means the request was never processed (``429 Too Many Requests``). A transactional commit that fails
+with a ``503`` might still have been applied, so it is never retried.
+
+A connection can also have a :class:`CircuitBreaker`. After enough consecutive failures it fails every request
+straight away with :class:`~gcloudoem.exceptions.CircuitOpen` for a while, rather than letting every caller wait
+through its own retries while the backend is down::
+
+    >>> connection = get_connection()
+    >>> connection.retry_policy = RetryPolicy(max_attempts=3, deadlines={'commit': 10})
+    >>> connection.circuit_breaker = CircuitBreaker(failure_threshold=10, reset_timeout=30)
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+import socket
+import threading
+import time
+
+import httplib2
+
+from ..exceptions import CircuitOpen, GCloudError, ServerError
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def backoff_delay(attempt, initial_delay, max_delay, multiplier=2):
+    """
+    How long to wait before retrying, using exponential backoff with full jitter.
+
+    The delay is random, between zero and ``initial_delay * multiplier ** attempt`` (capped at ``max_delay``), so that
+    clients that failed at the same time don't all retry at the same time too.
+
+    :param int attempt: The number of retries so far.
+    :param float initial_delay: The cap (seconds) for the first retry.
+    :param float max_delay: The largest cap (seconds).
+    :param float multiplier: How much the cap grows by each retry.
+
+    :rtype: float
+    """
+    return random.uniform(0, min(max_delay, initial_delay * multiplier ** attempt))
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests a connection retries, and how long it waits in between.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    """HTTP statuses that mean a request might succeed if it's tried again."""
+
+    IDEMPOTENT_METHODS = ('lookup', 'runQuery', 'beginTransaction', 'rollback', 'allocateIds')
+    """Methods that are always safe to send again. Some commits are too, see :meth:`is_idempotent`."""
+
+    def __init__(self, max_attempts=5, initial_delay=0.1, max_delay=10.0, multiplier=2, deadline=60.0, deadlines=None,
+                 attempt_timeout=30.0):
+        """
+        :param int max_attempts: The most times to send a request (including the first).
+        :param float initial_delay: The cap (seconds) for the delay before the first retry.
+        :param float max_delay: The largest cap (seconds) for the delay before a retry.
+        :param float multiplier: How much the cap grows by each retry.
+        :param float deadline: How long (seconds) a request can take, including retries. None for no deadline.
+        :param dict deadlines: Deadlines for particular methods (eg. ``{'commit': 10}``), overriding ``deadline``.
+        :param float attempt_timeout: The socket timeout (seconds) for each attempt, so that a hung connection can't
+            block forever. None for no timeout.
+        """
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.deadlines = dict(deadlines or {})
+        self.attempt_timeout = attempt_timeout
+
+    def deadline_for(self, method):
+        """
+        :param str method: The API method (eg. ``runQuery``).
+        :rtype: float or None
+        :returns: The deadline (seconds) for requests to ``method``.
+        """
+        return self.deadlines.get(method, self.deadline)
+
+    def is_idempotent(self, method, request_pb):
+        """
+        Is it safe to send ``request_pb`` again if we don't know whether it was processed?
+
+        Non-transactional commits are, as long as every mutation is an unconditional upsert, update or delete. Inserts
+        fail if they were already applied, conditional writes would report a conflict, and a transaction can only be
+        committed once.
+
+        :param str method: The API method.
+        :param request_pb: The request protobuf.
+        :rtype: bool
+        """
+        if method in self.IDEMPOTENT_METHODS:
+            return True
+        if method == 'commit' and not request_pb.transaction:
+            return all(
+                mutation.WhichOneof('operation') != 'insert' and not mutation.HasField('base_version')
+                for mutation in request_pb.mutations
+            )
+        return False
+
+    def is_failure(self, error):
+        """
+        Does ``error`` mean something is wrong with the backend (rather than with the request)?
+
+        :rtype: bool
+        """
+        if isinstance(error, GCloudError):
+            return isinstance(error, ServerError) or error.code == 429
+        return isinstance(error, (socket.error, httplib2.HttpLib2Error))
+
+    def should_retry(self, error, attempt, idempotent):
+        """
+        Should a request that failed with ``error`` be sent again?
+
+        :param error: The exception the request failed with.
+        :param int attempt: The number of times the request has been sent.
+        :param bool idempotent: Is the request safe to send again? See :meth:`is_idempotent`.
+        :rtype: bool
+        """
+        if attempt >= self.max_attempts:
+            return False
+        if isinstance(error, GCloudError):
+            if error.code not in self.RETRY_STATUSES:
+                return False
+            return idempotent or error.code == 429  # A 429 was rejected before it was processed
+        return idempotent and isinstance(error, (socket.error, httplib2.HttpLib2Error))
+
+    def backoff(self, attempt):
+        """
+        :param int attempt: The number of times the request has been sent.
+        :rtype: float
+        :returns: How long (seconds) to wait before sending it again.
+        """
+        return backoff_delay(attempt - 1, self.initial_delay, self.max_delay, self.multiplier)
+
+
+class CircuitBreaker(object):
+    """
+    Fails requests fast while the backend looks to be down.
+
+    The breaker starts *closed*, letting requests through. After ``failure_threshold`` consecutive failures it *opens*
+    and every request fails straight away with :class:`~gcloudoem.exceptions.CircuitOpen`. Once ``reset_timeout``
+    seconds have passed, a single trial request is let through (*half open*). If it succeeds the breaker closes again,
+    otherwise it opens for another ``reset_timeout``.
+
+    Instances are thread safe.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param int failure_threshold: How many consecutive failures open the breaker.
+        :param float reset_timeout: How long (seconds) the breaker stays open before trying a request again.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """One of :attr:`CLOSED`, :attr:`OPEN` or :attr:`HALF_OPEN`."""
+        return self._state
+
+    def before_request(self):
+        """
+        Call before sending a request.
+
+        :raises: :class:`~gcloudoem.exceptions.CircuitOpen` if the request shouldn't be sent.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and _clock() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN  # Let this request through as a trial
+                return
+            raise CircuitOpen('Not sending request: %d consecutive requests failed' % self._failures)
+
+    def record_success(self):
+        """Call when a request gets a response from the backend (even an error one, like a ``404``)."""
+        with self._lock:
+            self._failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        """Call when a request fails because of the backend (see :meth:`RetryPolicy.is_failure`)."""
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = _clock()
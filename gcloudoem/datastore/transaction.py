@@ -20,12 +20,26 @@
 """Create / interact with a datastore transaction."""
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import copy
+from functools import wraps
+import threading
+import time
+
 from . import utils
+from .allocator import get_id_allocator
 from ._generated import datastore_pb2 as datastore_pb
 from .connection import get_connection
+from .retry import backoff_delay
+from ..exceptions import Conflict, VersionConflict
 from ..properties import KeyProperty, ListProperty, ReferenceProperty
 
-_TRANSACTIONS = utils._LocalStack()
+_TRANSACTIONS = utils._resource_stack('gcloudoem_transactions')
+
+DEFAULT_RETRIES = 3
+"""The number of times :func:`run_in_transaction` retries a function after a conflict."""
+
+_retry_stats = {'transactions': 0, 'retries': 0, 'exhausted': 0}
+_retry_stats_lock = threading.Lock()
 
 
 class Transaction(object):
@@ -78,6 +92,16 @@ class Transaction(object):
       ... else:
       ...     transaction.commit()
 
+    Writes are buffered by key until the commit: saving or deleting the same entity more than once only sends the last
+    write, and ``MyEntity.objects.get(pk=...)`` inside the transaction returns what was last saved (or raises
+    ``DoesNotExist`` if it was deleted)::
+
+      >>> with Transaction() as transaction:
+      ...     transaction.put(MyEntity(key=123, name='draft'))
+      ...     entity = MyEntity.objects.get(pk=123)  # no RPC
+      ...     entity.name = 'final'
+      ...     transaction.put(entity)  # replaces the first put
+
     Transactions have 3 isolation levels. They are (in order of strictness):
 
     #. NONE - No isolation. Everything is just wrapped in a single mutation and sent to datastore.
@@ -103,22 +127,30 @@ class Transaction(object):
     _ABORTED = 2
     _FINISHED = 3
 
-    def __init__(self, isolation):
+    def __init__(self, isolation, connection=None):
         """
         Construct a transaction.
 
         :type isolation: :class:`bool` or None. Use the class attributes as shortcuts.
         :param dataset_id: Transaction isolation level. None = NONE, False = SNAPSHOT and True = SERIALIZABLE.
+        :param connection: The connection to commit with. Keys are written to its dataset and namespace. Defaults to
+            the current connection.
 
         :raises: :class:`~gcloudoem.exceptions.ConnectionError` if there is no active connection.
         """
-        self._connection = get_connection()
-        self._mutation = datastore_pb.CommitRequest()
-        self._auto_id_entities = []
+        self._connection = connection or get_connection()
+        self._reset_mutation()
         self._id = None
         self._status = self._INITIAL
         self._isolation = isolation
 
+    def _reset_mutation(self):
+        """Start a new, empty mutation."""
+        self._mutation = datastore_pb.CommitRequest()
+        self._auto_id_entities = []
+        self._mutation_entities = []  # The entity for each mutation, in order. Used to record versions on commit.
+        self._write_buffer = {}  # Complete key -> index of its mutation. Used to coalesce writes and read them back.
+
     @staticmethod
     def current():
         """Return the topmost batch / transaction, or None."""
@@ -155,28 +187,47 @@ class Transaction(object):
 
         self._auto_id_entities.append(entity)
 
-    def _assign_entity_to_mutation(self, entity, force_insert=False):
+    def _assign_entity_to_mutation(self, entity, force_insert=False, if_unchanged=False):
         """
         Copy ``entity`` into appropriate slot of the mutation for this transaction.
 
-        If ``entity.key`` is incomplete, append ``entity`` to self.auto_id_entities for later fixup during ``commit``.
+        If ``entity.key`` is an incomplete root key and the entity has the ``id_block_size`` Meta option set, the key is
+        completed straight away from the kind's :class:`~gcloudoem.datastore.allocator.IdAllocator`. Otherwise, append
+        ``entity`` to self.auto_id_entities for later fixup during ``commit``.
 
         :type entity: :class:`~gcloudoem.entity.Entity`
         :param entity; the entity being updated within the batch / transaction.
 
         :type force_insert: bool
         :param force_insert: Assign this entity to the insert mutation instead of upsert. Defaults to False.
+
+        :type if_unchanged: bool
+        :param if_unchanged: Only apply the mutation if the entity hasn't changed in Datastore since it was read (it
+            sets the mutation's ``base_version`` to the entity's version). Defaults to False.
         """
+        if if_unchanged and entity._version is None:
+            raise ValueError("Can't save an entity if unchanged unless it was read from Datastore")
+
         # Prepare the key
         key = getattr(entity, 'key')
-        key_pb = entity._properties['key'].to_protobuf(key)
+        if key.is_partial and entity._meta.id_block_size and len(key.path) == 1:
+            get_id_allocator(entity.__class__, connection=self._connection).assign(entity)
+        key_pb = self._key_to_protobuf(key)
 
         # What type of mutation is this?
+        mutation, previous = self._buffered_mutation(key, entity)
+        if if_unchanged:
+            mutation.base_version = entity._version
+        elif previous is not None and previous.HasField('base_version'):
+            mutation.base_version = previous.base_version
+        if previous is not None and previous.WhichOneof('operation') == 'insert':
+            force_insert = True  # The entity still mustn't exist before this transaction
         if key.is_partial or force_insert:
-            insert = self._mutation.mutations.add().insert
-            self._auto_id_entities.append(entity)
+            insert = mutation.insert
+            if key.is_partial:
+                self._auto_id_entities.append(entity)
         else:
-            insert = self._mutation.mutations.add().upsert
+            insert = mutation.upsert
 
         # Add the key
         insert.key.CopyFrom(key_pb)
@@ -210,7 +261,7 @@ class Transaction(object):
                 for sub_value in prop.array_value.values:
                     sub_value.exclude_from_indexes = True
 
-    def put(self, entity):
+    def put(self, entity, if_unchanged=False):
         """
         Store entity as part of this transaction.
 
@@ -228,11 +279,15 @@ class Transaction(object):
 
         :type entity: :class:`~gcloud.entity.Entity`
         :param entity: the entity to be saved.
+
+        :type if_unchanged: bool
+        :param if_unchanged: Only save the entity if its version in Datastore is still the one it was read at. If it
+            isn't, :meth:`commit` raises :class:`~gcloudoem.exceptions.VersionConflict`. Defaults to False.
         """
         if entity.key is None:
             raise ValueError("Entity must have a key")
 
-        self._assign_entity_to_mutation(entity)
+        self._assign_entity_to_mutation(entity, if_unchanged=if_unchanged)
 
     def create(self, entity):
         """
@@ -267,8 +322,71 @@ class Transaction(object):
         if entity.key.is_partial:
             raise ValueError("Entity myst have a complete key")
 
-        key_pb = entity._properties['key'].to_protobuf(entity.key)
-        self._mutation.mutations.add().delete.CopyFrom(key_pb)
+        key_pb = self._key_to_protobuf(entity.key)
+        mutation, _ = self._buffered_mutation(entity.key, None)
+        mutation.delete.CopyFrom(key_pb)
+
+    def _key_to_protobuf(self, key):
+        """The protobuf for ``key`` in the partition of our connection. See :meth:`gcloudoem.key.Key.to_protobuf`."""
+        return key.to_protobuf(self._connection.dataset, self._connection.namespace)
+
+    def _buffered_mutation(self, key, entity):
+        """
+        Get an empty mutation for a write of ``key``, reusing the one from an earlier write of the same key in this
+        transaction if there is one. Datastore only applies one mutation per key in a commit anyway, so a later write
+        simply replaces an earlier one.
+
+        :param key: The :class:`~gcloudoem.key.Key` being written.
+        :param entity: The entity being saved, or None for a delete.
+
+        :rtype: tuple
+        :returns: The mutation to fill in, and a copy of the mutation it replaced (or None).
+        """
+        index = None if key.is_partial else self._write_buffer.get(key)
+        if index is None:
+            mutation = self._mutation.mutations.add()
+            self._mutation_entities.append(entity)
+            if not key.is_partial:
+                self._write_buffer[key] = len(self._mutation.mutations) - 1
+            return mutation, None
+
+        mutation = self._mutation.mutations[index]
+        previous = datastore_pb.Mutation()
+        previous.CopyFrom(mutation)
+        mutation.Clear()
+        self._mutation_entities[index] = entity
+        return mutation, previous
+
+    def is_buffered(self, key):
+        """
+        Has ``key`` been saved or deleted in this transaction?
+
+        :param key: The :class:`~gcloudoem.key.Key` to check.
+        :rtype: bool
+        """
+        return key in self._write_buffer
+
+    def get_buffered(self, key):
+        """
+        Read back a write made earlier in this transaction.
+
+        The entity is rebuilt from the buffered mutation, so it has the values that will be committed, even if the
+        saved entity has been changed since.
+
+        :param key: The :class:`~gcloudoem.key.Key` of the entity.
+
+        :rtype: :class:`~gcloudoem.entity.Entity` or None
+        :returns: A new instance of the entity last saved with ``key`` in this transaction, or None if it was deleted.
+        :raises: :class:`KeyError` if ``key`` hasn't been written in this transaction.
+        """
+        index = self._write_buffer[key]
+        saved = self._mutation_entities[index]
+        if saved is None:
+            return None
+        mutation = self._mutation.mutations[index]
+        entity = saved.__class__.from_protobuf(getattr(mutation, mutation.WhichOneof('operation')))
+        entity._version = saved._version
+        return entity
 
     def begin(self):
         """
@@ -292,6 +410,11 @@ class Transaction(object):
 
         This is called automatically upon exiting a with statement, however it can be called explicitly if you don't
         want to use a context manager.
+
+        Saved entities have their :attr:`~gcloudoem.entity.Entity.version` updated to the one they were written at.
+
+        :raises: :class:`~gcloudoem.exceptions.VersionConflict` if any entity put with ``if_unchanged=True`` had changed
+            in Datastore. The other mutations in the commit are still applied.
         """
         try:
             response = self._connection.commit(self._mutation, self._id)
@@ -302,12 +425,45 @@ class Transaction(object):
             # match (length and order) the request's 'insert_auto_id` entities, which are derived from our
             # '_auto_id_entities' (no partial success).
             for new_key_pb, entity in zip(completed_keys, self._auto_id_entities):
-                entity._data['key']._id = new_key_pb.path[-1].id
+                entity._data['key']._complete(new_key_pb.path[-1].id)
+
+            # There is one mutation result per mutation, in order.
+            conflicts = []
+            for mut_result, entity in zip(mut_results, self._mutation_entities):
+                if entity is None:
+                    continue
+                if mut_result.conflict_detected:
+                    conflicts.append(entity)
+                else:
+                    entity._version = mut_result.version or None
+            if conflicts:
+                raise VersionConflict(
+                    "%d entities changed since they were read: %s" % (len(conflicts), [e.key for e in conflicts]),
+                    entities=conflicts,
+                )
         finally:
             self._status = self._FINISHED
             # Clear our own ID in case this gets accidentally reused.
             self._id = None
 
+    def commit_async(self, executor=None):
+        """
+        Commit the batch in the background.
+
+        Works like :meth:`commit`, including completing the keys of entities that had partial keys, but the commit
+        runs on ``executor`` so the caller doesn't wait for it. The transaction can't be used while the commit is in
+        progress, and this can't be called inside the transaction's ``with`` block (leaving the block commits it).
+
+        :param executor: The executor to commit on. Defaults to :func:`~gcloudoem.datastore.utils.get_executor`.
+
+        :rtype: :class:`concurrent.futures.Future`
+        :returns: A future with a result of None once the commit is done. If the commit failed, its ``result()``
+            raises the error.
+        """
+        if _TRANSACTIONS.top is self:
+            raise ValueError("Can't commit a transaction asynchronously inside its with block")
+        return (executor or utils.get_executor()).submit(utils.in_current_context(self.commit))
+
     def rollback(self):
         """
         Rollback the transaction.
@@ -340,3 +496,245 @@ class Transaction(object):
                 self.rollback()
         finally:
             _TRANSACTIONS.pop()
+
+
+class BufferedWriter(Transaction):
+    """
+    A :attr:`~Transaction.NONE` transaction that commits its mutations in batches as they are added.
+
+    A plain ``Transaction(Transaction.NONE)`` holds every mutation in memory until it is committed at the end. A
+    buffered writer instead commits (flushes) the mutations it holds whenever there are ``max_mutations`` of them or
+    they reach ``max_bytes``, and optionally every ``flush_interval`` seconds from a background thread. Memory use is
+    therefore bounded no matter how many entities are written, which suits streaming a large number of writes::
+
+        >>> with BufferedWriter(flush_interval=1) as writer:
+        ...     for row in rows:
+        ...         MyEntity(**row).save()  # joins the writer
+
+    Each flush is a separate non-transactional commit. Call :meth:`flush` to block until everything written so far is
+    durable. Leaving the ``with`` block normally flushes anything left; leaving it because of an error discards
+    anything that hasn't been flushed yet.
+
+    An error committing a batch is raised by the call that triggered the flush. If a background flush fails, the error
+    is raised by the next write (or :meth:`flush`) instead. The mutations in a failed batch are not retried.
+
+    Instances are thread safe.
+    """
+
+    MAX_MUTATIONS = 500
+    """The maximum number of mutations Datastore accepts in one commit."""
+
+    MAX_BYTES = 9 * 1024 * 1024
+    """The default batch size limit. This leaves room under Datastore's 10MiB request size limit."""
+
+    def __init__(self, max_mutations=MAX_MUTATIONS, max_bytes=MAX_BYTES, flush_interval=None):
+        """
+        :param int max_mutations: Flush when this many mutations are buffered. Capped at :attr:`MAX_MUTATIONS`.
+        :param int max_bytes: Flush when the buffered mutations reach (approximately) this many bytes.
+        :param float flush_interval: If given, also flush every ``flush_interval`` seconds from a background thread.
+
+        :raises: :class:`~gcloudoem.exceptions.ConnectionError` if there is no active connection.
+        """
+        super(BufferedWriter, self).__init__(Transaction.NONE)
+        self._max_mutations = min(max_mutations, self.MAX_MUTATIONS)
+        self._max_bytes = max_bytes
+        self._flush_interval = flush_interval
+        self._bytes = 0
+        self._lock = threading.RLock()  # Guards the buffered mutation
+        self._commit_lock = threading.Lock()  # Makes batches commit one at a time, in order
+        self._flush_error = None
+        self._timer = None
+        self._stopped = threading.Event()
+
+    def _assign_entity_to_mutation(self, entity, force_insert=False, if_unchanged=False):
+        with self._lock:
+            self._raise_flush_error()
+            replaced = self._buffered_bytes(entity.key)
+            super(BufferedWriter, self)._assign_entity_to_mutation(entity, force_insert, if_unchanged)
+            mutation = self._mutation.mutations[self._write_buffer.get(entity.key, -1)]
+            self._buffered(mutation, replaced)
+
+    def delete(self, entity):
+        with self._lock:
+            self._raise_flush_error()
+            replaced = self._buffered_bytes(entity.key)
+            super(BufferedWriter, self).delete(entity)
+            self._buffered(self._mutation.mutations[self._write_buffer[entity.key]], replaced)
+
+    def _buffered_bytes(self, key):
+        """The size of the mutation already buffered for ``key``, which a write of it will replace, or 0."""
+        index = None if key.is_partial else self._write_buffer.get(key)
+        return 0 if index is None else self._mutation.mutations[index].ByteSize()
+
+    def _buffered(self, mutation, replaced=0):
+        """
+        Account for a newly buffered ``mutation``, flushing if a limit has been reached.
+
+        :param int replaced: The size of the earlier mutation for the same key that ``mutation`` replaced.
+        """
+        self._bytes += mutation.ByteSize() - replaced
+        if len(self._mutation.mutations) >= self._max_mutations or self._bytes >= self._max_bytes:
+            self.flush()
+        elif self._flush_interval and self._timer is None:
+            self._timer = threading.Thread(
+                target=utils.in_current_context(self._run_timer), name='gcloudoem-buffered-writer'
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _raise_flush_error(self):
+        if self._flush_error is not None:
+            error, self._flush_error = self._flush_error, None
+            raise error
+
+    @property
+    def pending(self):
+        """The number of buffered mutations that haven't been flushed yet."""
+        return len(self._mutation.mutations)
+
+    def flush(self):
+        """
+        Commit the buffered mutations, blocking until they and those of any flush already in progress are durable.
+
+        :raises: :class:`~gcloudoem.exceptions.GCloudError` if the commit fails, or a background flush failed.
+        """
+        with self._lock:
+            self._raise_flush_error()
+            batch = None
+            if self._mutation.mutations:
+                batch = copy.copy(self)  # Keeps the buffered mutation...
+                self._reset_mutation()  # ...while we start a new one
+                self._bytes = 0
+            # Taking the commit lock before letting other writers in keeps batches in order.
+            self._commit_lock.acquire()
+        try:
+            if batch is not None:
+                Transaction.commit(batch)
+        finally:
+            self._commit_lock.release()
+
+    def _run_timer(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                with self._lock:
+                    self._flush_error = e
+
+    def _stop_timer(self):
+        self._stopped.set()
+        if self._timer is not None and self._timer is not threading.current_thread():
+            self._timer.join()
+
+    def commit(self):
+        """Flush any remaining mutations and stop the background flush thread."""
+        try:
+            self._stop_timer()
+            self.flush()
+        finally:
+            self._status = self._FINISHED
+
+    def rollback(self):
+        """Discard any mutations that haven't been flushed yet and stop the background flush thread."""
+        try:
+            self._stop_timer()
+            with self._lock:
+                self._reset_mutation()
+                self._bytes = 0
+        finally:
+            self._status = self._ABORTED
+
+
+def run_in_transaction(func, retries=DEFAULT_RETRIES, isolation=Transaction.SNAPSHOT, initial_delay=0.1,
+                       max_delay=5.0):
+    """
+    Run ``func`` inside a :class:`Transaction`, retrying it when the commit fails because of contention.
+
+    When Datastore aborts a transaction because another one touched the same entity groups, it responds with a
+    ``409 Conflict``. The transaction is then rolled back and ``func`` is run again in a fresh transaction, after
+    sleeping for an exponentially growing delay with full jitter so competing clients spread out instead of colliding
+    again. ``func`` must therefore be safe to run more than once. Other ``409`` errors, like inserting an entity that
+    already exists, can't succeed by running ``func`` again so they're raised straight away. So is a
+    :class:`~gcloudoem.exceptions.VersionConflict`, as the rest of the commit has been applied. For example::
+
+        >>> def transfer():
+        ...     account = Account.objects.get(pk=1)
+        ...     account.balance -= 10
+        ...     account.save()  # joins the transaction
+        >>> run_in_transaction(transfer, retries=5)
+
+    :param func: A callable taking no arguments. Use :func:`functools.partial` to bind arguments.
+    :param int retries: How many times to retry ``func`` after a conflict. Defaults to :data:`DEFAULT_RETRIES`.
+    :param isolation: The isolation level of the transaction. Defaults to :attr:`Transaction.SNAPSHOT`.
+    :param float initial_delay: The maximum delay (seconds) before the first retry. Doubled for each retry after that.
+    :param float max_delay: The cap (seconds) on the delay between retries.
+
+    :returns: The return value of ``func``.
+    :raises: :class:`~gcloudoem.exceptions.Conflict` if ``func`` still conflicts after ``retries`` retries.
+    """
+    _record_retry_stat('transactions')
+    attempt = 0
+    while True:
+        try:
+            with Transaction(isolation):
+                return func()
+        except VersionConflict:
+            raise  # The commit's other mutations have been applied, so running func again would repeat them
+        except Conflict as e:
+            if not _is_contention(e):
+                raise
+            if attempt >= retries:
+                _record_retry_stat('exhausted')
+                raise
+            _record_retry_stat('retries')
+            time.sleep(backoff_delay(attempt, initial_delay, max_delay))
+            attempt += 1
+
+
+def transactional(retries=DEFAULT_RETRIES, isolation=Transaction.SNAPSHOT, **kwargs):
+    """
+    Decorator version of :func:`run_in_transaction`::
+
+        >>> @transactional(retries=5)
+        ... def transfer(from_id, to_id, amount):
+        ...     ...
+
+    Accepts the same options as :func:`run_in_transaction`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **func_kwargs):
+            return run_in_transaction(
+                lambda: func(*args, **func_kwargs), retries=retries, isolation=isolation, **kwargs
+            )
+        return inner
+    return decorator
+
+
+def retry_stats():
+    """
+    Counters for :func:`run_in_transaction` in this process.
+
+    :rtype: dict
+    :returns: A dict with the number of ``transactions`` run, the number of ``retries`` after a conflict and the number
+        of transactions that were ``exhausted`` (gave up after running out of retries).
+    """
+    with _retry_stats_lock:
+        return dict(_retry_stats)
+
+
+def _is_contention(error):
+    """
+    Whether ``error``, a :class:`~gcloudoem.exceptions.Conflict`, means the transaction was aborted because of
+    contention, so running it again could succeed.
+
+    Datastore responds with a ``409`` both for ``ABORTED`` (contention) and ``ALREADY_EXISTS`` (an insert of an entity
+    that exists). They can only be told apart by the message.
+    """
+    message = ('%s' % (error.message or '',)).lower()
+    return 'already exists' not in message and 'already_exists' not in message
+
+
+def _record_retry_stat(name):
+    with _retry_stats_lock:
+        _retry_stats[name] += 1
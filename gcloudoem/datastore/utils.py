@@ -24,12 +24,23 @@ The non-private functions are part of the API.
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
 from threading import local
 
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
 from ._generated import datastore_pb2 as datastore_pb
 
 
-__all__ = ('set_protobuf_value', 'prepare_key_for_request')
+__all__ = (
+    'set_protobuf_value', 'prepare_key_for_request', 'BoundedExecutor', 'get_executor', 'set_executor',
+    'in_current_context',
+)
 
 
 class _LocalStack(local):
@@ -70,6 +81,143 @@ class _LocalStack(local):
             return self._stack[-1]
 
 
+class _ContextStack(object):
+    """
+    Manage a LIFO stack of resources in a :class:`contextvars.ContextVar`.
+
+    Unlike :class:`_LocalStack`, each asyncio task gets its own view of the stack (a copy of the stack when it was
+    created), so a transaction opened in one task is never seen by another task running on the same thread. The stack
+    is an immutable tuple, so those copies can't affect each other.
+    """
+    def __init__(self, name):
+        self._var = contextvars.ContextVar(name, default=())
+
+    def __iter__(self):
+        """Iterate the stack in LIFO order."""
+        return iter(reversed(self._var.get()))
+
+    def push(self, resource):
+        """Push a resource onto our stack."""
+        self._var.set(self._var.get() + (resource,))
+
+    def pop(self):
+        """
+        Pop a resource from our stack.
+
+        :raises: IndexError if the stack is empty.
+        :returns: the top-most resource, after removing it.
+        """
+        stack = self._var.get()
+        if not stack:
+            raise IndexError('pop from empty stack')
+        self._var.set(stack[:-1])
+        return stack[-1]
+
+    @property
+    def top(self):
+        """
+        Get the top-most resource
+
+        :returns: the top-most item, or None if the stack is empty.
+        """
+        stack = self._var.get()
+        if stack:
+            return stack[-1]
+
+
+class BoundedExecutor(object):
+    """
+    A thread pool that limits how much work can be outstanding.
+
+    A plain :class:`~concurrent.futures.ThreadPoolExecutor` queues an unlimited amount of work, so a caller that
+    submits faster than the pool can keep up just uses more and more memory. :meth:`submit` instead blocks the caller
+    once ``max_pending`` tasks are queued or running, until one of them finishes.
+    """
+    def __init__(self, max_workers=8, max_pending=None):
+        """
+        :param int max_workers: The number of worker threads.
+        :param int max_pending: The maximum number of tasks queued or running at once. Defaults to 4 x ``max_workers``.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._semaphore = threading.BoundedSemaphore(max_pending or max_workers * 4)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule ``fn(*args, **kwargs)`` to run in the pool, blocking while too much work is outstanding.
+
+        :rtype: :class:`concurrent.futures.Future`
+        """
+        self._semaphore.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda f: self._semaphore.release())
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop accepting work. If ``wait`` is True, block until all outstanding work is done."""
+        self._executor.shutdown(wait=wait)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Get the executor used for asynchronous RPCs, creating a default :class:`BoundedExecutor` if none has been set.
+
+    :rtype: :class:`BoundedExecutor`
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = BoundedExecutor()
+        return _executor
+
+
+def set_executor(executor):
+    """
+    Set the executor used for asynchronous RPCs.
+
+    :param executor: Anything with a ``submit`` method like :class:`concurrent.futures.Executor`. Use None to go back
+        to the default.
+    """
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+
+def in_current_context(fn):
+    """
+    Wrap ``fn`` to run in a copy of the current :mod:`contextvars` context, wherever it's called.
+
+    Threads (including executor workers) start in an empty context, so an RPC made on one isn't seen by anything
+    active where the work was started, like a :class:`~gcloudoem.datastore.accounting.CostAccountant`. Wrap the
+    function given to the thread or executor with this so that it is. Without :mod:`contextvars`, ``fn`` is returned
+    as is.
+
+    :rtype: callable
+    """
+    if contextvars is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def _resource_stack(name):
+    """
+    Make a stack of resources that is local to the current execution context.
+
+    :param str name: A name for the stack, used for the underlying :class:`contextvars.ContextVar`.
+    :returns: A :class:`_ContextStack`, or a :class:`_LocalStack` if :mod:`contextvars` isn't available.
+    """
+    if contextvars is None:
+        return _LocalStack()
+    return _ContextStack(name)
+
+
 def set_protobuf_value(protobuf_obj, attr, pb_value):
     """
     Assign ``pb_value`` the correct subfield of ``protobuf_obj`` based on ``attr``.
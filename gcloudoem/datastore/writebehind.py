@@ -0,0 +1,343 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Write-behind saving of entities via a local journal.
+
+A :class:`WriteBehindQueue` acknowledges a write as soon as it has been appended to a journal file on local disk. A
+background thread (the drainer) then commits the journal to Datastore in large non-transactional batches. If the
+process dies, the writes that hadn't been committed yet are committed when a queue is next opened on the same journal.
+
+This suits high volume, append-mostly kinds (logs, events, metrics) where a request shouldn't wait on a Datastore round
+trip::
+
+    >>> queue = WriteBehindQueue('/var/lib/myapp/events.journal')
+    >>> queue.put(Event(message='hi'))  # returns once the write is on disk
+    >>> with queue:
+    ...     Event(message='there').save()  # saves join the queue like they would a transaction
+    >>> queue.lag()
+    {'pending': 2, 'pending_bytes': 96, 'oldest_age': 0.004, 'committed': 0, 'rejected': 0, 'errors': 0, ...}
+    >>> queue.close()  # waits for everything to be committed
+
+Every write is an upsert of an entity with a complete key (partial root keys are completed with the kind's
+:class:`~gcloudoem.datastore.allocator.IdAllocator`), or a delete, so committing a write again after a crash is
+harmless. Writes to the same key in a batch are coalesced, so only the last one is sent.
+
+A batch that Datastore rejects as invalid (400 Bad Request) can never succeed, so rather than blocking everything behind
+it, it is appended to ``<path>.rejected`` (in the journal format) and skipped. Any other error is retried until it
+succeeds.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import deque, OrderedDict
+import io
+import os
+import struct
+import threading
+import time
+
+from . import utils
+from ._generated import datastore_pb2 as datastore_pb
+from .allocator import get_id_allocator
+from .connection import get_connection
+from .transaction import Transaction, _TRANSACTIONS
+from ..exceptions import BadRequest
+
+
+_HEADER = struct.Struct('>Id')
+"""Each journal record is the length of a serialised Mutation and the time it was written, followed by the Mutation."""
+
+
+class WriteBehindQueue(object):
+    """
+    Journals writes locally and commits them to Datastore in the background.
+
+    Instances are thread safe, but only one queue may use a journal at a time.
+    """
+    def __init__(self, path, connection=None, batch_size=500, flush_interval=1.0, fsync=True, retry_delay=1.0,
+                 start=True):
+        """
+        Open (or create) the journal at ``path``. Any writes left in it are committed by the drainer.
+
+        :param str path: The journal file. ``<path>.offset`` and ``<path>.rejected`` are also used.
+        :param connection: The connection to commit with. Defaults to the current connection.
+        :param int batch_size: The maximum number of writes per commit (Datastore allows 500).
+        :param float flush_interval: How long (seconds) to wait for a batch to fill before committing what there is.
+        :param bool fsync: Sync the journal to disk on every write. Turning this off is faster, but writes can be lost
+            if the machine (rather than just the process) goes down.
+        :param float retry_delay: How long (seconds) to wait before trying to commit again after an error.
+        :param bool start: Start the drainer straight away. Defaults to True.
+        """
+        self._path = path
+        self._offset_path = path + '.offset'
+        self._rejected_path = path + '.rejected'
+        self._connection = connection or get_connection()
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._retry_delay = retry_delay
+
+        self._lock = threading.Condition(threading.Lock())
+        self._pending = deque()  # (time written, size) of each journalled write not committed yet, in order
+        self._pending_bytes = 0
+        self._committed = 0
+        self._rejected = 0
+        self._errors = 0
+        self._last_error = None
+        self._last_commit = None
+        self._closing = False
+        self._flushing = False  # Someone is waiting in flush(), so don't wait for batches to fill up
+        self._thread = None
+
+        self._offset = self._recover()
+        self._journal = io.open(path, 'ab')
+        if start:
+            self.start()
+
+    def _recover(self):
+        """Work out which journalled writes haven't been committed, dropping any partly written record at the end."""
+        try:
+            with io.open(self._offset_path, 'rb') as f:
+                offset = int(f.read() or 0)
+        except (IOError, OSError, ValueError):
+            offset = 0
+
+        end = offset
+        if os.path.exists(self._path):
+            with io.open(self._path, 'r+b') as journal:
+                size = journal.seek(0, io.SEEK_END)
+                if offset > size:  # We died while compacting. Everything was committed.
+                    offset = end = 0
+                journal.seek(offset)
+                while True:
+                    header = journal.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    length, written = _HEADER.unpack(header)
+                    if len(journal.read(length)) < length:
+                        break
+                    self._pending.append((written, _HEADER.size + length))
+                    self._pending_bytes += _HEADER.size + length
+                    end = journal.tell()
+                if end < size:
+                    journal.truncate(end)
+        return offset
+
+    def start(self):
+        """Start the drainer thread if it isn't running."""
+        with self._lock:
+            if self._thread is None:
+                self._closing = False
+                self._thread = threading.Thread(
+                    target=utils.in_current_context(self._run), name='gcloudoem-write-behind'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    def put(self, entity, if_unchanged=False):
+        """
+        Journal an upsert of ``entity``. If its key is partial, it's completed first, so it mustn't have a parent.
+
+        :param entity: The :class:`~gcloudoem.entity.Entity` to save.
+        :param bool if_unchanged: Not supported. Conditional writes need to be committed straight away.
+        """
+        if if_unchanged:
+            raise ValueError("Write-behind saves can't be conditional")
+        if entity.key.is_partial:
+            get_id_allocator(entity.__class__, connection=self._connection).assign(entity)
+        txn = Transaction(Transaction.NONE, connection=self._connection)
+        txn.put(entity)
+        self._append(txn._mutation.mutations[0])
+
+    def create(self, entity):
+        """Same as :meth:`put`. There's no insert, as journalled writes have to be safe to commit more than once."""
+        self.put(entity)
+
+    def delete(self, entity):
+        """
+        Journal a delete of ``entity``.
+
+        :param entity: The :class:`~gcloudoem.entity.Entity` to delete. It must have a complete key.
+        """
+        txn = Transaction(Transaction.NONE, connection=self._connection)
+        txn.delete(entity)
+        self._append(txn._mutation.mutations[0])
+
+    def is_buffered(self, key):
+        """Journalled writes can't be read back, so :meth:`QuerySet.get` always goes to Datastore."""
+        return False
+
+    def _append(self, mutation):
+        data = mutation.SerializeToString()
+        written = time.time()
+        with self._lock:
+            if self._closing:
+                raise ValueError('Write-behind queue is closed')
+            self._journal.write(_HEADER.pack(len(data), written) + data)
+            self._journal.flush()
+            if self._fsync:
+                os.fsync(self._journal.fileno())
+            self._pending.append((written, _HEADER.size + len(data)))
+            self._pending_bytes += _HEADER.size + len(data)
+            if len(self._pending) == 1 or len(self._pending) >= self._batch_size:
+                self._lock.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Block until every write made so far has been committed.
+
+        :param float timeout: Give up after this many seconds.
+        :rtype: bool
+        :returns: True if everything was committed, False if we timed out.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            target = self._committed + self._rejected + len(self._pending)
+            self._flushing = True
+            self._lock.notify_all()
+            while self._committed + self._rejected < target:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        """
+        Stop accepting writes, wait for the journal to be committed and stop the drainer.
+
+        :param float timeout: Give up waiting after this many seconds. Anything not committed stays in the journal.
+        :rtype: bool
+        :returns: True if everything was committed.
+        """
+        with self._lock:
+            self._closing = True
+            self._lock.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._lock:
+            if thread is None or not thread.is_alive():
+                self._thread = None
+                self._journal.close()
+            return not self._pending
+
+    def lag(self):
+        """
+        How far behind Datastore is.
+
+        :rtype: dict
+        :returns: ``pending`` writes and ``pending_bytes`` not committed yet, the ``oldest_age`` (seconds) of those,
+            how many writes have been ``committed`` and ``rejected``, the number of failed commits (``errors``), the
+            ``last_error`` and the time of the ``last_commit``.
+        """
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'pending_bytes': self._pending_bytes,
+                'oldest_age': time.time() - self._pending[0][0] if self._pending else 0.0,
+                'committed': self._committed,
+                'rejected': self._rejected,
+                'errors': self._errors,
+                'last_error': self._last_error,
+                'last_commit': self._last_commit,
+            }
+
+    def __enter__(self):
+        _TRANSACTIONS.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _TRANSACTIONS.pop()
+
+    def _run(self):
+        """The drainer."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    if self._closing:
+                        return
+                    self._flushing = False
+                    self._lock.wait()
+                    continue
+                if len(self._pending) < self._batch_size and not (self._closing or self._flushing):
+                    self._lock.wait(self._flush_interval)  # Give the batch a chance to fill up
+            if not self._drain():
+                time.sleep(self._retry_delay)
+
+    def _drain(self):
+        """
+        Commit the next batch of journalled writes.
+
+        :rtype: bool
+        :returns: False if the commit failed and should be retried.
+        """
+        with self._lock:
+            count = min(len(self._pending), self._batch_size)
+            offset = self._offset
+
+        records = []
+        with io.open(self._path, 'rb') as journal:
+            journal.seek(offset)
+            for _ in range(count):
+                length, _ = _HEADER.unpack(journal.read(_HEADER.size))
+                records.append(journal.read(length))
+            end = journal.tell()
+
+        mutations = OrderedDict()
+        for data in records:
+            mutation = datastore_pb.Mutation.FromString(data)
+            operation = mutation.WhichOneof('operation')
+            key = mutation.delete if operation == 'delete' else getattr(mutation, operation).key
+            key = key.SerializeToString()
+            mutations.pop(key, None)  # The last write of a key wins
+            mutations[key] = mutation
+        request = datastore_pb.CommitRequest()
+        request.mutations.extend(mutations.values())
+
+        rejected = False
+        try:
+            self._connection.commit(request, None)
+        except BadRequest as e:
+            rejected = True
+            with io.open(self._rejected_path, 'ab') as f:
+                for data in records:
+                    f.write(_HEADER.pack(len(data), time.time()) + data)
+            with self._lock:
+                self._last_error = e
+        except Exception as e:
+            with self._lock:
+                self._errors += 1
+                self._last_error = e
+            return False
+
+        with self._lock:
+            self._offset = end
+            for _ in range(count):
+                self._pending_bytes -= self._pending.popleft()[1]
+            if rejected:
+                self._rejected += count
+            else:
+                self._committed += count
+                self._last_commit = time.time()
+            self._checkpoint()
+            self._lock.notify_all()
+        return True
+
+    def _checkpoint(self):
+        """Record how much of the journal has been committed. Once all of it has, empty it. Call with the lock held."""
+        self._write_offset(self._offset)
+        if not self._pending:
+            self._journal.truncate(0)
+            self._offset = 0
+            self._write_offset(0)
+
+    def _write_offset(self, offset):
+        tmp_path = self._offset_path + '.tmp'
+        with io.open(tmp_path, 'wb') as f:
+            f.write(str(offset).encode('ascii'))
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self._offset_path):
+            os.remove(self._offset_path)
+        os.rename(tmp_path, self._offset_path)
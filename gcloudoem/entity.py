@@ -47,30 +47,84 @@ class Entity(with_metaclass(EntityMeta, BaseEntity)):
     def __init__(self, **kwargs):
         super(Entity, self).__init__(**kwargs)
 
-    def save(self, force_insert=False, validate=True, clean=True, **kwargs):
+    def save(self, force_insert=False, validate=True, clean=True, if_unchanged=False, **kwargs):
         """
         Save the :class:`Entity` to the database. If the entity already exists, it will be updated,
         otherwise it will be created.
 
+        If called inside a :class:`~gcloudoem.datastore.transaction.Transaction` block, the save joins that transaction
+        and happens when it commits (so a partial key is only completed then). Otherwise it is committed straight away
+        in a transaction of its own. To force a separate transaction, use one explicitly.
+
         :param force_insert: only try to create a new document, don't allow updates of existing documents. Defaults to
             False.
         :param validate: validates the document; set to ``False`` to skip.
         :param clean: call the document clean method, requires `validate` to be True.
+        :param if_unchanged: only save the entity if it hasn't changed in Datastore since it was read (optimistic
+            concurrency). This is a single non-transactional commit, so it's much cheaper than a read-modify-write
+            transaction when contention is rare. Defaults to False.
+
+        :raises: :class:`~gcloudoem.exceptions.VersionConflict` if ``if_unchanged`` is True and the entity has changed
+            since it was read.
+        :raises: ValueError if both ``force_insert`` and ``if_unchanged`` are True. An entity that was read already
+            exists, so it can't be inserted.
+        """
+        if force_insert and if_unchanged:
+            raise ValueError("Can't save an entity with both force_insert and if_unchanged")
+        if validate:
+            self.validate(clean=clean)
+
+        txn = Transaction.current()
+        if txn is not None:
+            self._put(txn, force_insert, if_unchanged)
+        else:
+            # A conditional put is a single mutation, so it doesn't need an actual transaction.
+            with Transaction(Transaction.NONE if if_unchanged else Transaction.SNAPSHOT) as txn:
+                self._put(txn, force_insert, if_unchanged)
 
+    def save_async(self, force_insert=False, validate=True, clean=True, executor=None):
+        """
+        Save the :class:`Entity` to the database without waiting for the write to finish.
+
+        Validation and encoding happen straight away in the caller, then the write is committed on ``executor`` as a
+        single non-transactional commit. Unlike :meth:`save`, it never joins the current transaction. Once the
+        write is done the entity's key is complete, just as it would be after :meth:`save`.
+
+        :param force_insert: only try to create a new document, don't allow updates of existing documents. Defaults to
+            False.
+        :param validate: validates the document; set to ``False`` to skip.
+        :param clean: call the document clean method, requires `validate` to be True.
+        :param executor: The executor to commit on. Defaults to :func:`~gcloudoem.datastore.utils.get_executor`.
+
+        :rtype: :class:`concurrent.futures.Future`
+        :returns: A future with a result of None once the write is done. If the write failed, its ``result()`` raises
+            the error.
         """
         if validate:
             self.validate(clean=clean)
 
-        with Transaction(Transaction.SNAPSHOT) as txn:
-            if force_insert:
-                txn.create(self)
-            else:
-                txn.put(self)
+        txn = Transaction(Transaction.NONE)
+        self._put(txn, force_insert, False)
+        return txn.commit_async(executor)
+
+    def _put(self, txn, force_insert, if_unchanged):
+        if force_insert:
+            txn.create(self)
+        else:
+            txn.put(self, if_unchanged=if_unchanged)
 
     def delete(self):
-        """Delete this entity from Datastore."""
-        with Transaction(Transaction.SNAPSHOT) as txn:
+        """
+        Delete this entity from Datastore.
+
+        Like :meth:`save`, this joins the current :class:`~gcloudoem.datastore.transaction.Transaction` if there is one.
+        """
+        txn = Transaction.current()
+        if txn is not None:
             txn.delete(self)
+        else:
+            with Transaction(Transaction.SNAPSHOT) as txn:
+                txn.delete(self)
 
     @classmethod
     def from_protobuf(cls, pb):
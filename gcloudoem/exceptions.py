@@ -161,6 +161,15 @@ class ServiceUnavailable(ServerError):
     code = 503
 
 
+class DeadlineExceeded(ServerError):
+    """
+    Exception mapping a '504 Gateway Timeout' response.
+
+    Also raised by a connection when retrying a request would take it past its deadline.
+    """
+    code = 504
+
+
 def make_exception(response, content, use_json=True):
     """
     Factory: create exception based on HTTP response code.
@@ -177,10 +186,12 @@ def make_exception(response, content, use_json=True):
     :rtype: instance of :class:`GCloudError`, or a concrete subclass.
     :returns: Exception specific to the error response.
     """
+    if isinstance(content, six.binary_type):
+        content = content.decode('utf-8', 'replace')
     message = content
     errors = ()
 
-    if isinstance(content, str):
+    if isinstance(content, six.string_types):
         if use_json:
             payload = json.loads(content)
         else:
@@ -216,6 +227,27 @@ for eklass in _walk_subclasses(GCloudError):
         _HTTP_CODE_TO_EXCEPTION[code] = eklass
 
 
+class VersionConflict(Conflict):
+    """
+    Raised when a conditional write fails because the entity changed since it was read.
+
+    Defined after the status code mapping above so that ``409`` responses still map to :class:`Conflict`.
+
+    :ivar entities: The entities whose writes conflicted.
+    """
+    def __init__(self, message, entities=(), errors=()):
+        super(VersionConflict, self).__init__(message, errors)
+        self.entities = list(entities)
+
+
+class CircuitOpen(ServiceUnavailable):
+    """
+    Raised instead of sending a request while a connection's circuit breaker is open.
+
+    Defined after the status code mapping above so that ``503`` responses still map to :class:`ServiceUnavailable`.
+    """
+
+
 class ValidationError(AssertionError):
     """
     Validation exception.
@@ -321,3 +353,18 @@ class MultipleObjectsReturned(Exception):
 
 class ConnectionError(Exception):
     pass
+
+
+class NPlusOneWarning(RuntimeWarning):
+    """A line of code fetched many referenced entities one at a time. See :mod:`gcloudoem.queryset.nplusone`."""
+    pass
+
+
+class NPlusOneError(Exception):
+    """Raised instead of :class:`NPlusOneWarning` by a detector created with ``raise_error=True``."""
+    pass
+
+
+class ReplayError(Exception):
+    """A recording of Datastore traffic couldn't be made or replayed. See :mod:`gcloudoem.datastore.replay`."""
+    pass
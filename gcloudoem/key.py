@@ -1,10 +1,16 @@
 # Copyright (c) 2012-2015 Kapiche Ltd.
 # Author: Ryan Stuart<ryan@kapiche.com>
 from builtins import str as text
+import threading
+import weakref
 
 import six
 
 
+_INTERNED = weakref.WeakValueDictionary()
+_INTERN_LOCK = threading.Lock()
+
+
 class Key(object):
     """
     A Key for an Entity in Google Datastore.
@@ -18,6 +24,11 @@ class Key(object):
 
     If no id or name is specified for this key, then an int id will be auto assigned to it when the owning
     :class:`~gcloud.entity.Entity` is saved.
+
+    Complete keys compare and hash by value (their full path), so they can be used in sets and as dict keys. Partial
+    keys (and keys with a partial ancestor) have no identity in Datastore yet so they only compare equal to themselves.
+    Note that a partial key's hash changes once it is completed, so don't keep partial keys in a set or dict across a
+    save.
     """
     def __init__(self, kind, parent=None, value=None):
         """
@@ -30,11 +41,38 @@ class Key(object):
         self._kind = u"%s" % text(kind)  # Make SURE we have unicode
         self._parent = parent
         self._id = self._name = None
+        self._pb_cache = {}
         if isinstance(value, six.string_types):
             self._name = value
         elif isinstance(value, six.integer_types):
             self._id = value
 
+    @classmethod
+    def intern(cls, key):
+        """
+        Get the canonical instance for ``key`` from the intern table.
+
+        Interning lets many entities share one :class:`Key` instance (and its cached protobuf) for the same Datastore
+        key, which is useful when decoding lots of entities that reference the same keys. The table only holds weak
+        references so interned keys are freed once nothing else uses them. Partial keys are returned as is.
+
+        :param :class:`Key` key: The key to intern.
+        :rtype: :class:`Key`
+        """
+        if not key.is_complete:
+            return key
+        with _INTERN_LOCK:
+            interned = _INTERNED.get(key.flat_path)
+            if interned is None:
+                _INTERNED[key.flat_path] = interned = key
+        return interned
+
+    @staticmethod
+    def clear_interned():
+        """Empty the intern table."""
+        with _INTERN_LOCK:
+            _INTERNED.clear()
+
     @property
     def kind(self):
         return self._kind
@@ -57,8 +95,24 @@ class Key(object):
 
     @property
     def is_partial(self):
+        """True if this key doesn't have a name or id yet, so one will be allocated for it when it's saved."""
         return self.name_or_id is None
 
+    @property
+    def is_complete(self):
+        """
+        True if every key in this key's path has a name or id.
+
+        A key with a partial ancestor isn't partial itself, but its path will change when the ancestor is completed, so
+        until then it isn't cached, interned or hashed by value.
+        """
+        key = self
+        while key is not None:
+            if key.name_or_id is None:
+                return False
+            key = _parent_key(key.parent)
+        return True
+
     @property
     def path(self):
         """
@@ -68,8 +122,95 @@ class Key(object):
         :return: The full path of this :class:`Key` which includes this key itself as the last element.
         """
         path = [self]
-        key = self._parent
-        while key:
+        key = _parent_key(self._parent)
+        while key is not None:
             path = [key] + path
-            key = key.parent
+            key = _parent_key(key.parent)
         return path
+
+    @property
+    def flat_path(self):
+        """
+        The path of this key as a tuple of ``(kind, name_or_id)`` pairs, oldest ancestor first.
+
+        :rtype: tuple
+        """
+        return tuple((key.kind, key.name_or_id) for key in self.path)
+
+    def to_protobuf(self, project_id, namespace):
+        """
+        Get the protobuf for this key in the given partition.
+
+        The protobuf for a complete key is built once per partition and cached on the key, so the returned protobuf is
+        shared and **must not** be modified. Copy it first (eg. ``CopyFrom``) if you need to change it.
+
+        :param str project_id: The project (dataset) the key belongs to.
+        :param str namespace: The namespace the key belongs to.
+
+        :rtype: :class:`gcloudoem.datastore._generated.entity_pb2.Key`
+        """
+        partition = (project_id, namespace)
+        key_pb = self._pb_cache.get(partition)
+        if key_pb is not None:
+            return key_pb
+
+        from .datastore._generated import entity_pb2 as entity_pb
+        key_pb = entity_pb.Key()
+        key_pb.partition_id.project_id = project_id
+        key_pb.partition_id.namespace_id = namespace
+        for item in self.path:
+            element = key_pb.path.add()
+            element.kind = item.kind
+            if item.id:
+                element.id = item.id
+            elif item.name:
+                element.name = item.name
+
+        if self.is_complete:  # Partial keys are completed in place on save, so don't cache them.
+            self._pb_cache[partition] = key_pb
+        return key_pb
+
+    def _complete(self, id):
+        """Complete a partial key with the id assigned to it by Datastore."""
+        self._id = id
+        self._pb_cache.clear()
+
+    def __eq__(self, other):
+        if not isinstance(other, Key):
+            return NotImplemented
+        if self is other:
+            return True
+        if not (self.is_complete and other.is_complete):
+            return False
+        return self.flat_path == other.flat_path
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        if not self.is_complete:
+            return id(self)
+        return hash(self.flat_path)
+
+    def __getstate__(self):
+        """Don't pickle cached protobufs. Keys are pickled by :class:`~gcloudoem.properties.ReferenceProperty`."""
+        state = self.__dict__.copy()
+        state.pop('_pb_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pb_cache = {}
+
+    def __repr__(self):
+        return "<Key %s>" % ', '.join('%s: %r' % item for item in self.flat_path)
+
+
+def _parent_key(parent):
+    """Parents can be given as an Entity instead of a Key. Resolve these to the Entity's key."""
+    if parent is None or isinstance(parent, Key):
+        return parent
+    return parent.key
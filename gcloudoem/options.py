@@ -27,6 +27,9 @@ class Options(object):
     * **get_latest_by** - The name of an orderable property in the entity, typically a DateProperty, DateTimeProperty,
         or IntegerProperty. This specifies the default field to use in your model Manager's latest() and earliest()
         methods.
+    * **id_block_size** - If set, partial root keys for this entity are completed with IDs reserved client side in
+        blocks of this size (see :mod:`gcloudoem.datastore.allocator`) instead of being assigned by Datastore on
+        commit. Keys with a parent are still assigned by Datastore. Defaults to None.
     * **indexed_properties** - Which properties should be indexed in Datastore? This should be a tuple or list of string
         property names. Defaults to all properties.
     * **kind** - What kind should be used to store this in datastore. Defaults to the Entity class name.
@@ -45,12 +48,13 @@ class Options(object):
     """
     DEFAULT_NAMES = (
         'verbose_name', 'verbose_name_plural', 'kind', 'ordering', 'get_latest_by',
-        'order_with_respect_to', 'namespace', 'indexed_properties',
+        'order_with_respect_to', 'namespace', 'indexed_properties', 'id_block_size',
     )
 
     def __init__(self, meta):
         # Defaults
         self.get_by_latest = None
+        self.id_block_size = None
         self.indexed_properties = []
         self.kind = ''
         self.namespace = ''
@@ -102,24 +102,16 @@ class KeyProperty(BaseProperty):
             instance._data[self.name] = Key(kind, parent=parent, value=value)
 
     def to_protobuf(self, value):
-        from .datastore._generated import entity_pb2 as entity_pb
-        key = entity_pb.Key()
+        """
+        Get the protobuf for the key ``value`` in the partition of the current connection.
 
-        dataset_id = get_connection().dataset
-        if not dataset_id:
+        The returned protobuf is cached on ``value`` (see :meth:`gcloudoem.key.Key.to_protobuf`) so it must not be
+        modified.
+        """
+        connection = get_connection()
+        if not connection.dataset:
             raise EnvironmentError("Couldn't determine the dataset ID. Have you called connect?")
-        key.partition_id.project_id = dataset_id
-        key.partition_id.namespace_id = get_connection().namespace
-
-        for item in value.path:
-            element = key.path.add()
-            element.kind = item.kind
-            if item.id:
-                element.id = item.id
-            elif item.name:
-                element.name = item.name
-
-        return key
+        return value.to_protobuf(connection.dataset, connection.namespace)
 
     def from_protobuf(self, pb_value):
         """
@@ -168,6 +160,8 @@ class ReferenceProperty(BaseProperty):
         try:
             value = instance._data[self.name]
             if isinstance(value, Key):  # We need to fetch the entity and set it on the owning entity
+                from .queryset.nplusone import record_fetch
+                record_fetch(instance, self)
                 value = self.entity_cls.objects.get(pk=value.name_or_id)
                 setattr(instance, self.name, value)
         except KeyError:  # Empty
@@ -2,6 +2,7 @@
 # Author: Ryan Stuart<ryan@kapiche.com>
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
 import copy
 import warnings
 import itertools
@@ -14,6 +15,14 @@ from ..datastore.transaction import Transaction
 from ..exceptions import GCloudError
 from ..utils import VERSION_PICKLE_KEY
 from .lookups import convert_lookups, LOOKUP_SEP
+from .nplusone import prefetch_related_objects
+from . import aggregates, columns, rows
+from .aggregates import Aggregate, Avg, Count, Max, Min, Sum
+
+
+__all__ = (
+    'QuerySet', 'Aggregate', 'Avg', 'Count', 'Max', 'Min', 'Sum',
+)
 
 
 # The maximum number of items to display in a QuerySet.__repr__
@@ -32,7 +41,8 @@ class QuerySet(object):
         self._result_cache = None
 
         self._queries = queries or []
-        self._properties = None
+        self._properties = None  # The names of the properties in each row, after values() or values_list()
+        self._row_type = None
 
         self._start = 0
         self._limit = None
@@ -40,6 +50,10 @@ class QuerySet(object):
         self._order = None
         self._is_filtered = False
         self._projection = None
+        self._distinct = ()
+        self._prefetch_related = ()
+        self._annotations = None  # The aggregates for each group of rows, after annotate()
+        self._prepared_queries = None
 
     ##
     # Python data-model related functions
@@ -130,12 +144,16 @@ class QuerySet(object):
     # Public methods that evaluate the queryset
     ##
     def iterator(self):
-        for q in self._queries:
-            if self._order:
-                q.order = self._order
-            if self._projection:
-                q.projections(self._projection)
-        return itertools.chain(*[q() for q in self._queries])
+        if self._annotations is not None:
+            return aggregates.annotate(self)
+        queries = self._get_prepared_queries()
+        row_factory = None
+        if self._properties is not None:
+            row_factory = rows.row_factory(self.entity, self._properties, self._row_type)
+        results = itertools.chain(*[q(row_factory) for q in queries])
+        if self._distinct and len(queries) > 1:  # Each query is distinct, but they can overlap
+            results = self._unique(results)
+        return results
 
     def count(self):
         """
@@ -146,15 +164,43 @@ class QuerySet(object):
         self._fetch_all()
         return len(self._result_cache)
 
+    def aggregate(self, *args, **kwargs):
+        """
+        Return a dict of aggregates over the entities in this QuerySet, computed as the results are streamed in::
+
+            >>> Order.objects.filter(country='AU').aggregate(total=Sum('amount'), average=Avg('amount'), n=Count())
+            {'total': 1200, 'average': 40.0, 'n': 30}
+
+        Only the aggregated properties are fetched (nothing but keys for ``Count()``), using a projection query for each
+        property, so they must be indexed. See :mod:`gcloudoem.queryset.aggregates`. Aggregates given as positional
+        arguments are named after their property, like ``amount__sum``.
+
+        This results in this queryset being evaluated.
+        """
+        assert not self._is_limited(), "Cannot use aggregate() once a slice has been taken."
+        assert self._annotations is None, "Can't use aggregate() after annotate()."
+        return aggregates.aggregate(self, aggregates.aliased(args, kwargs))
+
     def get(self, *args, **kwargs):
         """
         Performs the query and returns a single entity matching the given keyword arguments.
 
         if strong_consistency is True, This is done inside a Datastore transaction.
+
+        If the only filter is on the key (eg. ``get(pk=...)``) and the entity was saved or deleted in the current
+        :class:`~gcloudoem.datastore.transaction.Transaction`, the result is read back from the transaction rather than
+        Datastore, which wouldn't see the write until the transaction is committed.
         """
         strong_consistency = kwargs.pop('strong_consistency', False)
         clone = self.filter(*args, **kwargs)
         clone = clone.order_by()
+        key = clone._key_lookup()
+        transaction = Transaction.current()
+        if key is not None and transaction is not None and transaction.is_buffered(key):
+            entity = transaction.get_buffered(key)
+            if entity is None:
+                raise self.entity.DoesNotExist("%s matching query does not exist." % self.entity._meta.kind)
+            return entity
         try:
             if strong_consistency:
                 transaction = Transaction(Transaction.SERIALIZABLE)
@@ -179,20 +225,17 @@ class QuerySet(object):
 
     def bulk_create(self, entities):
         """
-        Inserts each of the instances into the database. This does *not* call save() on each of the instances (save()
-        runs in its own transaction), but the outcome is the same as if you were to call save() on each entity. Rather,
-        it saves all the entities in Datastore within the one transaction.
+        Inserts each of the instances into the database. This does *not* call save() on each of the instances, but the
+        outcome is the same as if you were to call save() on each entity. Like save(), it joins the current
+        :class:`~gcloudoem.datastore.transaction.Transaction` if there is one. Otherwise the entities are saved in
+        transactions of 25.
 
         :type entities: iterable of :class:`~gcloudoem.entity.Entity` instances.
         :param entities: The entities to save.
 
         :return: The created entities
         """
-        for chunk in self._chunk(entities, 25):  # Limit for ancestor-less transactions
-            with Transaction(Transaction.SNAPSHOT) as txn:
-                for entity in chunk:
-                    txn.create(entity)
-
+        self._write('create', list(entities))
         return entities
 
     def get_or_create(self, defaults=None, **kwargs):
@@ -268,31 +311,31 @@ class QuerySet(object):
         return {e.key.name_or_id: e for e in qs}
 
     def delete(self):
-        """Deletes the entities in the current QuerySet."""
+        """
+        Deletes the entities in the current QuerySet, in the current
+        :class:`~gcloudoem.datastore.transaction.Transaction` if there is one.
+        """
         assert not self._is_limited(), "Cannot use 'limit' or 'offset' with delete."
 
         if self._properties is not None:
             raise TypeError("Cannot call delete() after .values() or .values_list()")
 
-        for chunk in self._chunk(list(self._clone()), 25):  # Can only operate on 25 items at once when ancestor-less
-            with Transaction(Transaction.SNAPSHOT) as txn:
-                for e in iter(chunk):
-                    txn.delete(e)
+        self._write('delete', list(self._clone()))
 
         # Clear the result cache, in case this QuerySet gets reused.
         self._result_cache = None
 
     def update(self, **kwargs):
-        """Updates all elements in the current QuerySet, setting all the given properties to the appropriate values."""
+        """
+        Updates all elements in the current QuerySet, setting all the given properties to the appropriate values. The
+        entities are saved in the current :class:`~gcloudoem.datastore.transaction.Transaction` if there is one.
+        """
         assert not self._is_limited(), "Cannot update a query once a slice has been taken."
         entities = list(self)
         for e in entities:
             for name, value in kwargs.items():
                 setattr(e, name, value)
-        for chunk in self._chunk(entities, 25):  # Limit for ancestor-less transactions
-            with Transaction(Transaction.SNAPSHOT) as txn:
-                for e in entities:
-                    txn.put(e)
+        self._write('put', entities)
         self._result_cache = None
         return entities
 
@@ -343,22 +386,212 @@ class QuerySet(object):
         clone._projection = '__key__'
         return clone
 
+    def values(self, *properties):
+        """
+        Return a dict for each result rather than an entity, with the values of ``properties`` (or all of them).
+
+        Given ``properties``, this is a projection query for them, so they must be indexed. The dicts are built
+        straight from the results, without constructing entities, so this is much cheaper than reading the same
+        properties off entities::
+
+            >>> Person.objects.filter(age__gt=18).values('name', 'age')
+            [{'name': 'Alice', 'age': 30}, {'name': 'Bob', 'age': 25}]
+
+        ``key`` is the entity's key, and can be used even in a projection.
+        """
+        return self._values(properties, rows.DICT)
+
+    def values_list(self, *properties, **kwargs):
+        """
+        Like :meth:`values`, but return a tuple for each result.
+
+        :param bool flat: Return just the value of the only property, rather than a tuple.
+        :param bool named: Return a :func:`~collections.namedtuple`, with a field for each property.
+        """
+        flat = kwargs.pop('flat', False)
+        named = kwargs.pop('named', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s' % (list(kwargs),))
+        if flat and named:
+            raise TypeError("'flat' and 'named' can't be used together.")
+        if flat and len(properties) != 1:
+            raise TypeError("'flat' is only valid when values_list is called with a single property.")
+        return self._values(properties, rows.FLAT if flat else rows.NAMED if named else rows.TUPLE)
+
+    def to_columns(self, properties=(), structured=False, projection=True):
+        """
+        Evaluate this QuerySet into a column of values for each of ``properties`` (or all of them), for analysis.
+
+        Like :meth:`values_list`, the values are read straight from the results without constructing entities, and
+        with ``properties`` this is a projection query for them. Integer, float, boolean and date/time columns are
+        packed as they arrive and returned as typed NumPy arrays; see :mod:`gcloudoem.queryset.columns` for the dtypes::
+
+            >>> columns = Person.objects.filter(age__gt=18).to_columns(['age', 'born'])
+            >>> columns['age'].mean()
+            31.5
+
+        :param properties: The names of the properties. ``key`` is the entity's key.
+        :param bool structured: Return a NumPy structured array, with a field for each property, rather than a dict.
+        :param bool projection: Use a projection query. Pass False if any of ``properties`` aren't indexed.
+        :rtype: :class:`~collections.OrderedDict` of property name to array (a list, if NumPy isn't installed), or a
+            :class:`numpy.ndarray`.
+        """
+        return columns.to_columns(self, properties, structured=structured, projection=projection)
+
+    def annotate(self, *args, **kwargs):
+        """
+        Aggregate each combination of the values of the properties given to :meth:`values` or :meth:`values_list`, and
+        add the aggregates to their rows::
+
+            >>> Order.objects.values('country').annotate(total=Sum('amount'), n=Count())
+            [{'country': 'AU', 'total': 1200, 'n': 30}, {'country': 'NZ', 'total': 400, 'n': 12}]
+
+        The aggregates are computed as the results are streamed in, as for :meth:`aggregate`, and the rows are in the
+        order their groups were first seen.
+        """
+        assert self._properties is not None and self._projection, \
+            "annotate() must follow values() or values_list() with the properties to group by."
+        assert self._row_type != rows.FLAT, "Can't use annotate() with values_list(flat=True)."
+        clone = self._clone()
+        clone._annotations = aggregates.aliased(args, kwargs)
+        if self._annotations:
+            clone._annotations = collections.OrderedDict(itertools.chain(
+                self._annotations.items(), clone._annotations.items()
+            ))
+        return clone
+
+    def distinct(self, *properties):
+        """
+        Only return the first entity for each combination of values of ``properties``.
+
+        This uses Datastore's ``distinct_on``, so the duplicates are never sent. Datastore only supports it for
+        projection queries, so ``properties`` are added to the :meth:`projection` (or are the projection, if it hasn't
+        been set). For example, the ages of people, without fetching everyone::
+
+            >>> [person.age for person in Person.objects.distinct('age')]
+            [18, 21, 30]
+        """
+        assert properties, "distinct() needs at least one property."
+        assert not self._is_limited(), "Cannot use distinct() once a slice has been taken."
+        assert self._projection != '__key__', "Can't use distinct() after keys_only()."
+        clone = self._clone()
+        clone._distinct = properties
+        return clone
+
+    def prefetch_related(self, *names):
+        """
+        Fetch the entities referenced by the properties ``names`` when this QuerySet is evaluated, in a single RPC
+        (for each batch of 1000 keys) rather than one RPC each time a reference is read.
+
+        Each of ``names`` must be a :class:`~gcloudoem.properties.ReferenceProperty` or a ``ListProperty`` of them.
+        Calling this with no arguments clears any properties given before.
+        """
+        clone = self._clone()
+        clone._prefetch_related = self._prefetch_related + names if names else ()
+        return clone
+
     ##
     # Private methods
     ##
     def _clone(self, **kwargs):
         clone = self.__class__(entity=self.entity, queries=self._queries[:])
         clone._properties = self._properties
+        clone._row_type = self._row_type
         clone._start = self._start
         clone._limit = self._limit
         clone._step = self._step
+        clone._order = self._order
         clone._is_filtered = self._is_filtered
         clone._projection = self._projection
+        clone._distinct = self._distinct
+        clone._prefetch_related = self._prefetch_related
+        clone._annotations = self._annotations
 
         clone.__dict__.update(kwargs)
 
         return clone
 
+    def _values(self, properties, row_type):
+        assert not self._is_limited(), "Cannot use values() or values_list() once a slice has been taken."
+        assert not self._projection, "Can't use values() or values_list() after projection() or keys_only()."
+        names = list(properties) or list(self.entity._properties)
+        rows.row_factory(self.entity, names, row_type)  # Check the properties exist
+        clone = self._clone()
+        clone._properties = tuple(names)
+        clone._row_type = row_type
+        if properties:
+            projection = [name for name in names if name != 'key']
+            clone._projection = tuple(projection) if projection else '__key__'
+        return clone
+
+    def _get_prepared_queries(self):
+        """
+        The queries to run, with this QuerySet's order, projection and distinct properties applied.
+
+        They're prepared once per QuerySet (every change makes a new QuerySet), so evaluating it again reuses the
+        protobufs the queries have already built.
+        """
+        if self._prepared_queries is None:
+            queries = self._queries or [Query(self.entity)]
+            if self._order or self._projection or self._distinct:
+                queries = [q.clone() for q in queries]
+                for q in queries:
+                    if self._order:
+                        q.order = list(self._order)
+                    if self._distinct:
+                        projection = list(self._projection or ())
+                        q.projection = projection + [name for name in self._distinct if name not in projection]
+                        q.group_by = list(self._distinct)
+                    elif self._projection:
+                        q.projection = self._projection
+            self._prepared_queries = queries
+        return self._prepared_queries
+
+    def _unique(self, results):
+        """Yield the first of ``results`` with each combination of values of the distinct properties."""
+        if self._properties is None:
+            def distinct_values(entity):
+                return tuple(entity._data.get(name) for name in self._distinct)
+        elif self._row_type == rows.DICT:
+            def distinct_values(row):
+                return tuple(row.get(name) for name in self._distinct)
+        elif self._row_type == rows.FLAT:
+            def distinct_values(value):
+                return value
+        elif all(name in self._properties for name in self._distinct):
+            positions = [self._properties.index(name) for name in self._distinct]
+
+            def distinct_values(row):
+                return tuple(row[position] for position in positions)
+        else:  # Not all of the distinct values are in the rows. Compare the whole row instead.
+            distinct_values = tuple
+        seen = set()
+        for result in results:
+            values = distinct_values(result)
+            try:
+                hash(values)
+            except TypeError:
+                values = repr(values)
+            if values not in seen:
+                seen.add(values)
+                yield result
+
+    def _key_lookup(self):
+        """
+        If this queryset is nothing more than a lookup of a single entity by key, return that key.
+
+        :rtype: :class:`~gcloudoem.key.Key` or None
+        """
+        if len(self._queries) != 1 or self._projection or self._properties is not None:
+            return None
+        filters = self._queries[0].filters
+        if len(filters) != 1:
+            return None
+        name, operator, value = filters[0]
+        if name != 'key' or operator not in ('=', 'eq'):
+            return None
+        return value
+
     def _fetch_all(self):
         """
         Evaluates this query set and populates the cache. Does nothing is the cache is already populated.
@@ -368,6 +601,8 @@ class QuerySet(object):
         """
         if not self._result_cache:
             self._result_cache = list(self.iterator())
+            if self._prefetch_related and self._properties is None:
+                prefetch_related_objects(self._result_cache, *self._prefetch_related)
 
     def _has_filters(self):
         """
@@ -431,18 +666,35 @@ class QuerySet(object):
             # Datastore doesn't support OR queries. To do OR queries, you need to do separate queries.
             # So each AND filter gets applied to every query. Each OR filter (only the in operator) creates a new query.
             if f[1] == 'in':
-                existing_filters = clone._queries[0].filters() if clone._queries else []
-                clone._queries = clone._queries + [
-                    Query(self.entity, filters=existing_filters + [(f[0], 'eq', value,)]) for value in f[2]
+                clone._queries = [
+                    Query(self.entity, filters=existing_filters + [(f[0], 'eq', value,)])
+                    for existing_filters in ([q.filters for q in clone._queries] or [[]]) for value in f[2]
                 ]
             else:
                 if clone._queries:
+                    # The queries are shared with the QuerySet this was cloned from, so filter copies of them.
+                    clone._queries = [q.clone() for q in clone._queries]
                     for q in clone._queries:
                         q.add_filter(*f)
                 else:
                     clone._queries.append(Query(self.entity, filters=[f]))
         return clone
 
+    def _write(self, operation, entities):
+        """
+        Call the ``operation`` method (eg. ``put``) of the current transaction for each of ``entities``. If there isn't
+        a current transaction, do it in transactions of 25 entities (the limit for ancestor-less transactions).
+        """
+        txn = Transaction.current()
+        if txn is not None:
+            for entity in entities:
+                getattr(txn, operation)(entity)
+            return
+        for chunk in self._chunk(entities, 25):
+            with Transaction(Transaction.SNAPSHOT) as txn:
+                for entity in chunk:
+                    getattr(txn, operation)(entity)
+
     @staticmethod
     def _chunk(items, size):
         """Yield successive n-sized chunks from l."""
@@ -0,0 +1,297 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Aggregates, computed client side as a query's results stream in. See :meth:`~gcloudoem.queryset.QuerySet.aggregate`
+and :meth:`~gcloudoem.queryset.QuerySet.annotate`.
+
+Only the properties being aggregated (and grouped by) are fetched, with a projection query for each aggregated property,
+or a keys-only query for aggregates without one (like ``Count()``). No entities are constructed. The results are read
+into typed columns (see :mod:`gcloudoem.queryset.columns`) a chunk at a time, and each chunk is folded into the
+aggregates, with NumPy if it's installed. So memory use doesn't grow with the number of results, only with the number of
+groups.
+
+As with any projection query, the properties must be indexed. An entity without a value for a property isn't counted by
+the aggregates of that property (nor in any group, if it has no value for a property being grouped by), and a list
+property gives a value for each of its values. Since each property has its own query, that doesn't affect the
+aggregates of other properties.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import itertools
+
+from six.moves import range
+
+from . import rows
+from .columns import Column
+
+
+# How many results are read into columns before they are folded into the aggregates
+CHUNK_SIZE = 1000
+
+
+class Aggregate(object):
+    """
+    An aggregate of the values of a property.
+
+    Subclasses implement :meth:`add`, and :meth:`start` and :meth:`finish` if the default state (None) won't do.
+    """
+    name = None  # Used in the default alias, eg. "amount__sum"
+
+    def __init__(self, property=None):
+        """
+        :param str property: The name of the property to aggregate.
+        """
+        self.property = property
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, repr(self.property) if self.property is not None else '')
+
+    @property
+    def default_alias(self):
+        if self.property is None:
+            raise TypeError('%r must be given an alias' % self)
+        return '%s__%s' % (self.property, self.name)
+
+    def start(self):
+        """The state before any values have been added."""
+        return None
+
+    def add(self, state, values):
+        """
+        Add a chunk of values.
+
+        :param state: The state so far.
+        :param values: The values that aren't missing, from :meth:`~gcloudoem.queryset.columns.Column.present`. For
+            an aggregate without a property, a sequence as long as the chunk of results.
+        :returns: The new state.
+        """
+        raise NotImplementedError
+
+    def finish(self, state, column):
+        """
+        :param column: The :class:`~gcloudoem.queryset.columns.Column` of the property, or None.
+        :returns: The aggregate, from the final state.
+        """
+        return _to_python(state, column)
+
+
+class Count(Aggregate):
+    """The number of results, or of values of ``property`` if given."""
+    name = 'count'
+
+    @property
+    def default_alias(self):
+        return 'count' if self.property is None else super(Count, self).default_alias
+
+    def start(self):
+        return 0
+
+    def add(self, state, values):
+        return state + len(values)
+
+
+class Sum(Aggregate):
+    """The sum of the values of ``property``."""
+    name = 'sum'
+
+    def start(self):
+        return 0
+
+    def add(self, state, values):
+        return state + (values.sum() if hasattr(values, 'sum') else sum(values))
+
+
+class Avg(Aggregate):
+    """The mean of the values of ``property``, or None if there aren't any."""
+    name = 'avg'
+
+    def start(self):
+        return 0, 0
+
+    def add(self, state, values):
+        total, count = state
+        return total + (values.sum() if hasattr(values, 'sum') else sum(values)), count + len(values)
+
+    def finish(self, state, column):
+        total, count = state
+        return _to_python(total / count, None) if count else None
+
+
+class Min(Aggregate):
+    """The smallest value of ``property``, or None if there aren't any."""
+    name = 'min'
+    _reduce = staticmethod(min)
+
+    def add(self, state, values):
+        if not len(values):
+            return state
+        value = getattr(values, self.name)() if hasattr(values, self.name) else self._reduce(values)
+        return value if state is None else self._reduce(state, value)
+
+
+class Max(Min):
+    """The largest value of ``property``, or None if there aren't any."""
+    name = 'max'
+    _reduce = staticmethod(max)
+
+
+def aliased(args, kwargs):
+    """
+    The aggregates passed to :meth:`~gcloudoem.queryset.QuerySet.aggregate` or
+    :meth:`~gcloudoem.queryset.QuerySet.annotate`, by alias.
+
+    :rtype: :class:`~collections.OrderedDict`
+    """
+    aggregates = collections.OrderedDict()
+    for aggregate in args:
+        aggregates[aggregate.default_alias] = aggregate
+    aggregates.update(kwargs)
+    for alias, aggregate in aggregates.items():
+        if not isinstance(aggregate, Aggregate):
+            raise TypeError('%s is not an aggregate: %r' % (alias, aggregate))
+    return aggregates
+
+
+def aggregate(queryset, aggregates):
+    """
+    Evaluate ``aggregates`` over ``queryset``. See :meth:`~gcloudoem.queryset.QuerySet.aggregate`.
+
+    :rtype: dict
+    """
+    groups, columns = _evaluate(queryset, (), aggregates)
+    _, states = groups.get((), (None, None))
+    if states is None:  # There weren't any results
+        states = dict((alias, aggregate.start()) for alias, aggregate in aggregates.items())
+    return dict(
+        (alias, aggregate.finish(states[alias], columns.get(aggregate.property)))
+        for alias, aggregate in aggregates.items()
+    )
+
+
+def annotate(queryset):
+    """
+    Yield a row for each group of an annotated ``queryset``, with its aggregates. See
+    :meth:`~gcloudoem.queryset.QuerySet.annotate`.
+    """
+    names = list(queryset._properties)
+    aggregates = queryset._annotations
+    groups, columns = _evaluate(queryset, names, aggregates)
+
+    if queryset._row_type == rows.DICT:
+        def make_row(values):
+            return dict(zip(names + list(aggregates), values))
+    elif queryset._row_type == rows.NAMED:
+        make_row = collections.namedtuple('Row', names + list(aggregates))._make
+    else:
+        make_row = tuple
+    for values, states in groups.values():
+        results = [
+            aggregate.finish(states[alias], columns.get(aggregate.property)) for alias, aggregate in aggregates.items()
+        ]
+        yield make_row(list(values) + results)
+
+
+def _evaluate(queryset, group_by, aggregates):
+    """
+    Stream the results of ``queryset`` into ``aggregates``, for each combination of the values of ``group_by``.
+
+    Each aggregated property is fetched with its own query (along with ``group_by``), so that an entity without a
+    value for one property (or with several values for a list property) doesn't change the aggregates of the others.
+
+    :returns: An :class:`~collections.OrderedDict` of group to ``(values, states)``, in the order the groups were
+        first seen, and the columns of the aggregated properties, by name.
+    """
+    by_property = collections.OrderedDict()
+    for alias, aggregate in aggregates.items():
+        by_property.setdefault(aggregate.property, collections.OrderedDict())[alias] = aggregate
+    columns = dict((name, Column(queryset.entity, name)) for name in by_property if name is not None)
+    getters = [rows.value_getter(queryset.entity, name) for name in group_by]
+    groups = collections.OrderedDict()
+
+    for name, property_aggregates in by_property.items():
+        properties = list(group_by)
+        if name is not None and name not in properties:
+            properties.append(name)
+        column = columns.get(name)
+        chunk = []  # The group of each result in the chunk, when grouping
+        size = 0
+        for pb in _protobufs(queryset, properties):
+            if column is not None:
+                column.append(pb)
+            if getters:
+                chunk.append(tuple([get(pb) for get in getters]))
+            size += 1
+            if size == CHUNK_SIZE:
+                _fold(groups, chunk, size, column, property_aggregates, aggregates)
+                chunk, size = [], 0
+        if size:
+            _fold(groups, chunk, size, column, property_aggregates, aggregates)
+    return groups, columns
+
+
+def _fold(groups, chunk, size, column, aggregates, all_aggregates):
+    """
+    Add a chunk of results to the states of ``aggregates`` (which all aggregate the property of ``column``) for their
+    groups, then empty the column for the next chunk. New groups start with the state of all of the aggregates.
+    """
+    if chunk:
+        positions = collections.OrderedDict()
+        for position, values in enumerate(chunk):
+            positions.setdefault(_hashable(values), (values, []))[1].append(position)
+    else:
+        positions = {(): ((), None)}  # Not grouping. Add all of the results.
+
+    for group, (values, group_positions) in positions.items():
+        if group not in groups:
+            groups[group] = values, dict((alias, aggregate.start()) for alias, aggregate in all_aggregates.items())
+        states = groups[group][1]
+        count = size if group_positions is None else len(group_positions)
+        present = range(count) if column is None else column.present(group_positions)
+        for alias, aggregate in aggregates.items():
+            states[alias] = aggregate.add(states[alias], present)
+
+    if column is not None:
+        column.clear()
+
+
+def _protobufs(queryset, properties):
+    """Yield the entity protobufs for ``queryset``, with just ``properties`` projected."""
+    projection = tuple(name for name in properties if name != 'key')
+    if not projection and not queryset._distinct:
+        projection = '__key__'
+    queryset = queryset._clone(_properties=None, _row_type=None, _projection=projection or None)
+    queries = queryset._get_prepared_queries()
+    results = itertools.chain(*[query(row_factory=_protobuf) for query in queries])
+    if not (queryset._distinct and len(queries) > 1):
+        return results
+    # Each query is distinct, but they can overlap
+    getters = [rows.value_getter(queryset.entity, name) for name in queryset._distinct]
+    return _unique(results, getters)
+
+
+def _unique(pbs, getters):
+    seen = set()
+    for pb in pbs:
+        values = _hashable(tuple([get(pb) for get in getters]))
+        if values not in seen:
+            seen.add(values)
+            yield pb
+
+
+def _protobuf(pb):
+    return pb
+
+
+def _hashable(values):
+    try:
+        hash(values)
+    except TypeError:
+        return repr(values)
+    return values
+
+
+def _to_python(value, column):
+    if column is not None:
+        return column.to_python(value)
+    return value.item() if hasattr(value, 'item') else value
@@ -0,0 +1,172 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Detection of N+1 query patterns.
+
+Reading a :class:`~gcloudoem.properties.ReferenceProperty` (or a ``ListProperty`` of them) that hasn't been fetched yet
+makes an RPC for every entity referenced. Doing that in a loop makes one query per iteration, which is easy to miss::
+
+    >>> for book in Book.objects.all():
+    ...     print(book.author.name)  # One query per book!
+
+While a :class:`NPlusOneDetector` is active, each of those fetches is counted against the code that triggered it. Once
+the same line of code has fetched the same property more than ``threshold`` times, the detector warns (or raises) with
+the stack and the :meth:`~gcloudoem.queryset.QuerySet.prefetch_related` call that would fetch them all at once::
+
+    >>> with NPlusOneDetector(threshold=5):
+    ...     handle_request()
+    NPlusOneWarning: Book.author was fetched one entity at a time 6 times from views.py:12 in book_list. Use
+    Book.objects.prefetch_related('author') to fetch them in a single RPC.
+
+Detectors are local to the current thread (or asyncio task), so one can wrap each request of a web application. When no
+detector is active, the cost is a single lookup per fetch.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import traceback
+import warnings
+
+from ..datastore.connection import get_connection
+from ..datastore.profiler import caller_site
+from ..datastore.transaction import Transaction
+from ..datastore.utils import _resource_stack
+from ..exceptions import NPlusOneError, NPlusOneWarning
+from ..key import Key
+
+
+_DETECTORS = _resource_stack('gcloudoem_nplusone_detectors')
+
+_MAX_LOOKUP_KEYS = 1000  # The most keys Datastore allows in a single lookup
+
+
+def record_fetch(instance, prop):
+    """
+    Called by a property before it fetches a referenced entity on its own.
+
+    :param instance: The :class:`~gcloudoem.entity.Entity` the property is being read from.
+    :param prop: The property being read.
+    """
+    detector = _DETECTORS.top
+    if detector is not None:
+        detector.record(type(instance), prop.name)
+
+
+class NPlusOneDetector(object):
+    """
+    Counts the entities fetched one at a time by each line of code, while used as a context manager.
+
+    :ivar int threshold: How many single entity fetches a line of code can make before it's reported.
+    :ivar bool raise_error: Raise :class:`~gcloudoem.exceptions.NPlusOneError` rather than warning with
+        :class:`~gcloudoem.exceptions.NPlusOneWarning`.
+    """
+    def __init__(self, threshold=5, raise_error=False):
+        """
+        :param int threshold: How many single entity fetches a line of code can make before it's reported.
+        :param bool raise_error: Raise :class:`~gcloudoem.exceptions.NPlusOneError` rather than warning.
+        """
+        self.threshold = threshold
+        self.raise_error = raise_error
+        self._counts = {}
+
+    def __enter__(self):
+        _DETECTORS.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _DETECTORS.pop()
+
+    def record(self, entity_cls, name):
+        """
+        Count a fetch of a referenced entity, reporting it if the calling line of code has done it too many times.
+
+        :param entity_cls: The class of the entity the reference is read from.
+        :param str name: The name of the property.
+        """
+        site = caller_site()
+        key = (site, entity_cls, name)
+        count = self._counts[key] = self._counts.get(key, 0) + 1
+        if count == self.threshold + 1:  # Only report each line once
+            message = (
+                "%(kind)s.%(name)s was fetched one entity at a time %(count)d times from %(site)s. Use "
+                "%(cls)s.objects.prefetch_related('%(name)s') to fetch them in a single RPC.\n%(stack)s" % {
+                    'kind': entity_cls._meta.kind, 'cls': entity_cls.__name__, 'name': name, 'count': count,
+                    'site': site, 'stack': ''.join(traceback.format_stack()[:-2]),
+                }
+            )
+            if self.raise_error:
+                raise NPlusOneError(message)
+            warnings.warn(message, NPlusOneWarning, stacklevel=4)
+
+    def report(self):
+        """
+        :rtype: list of tuple
+        :returns: A ``(site, entity class, property name, count)`` tuple for each line of code that fetched referenced
+            entities one at a time, most fetches first.
+        """
+        return sorted(
+            ((site, entity_cls, name, count) for (site, entity_cls, name), count in self._counts.items()),
+            key=lambda item: item[3], reverse=True
+        )
+
+
+def prefetch_related_objects(entities, *names):
+    """
+    Fetch the entities referenced by the properties ``names`` of each of ``entities`` in as few RPCs as possible.
+
+    Each of ``names`` must be a :class:`~gcloudoem.properties.ReferenceProperty` or a ``ListProperty`` of them. The
+    referenced entities are looked up by key, in batches, and set on ``entities`` so that reading the properties doesn't
+    make any more RPCs. References to entities that don't exist are left as they are.
+
+    :param list entities: :class:`~gcloudoem.entity.Entity` instances, all of the same class.
+    :param names: Names of properties of ``entities``.
+    """
+    if not entities:
+        return
+    from ..properties import ListProperty, ReferenceProperty
+
+    entity_cls = type(entities[0])
+    for name in names:
+        prop = entity_cls._properties.get(name)
+        if isinstance(prop, ReferenceProperty):
+            target_cls, repeated = prop.entity_cls, False
+        elif isinstance(prop, ListProperty) and isinstance(prop.property, ReferenceProperty):
+            target_cls, repeated = prop.property.entity_cls, True
+        else:
+            raise ValueError("%s.%s isn't a ReferenceProperty or a ListProperty of them" % (entity_cls.__name__, name))
+
+        keys = set()
+        for entity in entities:
+            value = entity._data.get(name)
+            for item in (value or ()) if repeated else (value,):
+                if isinstance(item, Key):
+                    keys.add(item)
+        fetched = _lookup(target_cls, keys)
+        for entity in entities:
+            value = entity._data.get(name)
+            if repeated and value:
+                entity._data[name] = [fetched.get(item, item) if isinstance(item, Key) else item for item in value]
+            elif isinstance(value, Key) and value in fetched:
+                entity._data[name] = fetched[value]
+
+
+def _lookup(entity_cls, keys):
+    """
+    Look up entities by key.
+
+    :rtype: dict
+    :returns: The entities found, by key.
+    """
+    connection = get_connection()
+    transaction = Transaction.current()
+    transaction_id = getattr(transaction, 'id', None)
+    key_pbs = [key.to_protobuf(connection.dataset, connection.namespace) for key in keys]
+    fetched = {}
+    while key_pbs:
+        batch, key_pbs = key_pbs[:_MAX_LOOKUP_KEYS], key_pbs[_MAX_LOOKUP_KEYS:]
+        found, _, deferred = connection.lookup(batch, transaction_id=transaction_id, entity_results=True)
+        for result in found:
+            entity = entity_cls.from_protobuf(result.entity)
+            entity._version = result.version or None
+            fetched[entity.key] = entity
+        key_pbs.extend(deferred)
+    return fetched
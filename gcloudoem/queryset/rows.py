@@ -0,0 +1,69 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+"""
+Lightweight rows for :meth:`~gcloudoem.queryset.QuerySet.values` and :meth:`~gcloudoem.queryset.QuerySet.values_list`.
+
+Rows are built straight from the entity protobufs in query results. Only the requested properties are decoded, and no
+:class:`~gcloudoem.entity.Entity` is constructed or validated.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+
+from ..exceptions import InvalidQueryError
+
+
+DICT = 'dict'
+TUPLE = 'tuple'
+FLAT = 'flat'
+NAMED = 'named'
+
+
+def row_factory(entity_cls, names, row_type):
+    """
+    Make a function that builds a row from an entity protobuf.
+
+    :param entity_cls: The :class:`~gcloudoem.entity.Entity` class the protobufs are for.
+    :param names: The names of the properties in each row. ``key`` is the entity's key.
+    :param str row_type: :data:`DICT`, :data:`TUPLE`, :data:`FLAT` (just the value of the first property) or
+        :data:`NAMED` (a :func:`~collections.namedtuple`).
+    :raises: :class:`~gcloudoem.exceptions.InvalidQueryError` if the entity doesn't have one of the properties.
+    """
+    names = tuple(names)
+    getters = [value_getter(entity_cls, name) for name in names]
+
+    if row_type == FLAT:
+        getter, = getters
+        return getter
+    if row_type == DICT:
+        return lambda pb: dict(zip(names, [getter(pb) for getter in getters]))
+    if row_type == NAMED:
+        row_cls = collections.namedtuple('Row', names)
+        return lambda pb: row_cls(*[getter(pb) for getter in getters])
+    return lambda pb: tuple([getter(pb) for getter in getters])
+
+
+def value_getter(entity_cls, name):
+    """A function that decodes the value of property ``name`` from an entity protobuf."""
+    from ..properties import KeyProperty, ListProperty
+
+    prop = entity_cls._properties.get(name)
+    if prop is None:
+        raise InvalidQueryError("Entity %s doesn't have a property %s" % (entity_cls._meta.kind, name))
+    if isinstance(prop, KeyProperty):
+        return lambda pb: prop.from_protobuf(pb.key)
+
+    db_name = prop.db_name
+    from_protobuf = prop.from_protobuf
+    item_from_protobuf = prop.property.from_protobuf if isinstance(prop, ListProperty) else None
+
+    def get(pb):
+        properties = pb.properties
+        if db_name not in properties:
+            return None
+        value_pb = properties[db_name]
+        # A projection of a list property has a row for each item, with just that item as the value.
+        if item_from_protobuf is not None and value_pb.WhichOneof('value_type') != 'array_value':
+            return item_from_protobuf(value_pb)
+        return from_protobuf(value_pb)
+    return get
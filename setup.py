@@ -27,6 +27,7 @@ if sys.version_info >= (3, 0):
 else:
     install_requires = [
         "future",
+        "futures",
         'httplib2 >= 0.9.1',
         'googleapis-common-protos >= 1.3.4',
         'grpcio >= 1.0.0, < 2.0dev',
@@ -61,7 +62,7 @@ setup(
         'Topic :: Database',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
-    packages=find_packages(exclude=["tests*", "docs*"]),
+    packages=find_packages(exclude=["tests*", "docs*", "benchmarks*"]),
     install_requires=install_requires,
     extras_require={
         'dev': ['sphinx', 'sphinx_rtd_theme'],
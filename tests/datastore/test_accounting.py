@@ -0,0 +1,116 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import httplib2
+import unittest2
+
+from gcloudoem import Entity, TextProperty
+from gcloudoem.datastore import Connection, instrumentation
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore._generated import entity_pb2 as entity_pb
+from gcloudoem.datastore._generated import query_pb2 as query_pb
+from gcloudoem.datastore.accounting import CostAccountant
+from gcloudoem.datastore.utils import BoundedExecutor
+from gcloudoem.exceptions import BadRequest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class Http(object):
+    def __init__(self, *responses):
+        self._responses = list(responses)
+
+    def request(self, **kw):
+        status, response = self._responses.pop(0)
+        content = response.SerializeToString() if hasattr(response, 'SerializeToString') else response
+        return httplib2.Response({'status': str(status)}), content
+
+
+def _key(kind, id):
+    key = entity_pb.Key()
+    key.path.add(kind=kind, id=id)
+    return key
+
+
+class TestCostAccountant(unittest2.TestCase):
+    def _make_connection(self, *responses):
+        connection = Connection('DATASET', 'TEST')
+        connection._http = Http(*responses)
+        return connection
+
+    def test_operations(self):
+        lookup = datastore_pb.LookupResponse()
+        lookup.found.add().entity.key.CopyFrom(_key('Person', 1))
+        lookup.missing.add().entity.key.CopyFrom(_key('Person', 2))
+        lookup.deferred.add().CopyFrom(_key('Person', 3))
+        query = datastore_pb.RunQueryResponse()
+        for id in range(3):
+            query.batch.entity_results.add().entity.key.CopyFrom(_key('Person', id + 1))
+        commit = datastore_pb.CommitResponse(index_updates=6)
+        connection = self._make_connection((200, lookup), (200, query), (200, query), (200, commit))
+
+        with CostAccountant() as accountant:
+            connection.lookup([_key('Person', 1), _key('Person', 2), _key('Person', 3)])
+            query_request = query_pb.Query()
+            query_request.kind.add(name='Person')
+            connection.run_query(query_request)
+            query_request.projection.add().property.name = '__key__'
+            connection.run_query(query_request)
+            request = datastore_pb.CommitRequest()
+            request.mutations.add().upsert.key.CopyFrom(_key('Person', 1))
+            request.mutations.add().insert.key.CopyFrom(_key('Pet', 1))
+            request.mutations.add().delete.CopyFrom(_key('Pet', 2))
+            connection.commit(request)
+        self.assertFalse(instrumentation.has_listeners())
+
+        self.assertEqual(accountant.total.to_dict(), {
+            'entity_reads': 2 + 4 + 1, 'small_ops': 3, 'entity_writes': 2, 'entity_deletes': 1, 'index_writes': 6,
+            'rpcs': 4,
+        })
+        self.assertEqual(accountant.by_kind['Person'].to_dict(), {
+            'entity_reads': 7, 'small_ops': 3, 'entity_writes': 1, 'entity_deletes': 0, 'index_writes': 0, 'rpcs': 4,
+        })
+        self.assertEqual((accountant.by_kind['Pet'].entity_writes, accountant.by_kind['Pet'].entity_deletes), (1, 1))
+        self.assertEqual(accountant.by_kind[None].index_writes, 6)
+        self.assertEqual(len(accountant.by_caller), 4)
+        for caller, usage in accountant.by_caller.items():
+            self.assertIn('test_accounting.py', caller)
+            self.assertIn('in test_operations', caller)
+            self.assertEqual(usage.rpcs, 1)
+        self.assertAlmostEqual(accountant.cost(), 7 * 0.06e-5 + 2 * 0.18e-5 + 0.02e-5)
+
+    def test_nested_and_errors(self):
+        commit = datastore_pb.CommitResponse(index_updates=4)
+        connection = self._make_connection((200, commit), (400, b'bad'), (200, commit))
+        request = datastore_pb.CommitRequest()
+        request.mutations.add().upsert.key.CopyFrom(_key('Person', 1))
+        with CostAccountant() as outer:
+            with CostAccountant(prices={'entity_writes': 1.0}) as inner:
+                connection.commit(request)
+                self.assertRaises(BadRequest, connection.commit, request)
+            connection.commit(request)
+        connection._http = Http((200, commit))
+        connection.commit(request)
+
+        self.assertEqual((inner.total.entity_writes, inner.total.rpcs), (1, 1))
+        self.assertEqual(inner.by_kind['Person'].index_writes, 4)
+        self.assertEqual(inner.cost(), 1.0)
+        self.assertEqual((outer.total.entity_writes, outer.total.index_writes), (2, 8))
+
+    def test_async_rpcs(self):
+        class Person(Entity):
+            name = TextProperty()
+
+        connection = self._make_connection((200, datastore_pb.CommitResponse(index_updates=2)))
+        executor = BoundedExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            with CostAccountant() as accountant:
+                Person(key=1, name='Alice').save_async(executor=executor).result(5)
+        self.assertEqual((accountant.total.entity_writes, accountant.total.rpcs), (1, 1))
+        self.assertEqual(accountant.by_kind['Person'].index_writes, 2)
@@ -0,0 +1,71 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+import unittest2
+
+from gcloudoem import Entity, Key
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore.allocator import IdAllocator
+from gcloudoem.exceptions import ServiceUnavailable
+
+
+class TestIdAllocator(unittest2.TestCase):
+    class TestEntity(Entity):
+        pass
+
+    def _make_connection(self):
+        counter = [0]
+
+        def allocate_ids(key_pbs):
+            result = []
+            for key_pb in key_pbs:
+                counter[0] += 1
+                result.append(Key(key_pb.path[0].kind, value=counter[0]).to_protobuf('DATASET', 'TEST'))
+            return result
+
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        connection.allocate_ids.side_effect = allocate_ids
+        return connection
+
+    def test_next_id_fetches_blocks(self):
+        connection = self._make_connection()
+        allocator = IdAllocator('Kind', block_size=3, connection=connection, prefetch=False)
+        self.assertEqual([allocator.next_id() for _ in range(4)], [1, 2, 3, 4])
+        self.assertEqual(connection.allocate_ids.call_count, 2)
+        key_pbs = connection.allocate_ids.call_args[0][0]
+        self.assertEqual(len(key_pbs), 3)
+        self.assertEqual(key_pbs[0].path[0].kind, 'Kind')
+        self.assertFalse(key_pbs[0].path[0].id)
+        self.assertEqual(allocator.available, 2)
+
+    def test_prefetch(self):
+        connection = self._make_connection()
+        allocator = IdAllocator('Kind', block_size=4, low_water_mark=3, connection=connection)
+        self.assertEqual(allocator.next_id(), 1)
+        self.assertEqual([allocator.next_id() for _ in range(7)], [2, 3, 4, 5, 6, 7, 8])
+        self.assertGreaterEqual(connection.allocate_ids.call_count, 2)
+
+    def test_assign(self):
+        connection = self._make_connection()
+        allocator = IdAllocator(self.TestEntity._meta.kind, block_size=2, connection=connection, prefetch=False)
+        entity = self.TestEntity()
+        self.assertIs(allocator.assign(entity), entity.key)
+        self.assertEqual(entity.key.id, 1)
+        allocator.assign(entity)  # Already complete, so nothing changes
+        self.assertEqual(entity.key.id, 1)
+        self.assertRaises(ValueError, IdAllocator('Other', connection=connection).assign, self.TestEntity())
+        self.assertRaises(ValueError, allocator.assign, self.TestEntity(key=(entity, None)))
+
+    def test_fetch_error(self):
+        connection = self._make_connection()
+        connection.allocate_ids.side_effect = ServiceUnavailable('down')
+        allocator = IdAllocator('Kind', connection=connection)
+        self.assertRaises(ServiceUnavailable, allocator.next_id)
@@ -0,0 +1,125 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+import httplib2
+import unittest2
+
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore._generated import entity_pb2 as entity_pb
+from gcloudoem.datastore.connection import Connection
+from gcloudoem.datastore.fakeserver import FakeDatastoreServer, FaultInjector
+from gcloudoem.datastore.memory import InMemoryDatastore
+from gcloudoem.datastore.retry import RetryPolicy
+from gcloudoem.exceptions import NotFound, ServiceUnavailable, TooManyRequests
+
+try:
+    import grpc
+    from gcloudoem.datastore._generated import datastore_grpc_pb2
+except ImportError:
+    grpc = None
+
+
+def _key(name):
+    key = entity_pb.Key()
+    key.partition_id.project_id = 'project'
+    key.partition_id.namespace_id = 'default'
+    key.path.add(kind='Person', name=name)
+    return key
+
+
+def _upsert(name, age):
+    request = datastore_pb.CommitRequest()
+    entity = request.mutations.add().upsert
+    entity.key.CopyFrom(_key(name))
+    entity.properties['age'].integer_value = age
+    return request
+
+
+class TestFakeDatastoreServer(unittest2.TestCase):
+    def setUp(self):
+        self.store = InMemoryDatastore()
+        self.faults = FaultInjector(seed=1)
+        self.server = FakeDatastoreServer(self.store, faults=self.faults).start()
+        self.addCleanup(self.server.stop)
+        self.connection = self._connection()
+
+    def _connection(self, **kwargs):
+        kwargs.setdefault('retry_policy', RetryPolicy(max_attempts=1))
+        return Connection('project', 'default', http=httplib2.Http(), api_base_url=self.server.http_url, **kwargs)
+
+    def test_round_trip(self):
+        self.connection.commit(_upsert('alice', 30))
+        found, missing, deferred = self.connection.lookup([_key('alice'), _key('bob')])
+        self.assertEqual([entity.properties['age'].integer_value for entity in found], [30])
+        self.assertEqual(len(missing), 1)
+        self.assertEqual(len(self.store), 1)
+
+    def test_store_errors(self):
+        request = datastore_pb.CommitRequest()
+        request.mutations.add().update.key.CopyFrom(_key('nobody'))
+        with self.assertRaises(NotFound):
+            self.connection.commit(request)
+
+    def test_unknown_method(self):
+        response, content = httplib2.Http().request(self.server.http_url + '/v1/projects/project:nope', method='POST')
+        self.assertEqual(response.status, 404)
+
+    def test_injected_errors(self):
+        self.faults.error_rate = 1.0
+        with self.assertRaises(ServiceUnavailable):
+            self.connection.lookup([_key('alice')])
+        self.assertEqual(self.faults.stats(), {'requests': 1, 'errors': 1, 'throttled': 0})
+
+    def test_retries_injected_errors(self):
+        self.faults.error_rate = 0.5
+        connection = self._connection(retry_policy=RetryPolicy(max_attempts=20, initial_delay=0))
+        for _ in range(10):
+            connection.lookup([_key('alice')])
+        stats = self.faults.stats()
+        self.assertGreater(stats['errors'], 0)
+        self.assertEqual(stats['requests'], stats['errors'] + 10)
+
+    def test_only_faults_methods(self):
+        self.faults.error_rate = 1.0
+        self.faults.methods = frozenset(['commit'])
+        self.connection.lookup([_key('alice')])
+        with self.assertRaises(ServiceUnavailable):
+            self.connection.commit(_upsert('alice', 30))
+
+    def test_throttling(self):
+        self.server.faults = FaultInjector(throttle_rate=1, throttle_burst=2)
+        self.connection.lookup([_key('alice')])
+        self.connection.lookup([_key('alice')])
+        with self.assertRaises(TooManyRequests):
+            self.connection.lookup([_key('alice')])
+        self.assertEqual(self.server.faults.stats()['throttled'], 1)
+
+    def test_latency(self):
+        self.faults.latency = 0.05
+        started = time.time()
+        self.connection.lookup([_key('alice')])
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+
+@unittest2.skipIf(grpc is None, 'grpcio is not installed')
+class TestFakeDatastoreServerGrpc(unittest2.TestCase):
+    def test_round_trip(self):
+        faults = FaultInjector()
+        with FakeDatastoreServer(grpc_port=0, faults=faults) as server:
+            channel = grpc.insecure_channel(server.grpc_target)
+            self.addCleanup(channel.close)
+            stub = datastore_grpc_pb2.DatastoreStub(channel)
+            request = _upsert('alice', 30)
+            request.project_id = 'project'
+            request.mode = datastore_pb.CommitRequest.NON_TRANSACTIONAL
+            stub.Commit(request)
+            response = stub.Lookup(datastore_pb.LookupRequest(project_id='project', keys=[_key('alice')]))
+            self.assertEqual(len(response.found), 1)
+
+            faults.error_rate = 1.0
+            with self.assertRaises(grpc.RpcError) as context:
+                stub.Lookup(datastore_pb.LookupRequest(project_id='project', keys=[_key('alice')]))
+            self.assertEqual(context.exception.code(), grpc.StatusCode.UNAVAILABLE)
@@ -0,0 +1,138 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+import httplib2
+import unittest2
+
+from gcloudoem.datastore import Connection, instrumentation
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore.hedging import HedgingPolicy, LatencyTracker
+from gcloudoem.exceptions import ServiceUnavailable
+
+
+class TestLatencyTracker(unittest2.TestCase):
+    def test_percentile(self):
+        tracker = LatencyTracker(window=100)
+        self.assertIsNone(tracker.percentile('lookup', 95))
+        for i in range(200):
+            tracker.record('lookup', i % 100 / 100.0)
+        self.assertEqual(tracker.count('lookup'), 100)
+        self.assertEqual(tracker.percentile('lookup', 50), 0.49)
+        self.assertEqual(tracker.percentile('lookup', 95), 0.94)
+        self.assertEqual(tracker.percentile('lookup', 100), 0.99)
+        self.assertEqual(tracker.count('runQuery'), 0)
+
+
+class TestHedgingPolicy(unittest2.TestCase):
+    def _make_policy(self, latency=0.001, **kwargs):
+        tracker = LatencyTracker()
+        for _ in range(20):
+            tracker.record('lookup', latency)
+        return HedgingPolicy(tracker=tracker, max_hedge_ratio=1, **kwargs)
+
+    def test_no_hedge_until_samples(self):
+        policy = HedgingPolicy(min_samples=2)
+        self.assertIsNone(policy.delay('lookup'))
+        self.assertIsNone(policy.delay('commit'))
+        self.assertEqual(policy.call('lookup', lambda: 'OK'), 'OK')
+        self.assertIs(policy.call('lookup', threading.current_thread), threading.current_thread())
+        self.assertEqual(policy.stats(), {'requests': 2, 'hedged': 0, 'hedge_wins': 0})
+        self.assertEqual(policy.tracker.count('lookup'), 2)
+
+    def test_hedge_wins(self):
+        policy = self._make_policy()
+        release = threading.Event()
+        calls = []
+
+        def request():
+            calls.append(1)
+            if len(calls) == 1:  # The first request hangs
+                release.wait(5)
+                return 'SLOW'
+            return 'FAST'
+
+        self.assertEqual(policy.call('lookup', request), 'FAST')
+        release.set()
+        self.assertEqual(policy.stats(), {'requests': 1, 'hedged': 1, 'hedge_wins': 1})
+
+    def test_hedge_budget(self):
+        policy = self._make_policy()
+        policy.max_hedge_ratio = 0
+
+        def slow():
+            threading.Event().wait(0.05)
+            return 'SLOW'
+        self.assertEqual(policy.call('lookup', slow), 'SLOW')
+        self.assertEqual(policy.stats()['hedged'], 0)
+
+    def test_errors(self):
+        policy = self._make_policy()
+        calls = []
+
+        def request():
+            calls.append(1)
+            if len(calls) == 1:
+                threading.Event().wait(0.05)
+                raise ServiceUnavailable('slow and broken')
+            return 'OK'
+        self.assertEqual(policy.call('lookup', request), 'OK')
+
+        def broken():
+            threading.Event().wait(0.01)
+            raise ServiceUnavailable('broken')
+        self.assertRaises(ServiceUnavailable, policy.call, 'lookup', broken)
+
+    def test_connection_hedges_reads(self):
+        policy = MagicMock(spec=HedgingPolicy)
+        policy.METHODS = HedgingPolicy.METHODS
+        policy.call.side_effect = lambda method, request: request()
+        connection = Connection('DATASET', 'TEST', hedging_policy=policy)
+        connection._request = MagicMock(return_value=datastore_pb.LookupResponse().SerializeToString())
+        connection._http = MagicMock()  # Can't be shared between threads, so isn't hedged
+        connection._rpc('lookup', datastore_pb.LookupRequest(), datastore_pb.LookupResponse)
+        self.assertFalse(policy.call.called)
+
+        connection = Connection('DATASET', 'TEST', hedging_policy=policy)
+        connection._request = MagicMock(return_value=datastore_pb.LookupResponse().SerializeToString())
+        connection._rpc('lookup', datastore_pb.LookupRequest(), datastore_pb.LookupResponse)
+        connection._rpc('commit', datastore_pb.CommitRequest(), datastore_pb.CommitResponse)
+        self.assertEqual(policy.call.call_count, 1)
+        self.assertEqual(policy.call.call_args[0][0], 'lookup')
+        self.assertEqual(connection._request.call_count, 2)
+
+    def test_copies_have_their_own_http_and_attempts(self):
+        instances = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        class Http(object):
+            def __init__(self, timeout=None):
+                instances.append(self)
+
+            def request(self, **kwargs):
+                self.thread = threading.current_thread()
+                if self is instances[0]:  # The first request hangs
+                    release.wait(5)
+                return httplib2.Response({'status': '200'}), datastore_pb.LookupResponse().SerializeToString()
+
+        events = []
+        instrumentation.add_listener(events.append)
+        self.addCleanup(instrumentation.remove_listener, events.append)
+        policy = self._make_policy()
+        connection = Connection('DATASET', 'TEST', hedging_policy=policy)
+        with patch('gcloudoem.datastore.base.httplib2.Http', Http):
+            connection._rpc('lookup', datastore_pb.LookupRequest(), datastore_pb.LookupResponse)
+        release.set()
+
+        self.assertEqual(policy.stats()['hedge_wins'], 1)
+        self.assertEqual(len(instances), 2)
+        self.assertIsNot(instances[0].thread, instances[1].thread)
+        self.assertEqual((events[0].attempts, events[0].status), (1, 200))
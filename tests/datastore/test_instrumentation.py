@@ -0,0 +1,108 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import warnings
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+import httplib2
+import unittest2
+
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore.instrumentation import HistogramCollector, RpcEvent, has_listeners, listening
+from gcloudoem.exceptions import BadRequest
+
+
+class Http(object):
+    def __init__(self, *responses):
+        self._responses = list(responses)
+
+    def request(self, **kw):
+        status, content = self._responses.pop(0)
+        return httplib2.Response({'status': str(status)}), content
+
+
+@patch('gcloudoem.datastore.connection.time.sleep')
+class TestInstrumentation(unittest2.TestCase):
+    def _make_connection(self, *responses):
+        connection = Connection('DATASET', 'TEST')
+        connection._http = Http(*responses)
+        return connection
+
+    def test_rpc_event(self, sleep):
+        response = datastore_pb.LookupResponse()
+        response.found.add().entity.key.path.add(kind='Kind', id=1)
+        response.found.add().entity.key.path.add(kind='Kind', id=2)
+        content = response.SerializeToString()
+        connection = self._make_connection((503, b'busy'), (200, content))
+        request = datastore_pb.LookupRequest()
+        request.read_options.transaction = b'TXN'
+        events = []
+        with listening(events.append):
+            self.assertTrue(has_listeners())
+            connection._rpc('lookup', request, datastore_pb.LookupResponse)
+        self.assertFalse(has_listeners())
+
+        event, = events
+        self.assertEqual(event.method, 'lookup')
+        self.assertEqual((event.dataset, event.namespace), ('DATASET', 'TEST'))
+        self.assertEqual((event.attempts, event.retries, event.status), (2, 1, 200))
+        self.assertEqual(event.request_bytes, request.ByteSize())
+        self.assertEqual(event.response_bytes, len(content))
+        self.assertEqual(event.entity_count, 2)
+        self.assertEqual(event.transaction_id, b'TXN')
+        self.assertIsNone(event.error)
+        self.assertGreaterEqual(event.latency, 0)
+
+    def test_rpc_event_error(self, sleep):
+        connection = self._make_connection((400, b'bad'))
+        events = []
+        with listening(events.append):
+            self.assertRaises(BadRequest, connection._rpc, 'commit', datastore_pb.CommitRequest(),
+                              datastore_pb.CommitResponse)
+        self.assertIsInstance(events[0].error, BadRequest)
+        self.assertEqual(events[0].status, 400)
+        self.assertIsNone(events[0].response_pb)
+
+    def test_listener_errors_ignored(self, sleep):
+        connection = self._make_connection((200, b''))
+        listener = MagicMock(side_effect=ValueError('oops'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with listening(listener):
+                connection._rpc('rollback', datastore_pb.RollbackRequest(), datastore_pb.RollbackResponse)
+        self.assertTrue(listener.called)
+        self.assertEqual(len(caught), 1)
+
+
+class TestHistogramCollector(unittest2.TestCase):
+    def _event(self, method, latency, error=None):
+        event = RpcEvent(method, MagicMock(dataset='DATASET', namespace='TEST'), None)
+        event.latency = latency
+        event.attempts = 1
+        event.entity_count = 3
+        event.error = error
+        return event
+
+    def test_to_dict(self):
+        collector = HistogramCollector(buckets=(0.01, 0.1))
+        collector(self._event('runQuery', 0.005))
+        collector(self._event('runQuery', 0.05))
+        collector(self._event('runQuery', 0.5, error=BadRequest('x')))
+        collector(self._event('commit', 0.01))
+        stats = collector.to_dict()
+        self.assertEqual(set(stats), {'runQuery', 'commit'})
+        self.assertEqual(stats['runQuery']['count'], 3)
+        self.assertEqual(stats['runQuery']['errors'], 1)
+        self.assertEqual(stats['runQuery']['entities'], 9)
+        self.assertEqual(stats['runQuery']['latency_min'], 0.005)
+        self.assertEqual(stats['runQuery']['latency_max'], 0.5)
+        self.assertEqual(stats['runQuery']['histogram'], [(0.01, 1), (0.1, 1), (float('inf'), 1)])
+        self.assertEqual(stats['commit']['histogram'][0], (0.01, 1))
+        collector.reset()
+        self.assertEqual(collector.to_dict(), {})
@@ -0,0 +1,352 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest2
+
+from gcloudoem import Entity, IntegerProperty, TextProperty
+from gcloudoem.datastore import connection as connection_module
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore._generated import entity_pb2 as entity_pb
+from gcloudoem.datastore._generated import query_pb2 as query_pb
+from gcloudoem.datastore.memory import InMemoryConnection, InMemoryDatastore, connect_in_memory
+from gcloudoem.datastore.transaction import Transaction
+from gcloudoem.exceptions import BadRequest, Conflict, NotFound, VersionConflict
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+NS = 'default'
+_FILTER = query_pb.PropertyFilter
+
+
+def _key(*path):
+    key = entity_pb.Key()
+    key.partition_id.project_id = 'memory'
+    key.partition_id.namespace_id = NS
+    for kind, value in zip(path[::2], path[1::2]):
+        element = key.path.add(kind=kind)
+        if isinstance(value, int):
+            element.id = value
+        elif value is not None:
+            element.name = value
+    return key
+
+
+def _entity(key, **properties):
+    entity = entity_pb.Entity()
+    entity.key.CopyFrom(key)
+    for name, value in properties.items():
+        _set_value(entity.properties[name], value)
+    return entity
+
+
+def _set_value(value_pb, value):
+    if isinstance(value, list):
+        value_pb.array_value.SetInParent()
+        for item in value:
+            _set_value(value_pb.array_value.values.add(), item)
+    elif isinstance(value, bool):
+        value_pb.boolean_value = value
+    elif isinstance(value, int):
+        value_pb.integer_value = value
+    elif isinstance(value, float):
+        value_pb.double_value = value
+    elif isinstance(value, entity_pb.Key):
+        value_pb.key_value.CopyFrom(value)
+    else:
+        value_pb.string_value = value
+
+
+def _query(kind='Person', filters=(), order=(), projection=(), distinct_on=(), limit=None, offset=0, start=None,
+           end=None):
+    query = query_pb.Query()
+    if kind:
+        query.kind.add(name=kind)
+    for name, op, value in filters:
+        property_filter = query.filter.composite_filter.filters.add().property_filter
+        property_filter.property.name = name
+        property_filter.op = op
+        _set_value(property_filter.value, value)
+    if filters:
+        query.filter.composite_filter.op = query_pb.CompositeFilter.AND
+    for name in order:
+        query.order.add(
+            property=query_pb.PropertyReference(name=name.lstrip('-')),
+            direction=query_pb.PropertyOrder.DESCENDING if name.startswith('-') else query_pb.PropertyOrder.ASCENDING
+        )
+    for name in projection:
+        query.projection.add().property.name = name
+    for name in distinct_on:
+        query.distinct_on.add(name=name)
+    if limit is not None:
+        query.limit.value = limit
+    query.offset = offset
+    if start:
+        query.start_cursor = start
+    if end:
+        query.end_cursor = end
+    return query
+
+
+class TestInMemoryDatastore(unittest2.TestCase):
+    def setUp(self):
+        self.store = InMemoryDatastore()
+
+    def _commit(self, *mutations, **kwargs):
+        request = datastore_pb.CommitRequest(mode=datastore_pb.CommitRequest.NON_TRANSACTIONAL)
+        for operation, value in mutations:
+            mutation = request.mutations.add()
+            if operation == 'delete':
+                mutation.delete.CopyFrom(value)
+            else:
+                getattr(mutation, operation).CopyFrom(value)
+            if 'base_version' in kwargs:
+                mutation.base_version = kwargs['base_version']
+        if 'transaction' in kwargs:
+            request.mode = datastore_pb.CommitRequest.TRANSACTIONAL
+            request.transaction = kwargs['transaction']
+        return self.store.commit(request)
+
+    def _run(self, query, transaction=None):
+        request = datastore_pb.RunQueryRequest(query=query)
+        request.partition_id.namespace_id = NS
+        if transaction:
+            request.read_options.transaction = transaction
+        return self.store.run_query(request).batch
+
+    def _names(self, query):
+        return [result.entity.key.path[-1].name for result in self._run(query).entity_results]
+
+    def _people(self):
+        people = [('alice', 30, ['a', 'b']), ('bob', 25, ['c']), ('carol', 35, []), ('dave', 25, ['b', 'z'])]
+        self._commit(*[
+            ('upsert', _entity(_key('Person', name), age=age, tags=tags)) for name, age, tags in people
+        ])
+        self._commit(('upsert', _entity(_key('Person', 'erin'), name='no age')))
+
+    def test_commit_and_lookup(self):
+        response = self._commit(('insert', _entity(_key('Person', None), name='alice')),
+                                ('upsert', _entity(_key('Person', 'bob'), name='bob')))
+        self.assertTrue(response.mutation_results[0].HasField('key'))
+        self.assertFalse(response.mutation_results[1].HasField('key'))
+        self.assertEqual(response.mutation_results[0].version, 1)
+        self.assertGreater(response.index_updates, 0)
+        new_key = response.mutation_results[0].key
+
+        lookup = self.store.lookup(datastore_pb.LookupRequest(keys=[new_key, _key('Person', 'nobody')]))
+        (found,), (missing,) = lookup.found, lookup.missing
+        self.assertEqual(found.entity.properties['name'].string_value, 'alice')
+        self.assertEqual(found.version, 1)
+        self.assertEqual(missing.entity.key, _key('Person', 'nobody'))
+        self.assertEqual(len(self.store), 2)
+
+        self._commit(('delete', new_key))
+        self.assertEqual(len(self.store.lookup(datastore_pb.LookupRequest(keys=[new_key])).missing), 1)
+        self.assertEqual(len(self.store), 1)
+
+    def test_commit_errors(self):
+        self._commit(('insert', _entity(_key('Person', 'bob'))))
+        self.assertRaises(Conflict, self._commit, ('insert', _entity(_key('Person', 'bob'))))
+        self.assertRaises(NotFound, self._commit, ('update', _entity(_key('Person', 'alice'))))
+        self.assertRaises(BadRequest, self._commit, ('upsert', _entity(_key('Person', 'x'))),
+                          ('delete', _key('Person', 'x')))
+        self.assertRaises(BadRequest, self._commit, ('delete', _key('Person', None)))
+        self.assertEqual(len(self.store), 1)  # Nothing else was applied
+
+    def test_base_version(self):
+        version = self._commit(('upsert', _entity(_key('Person', 'bob'), age=1))).mutation_results[0].version
+        result, = self._commit(('upsert', _entity(_key('Person', 'bob'), age=2)), base_version=version + 5) \
+            .mutation_results
+        self.assertTrue(result.conflict_detected)
+        result, = self._commit(('upsert', _entity(_key('Person', 'bob'), age=3)), base_version=version) \
+            .mutation_results
+        self.assertFalse(result.conflict_detected)
+        found, = self.store.lookup(datastore_pb.LookupRequest(keys=[_key('Person', 'bob')])).found
+        self.assertEqual(found.entity.properties['age'].integer_value, 3)
+
+    def test_allocate_ids(self):
+        self._commit(('upsert', _entity(_key('Person', 10))))
+        response = self.store.allocate_ids(datastore_pb.AllocateIdsRequest(keys=[_key('Person', None)] * 2))
+        self.assertEqual([key.path[0].id for key in response.keys], [11, 12])
+        self.assertRaises(BadRequest, self.store.allocate_ids, datastore_pb.AllocateIdsRequest(keys=[_key('P', 1)]))
+
+    def test_filters(self):
+        self._people()
+        self.assertEqual(sorted(self._names(_query(filters=[('age', _FILTER.EQUAL, 25)]))), ['bob', 'dave'])
+        self.assertEqual(self._names(_query(filters=[('age', _FILTER.GREATER_THAN, 25)])), ['alice', 'carol'])
+        self.assertEqual(self._names(_query(filters=[('age', _FILTER.GREATER_THAN_OR_EQUAL, 25),
+                                                     ('age', _FILTER.LESS_THAN, 35)])), ['alice', 'bob', 'dave'])
+        # Multi-valued properties match if any value does
+        self.assertEqual(self._names(_query(filters=[('tags', _FILTER.EQUAL, 'b')])), ['alice', 'dave'])
+        self.assertEqual(self._names(_query(filters=[('tags', _FILTER.EQUAL, 'b'), ('age', _FILTER.EQUAL, 25)])),
+                         ['dave'])
+        self.assertEqual(self._names(_query(filters=[('__key__', _FILTER.GREATER_THAN, _key('Person', 'carol'))])),
+                         ['dave', 'erin'])
+        self.assertEqual(len(self._names(_query(kind=None))), 5)
+
+    def test_order(self):
+        self._people()
+        # erin has no age so isn't in the index
+        self.assertEqual(self._names(_query(order=['age'])), ['bob', 'dave', 'alice', 'carol'])
+        self.assertEqual(self._names(_query(order=['-age', '-__key__'])), ['carol', 'alice', 'dave', 'bob'])
+        # Ascending uses the smallest value of a multi-valued property, descending the largest
+        self.assertEqual(self._names(_query(order=['tags'])), ['alice', 'dave', 'bob'])
+        self.assertEqual(self._names(_query(order=['-tags'])), ['dave', 'bob', 'alice'])
+
+    def test_ancestor(self):
+        self._commit(('upsert', _entity(_key('Person', 'alice'))),
+                     ('upsert', _entity(_key('Person', 'alice', 'Pet', 'rex'))),
+                     ('upsert', _entity(_key('Person', 'alice', 'Pet', 'tom'))),
+                     ('upsert', _entity(_key('Person', 'bob', 'Pet', 'fido'))))
+        query = _query(kind='Pet', filters=[('__key__', _FILTER.HAS_ANCESTOR, _key('Person', 'alice'))])
+        self.assertEqual(self._names(query), ['rex', 'tom'])
+
+    def test_projection_and_distinct(self):
+        self._people()
+        batch = self._run(_query(projection=['age'], order=['age']))
+        self.assertEqual(batch.entity_result_type, query_pb.EntityResult.PROJECTION)
+        self.assertEqual([r.entity.properties['age'].integer_value for r in batch.entity_results], [25, 25, 30, 35])
+        self.assertEqual(set(batch.entity_results[0].entity.properties), {'age'})
+
+        batch = self._run(_query(projection=['age'], order=['age'], distinct_on=['age']))
+        self.assertEqual([r.entity.properties['age'].integer_value for r in batch.entity_results], [25, 30, 35])
+
+        batch = self._run(_query(projection=['tags'], filters=[('age', _FILTER.EQUAL, 30)]))
+        self.assertEqual([r.entity.properties['tags'].string_value for r in batch.entity_results], ['a', 'b'])
+
+        batch = self._run(_query(projection=['__key__']))
+        self.assertEqual(batch.entity_result_type, query_pb.EntityResult.KEY_ONLY)
+        self.assertEqual(len(batch.entity_results), 5)
+        self.assertEqual(len(batch.entity_results[0].entity.properties), 0)
+
+    def test_limit_offset_cursors(self):
+        self._people()
+        batch = self._run(_query(order=['age'], limit=2, offset=1))
+        self.assertEqual([r.entity.key.path[0].name for r in batch.entity_results], ['dave', 'alice'])
+        self.assertEqual(batch.skipped_results, 1)
+        self.assertEqual(batch.more_results, query_pb.QueryResultBatch.MORE_RESULTS_AFTER_LIMIT)
+
+        batch = self._run(_query(order=['age'], start=batch.end_cursor))
+        self.assertEqual([r.entity.key.path[0].name for r in batch.entity_results], ['carol'])
+        self.assertEqual(batch.more_results, query_pb.QueryResultBatch.NO_MORE_RESULTS)
+
+        end = self._run(_query(order=['age'], limit=1)).end_cursor
+        batch = self._run(_query(order=['age'], end=end))
+        self.assertEqual([r.entity.key.path[0].name for r in batch.entity_results], ['bob'])
+        self.assertEqual(batch.more_results, query_pb.QueryResultBatch.MORE_RESULTS_AFTER_CURSOR)
+
+        self.store.max_batch_size = 3
+        batch = self._run(_query())
+        self.assertEqual(len(batch.entity_results), 3)
+        self.assertEqual(batch.more_results, query_pb.QueryResultBatch.NOT_FINISHED)
+        self.assertEqual(len(self._run(_query(start=batch.end_cursor)).entity_results), 2)
+
+        self.assertRaises(BadRequest, self._run, _query(start=b'bogus'))
+
+    def test_pages_reuse_results(self):
+        self._people()
+        self.store.max_batch_size = 2
+        with patch.object(self.store, '_query', wraps=self.store._query) as query:
+            batch = self._run(_query(order=['age']))
+            names = [r.entity.key.path[0].name for r in batch.entity_results]
+            while batch.more_results == query_pb.QueryResultBatch.NOT_FINISHED:
+                batch = self._run(_query(order=['age'], start=batch.end_cursor))
+                names.extend(r.entity.key.path[0].name for r in batch.entity_results)
+            self.assertEqual(names, ['bob', 'dave', 'alice', 'carol'])
+            self.assertEqual(query.call_count, 1)
+
+            # A commit is a new snapshot, so the query runs again
+            self._commit(('upsert', _entity(_key('Person', 'erin'), age=20)))
+            batch = self._run(_query(order=['age']))
+            self.assertEqual(batch.entity_results[0].entity.key.path[0].name, 'erin')
+            self.assertEqual(query.call_count, 2)
+
+    def test_transactions(self):
+        self._commit(('upsert', _entity(_key('Person', 'alice'), age=1)))
+        txn = self.store.begin_transaction(datastore_pb.BeginTransactionRequest()).transaction
+        self._commit(('upsert', _entity(_key('Person', 'alice'), age=2)))
+
+        # Reads in the transaction see the snapshot
+        request = datastore_pb.LookupRequest(keys=[_key('Person', 'alice')])
+        request.read_options.transaction = txn
+        found, = self.store.lookup(request).found
+        self.assertEqual(found.entity.properties['age'].integer_value, 1)
+        results = self._run(_query(filters=[('age', _FILTER.EQUAL, 1)]), transaction=txn).entity_results
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(self._run(_query(filters=[('age', _FILTER.EQUAL, 1)])).entity_results), 0)
+
+        # alice changed after the snapshot, so committing fails
+        self.assertRaises(Conflict, self._commit, ('upsert', _entity(_key('Person', 'alice'), age=3)),
+                          transaction=txn)
+        self.assertRaises(BadRequest, self.store.rollback, datastore_pb.RollbackRequest(transaction=txn))
+
+        txn = self.store.begin_transaction(datastore_pb.BeginTransactionRequest()).transaction
+        self._commit(('upsert', _entity(_key('Person', 'bob'))))  # Not read by the transaction
+        self._commit(('upsert', _entity(_key('Person', 'alice'), age=3)), transaction=txn)
+        found, = self.store.lookup(datastore_pb.LookupRequest(keys=[_key('Person', 'alice')])).found
+        self.assertEqual(found.entity.properties['age'].integer_value, 3)
+        self.assertEqual(self.store._history, {})
+
+
+class TestInMemoryConnection(unittest2.TestCase):
+    class Person(Entity):
+        name = TextProperty()
+        age = IntegerProperty()
+
+    def setUp(self):
+        self.connection = connect_in_memory()
+
+    def tearDown(self):
+        connection_module.disconnect()
+
+    def test_connect(self):
+        self.assertIsInstance(self.connection, InMemoryConnection)
+        self.assertIs(connection_module.get_connection(), self.connection)
+        store = InMemoryDatastore()
+        self.assertIs(connect_in_memory(store=store).store, store)
+
+    def test_entities(self):
+        for i in range(5):
+            self.Person(name='p%d' % i, age=i).save()
+        self.assertEqual(len(self.connection.store), 5)
+        self.assertEqual(self.Person.objects.filter(age__gt=2).count(), 2)
+        person = self.Person.objects.get(name='p1')
+        self.assertIsNotNone(person.version)
+
+        with Transaction(Transaction.SNAPSHOT):
+            person = self.Person.objects.get(name='p1')
+            person.age = 10
+            person.save()
+        self.assertEqual(self.Person.objects.get(name='p1').age, 10)
+
+        stale = self.Person.objects.get(name='p2')
+        self.Person.objects.get(name='p2').save()
+        stale.age = 20
+        self.assertRaises(VersionConflict, stale.save, if_unchanged=True)
+        self.assertRaises(ValueError, stale.save, force_insert=True, if_unchanged=True)
+
+        person.delete()
+        self.assertEqual(len(self.connection.store), 4)
+
+    def test_bulk_operations_join_transaction(self):
+        with Transaction(Transaction.SNAPSHOT):
+            self.Person.objects.bulk_create([self.Person(key=i + 1, name='p%d' % i, age=i) for i in range(30)])
+            self.assertEqual(len(self.connection.store), 0)
+        self.assertEqual(len(self.connection.store), 30)
+
+        with self.assertRaises(RuntimeError):
+            with Transaction(Transaction.SNAPSHOT):
+                self.Person.objects.filter(age__lt=10).update(age=100)
+                self.Person.objects.filter(age__gte=20).delete()
+                raise RuntimeError
+        self.assertEqual(len(self.connection.store), 30)
+        self.assertEqual(self.Person.objects.filter(age=100).count(), 0)
+
+        self.Person.objects.filter(age__lt=10).update(age=100)
+        self.Person.objects.filter(age__gte=20, age__lt=100).delete()
+        self.assertEqual(len(self.connection.store), 20)
+        self.assertEqual(self.Person.objects.filter(age=100).count(), 10)
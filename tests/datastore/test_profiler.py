@@ -0,0 +1,114 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+import unittest2
+
+from gcloudoem import Entity, IntegerProperty, TextProperty
+from gcloudoem.datastore import Connection, profiler
+from gcloudoem.datastore._generated import query_pb2 as query_pb
+from gcloudoem.datastore.query import Cursor, Query
+
+
+class Person(Entity):
+    name = TextProperty()
+    age = IntegerProperty()
+
+
+class TestQueryShape(unittest2.TestCase):
+    def test_values_stripped(self):
+        query = Query(Person, filters=[('age', '>', 30), ('name', '=', 'Alice')], order=['-age'])
+        other = Query(Person, filters=[('name', '=', 'Bob'), ('age', '>', 50)], order=['-age'])
+        shape = profiler.query_shape(query.to_protobuf())
+        self.assertEqual(shape, 'Person WHERE age > ? AND name = ? ORDER BY -age')
+        self.assertEqual(shape, profiler.query_shape(other.to_protobuf()))
+
+    def test_projection_and_ancestor(self):
+        pb = Query(Person, projection=['name']).to_protobuf()
+        pb.filter.property_filter.property.name = '__key__'
+        pb.filter.property_filter.op = query_pb.PropertyFilter.HAS_ANCESTOR
+        self.assertEqual(profiler.query_shape(pb), 'SELECT name FROM Person WHERE __key__ HAS ANCESTOR ?')
+
+    def test_fingerprint(self):
+        self.assertEqual(profiler.fingerprint('Person'), profiler.fingerprint('Person'))
+        self.assertNotEqual(profiler.fingerprint('Person'), profiler.fingerprint('Person ORDER BY age'))
+
+
+class TestQueryProfiler(unittest2.TestCase):
+    def _entity_result(self, id):
+        result = query_pb.EntityResult()
+        result.entity.key.path.add(kind='Person', id=id)
+        result.entity.properties['name'].string_value = 'Alice'
+        return result
+
+    def _make_cursor(self, *pages):
+        connection = MagicMock(spec=Connection)
+        connection.namespace = None
+        connection.run_query.side_effect = [
+            ([self._entity_result(id) for id in ids], b'CURSOR',
+             query_pb.QueryResultBatch.NOT_FINISHED if more else query_pb.QueryResultBatch.NO_MORE_RESULTS, 0)
+            for ids, more in pages
+        ]
+        return Cursor(Query(Person, filters=[('name', '=', 'Alice')]), connection)
+
+    def tearDown(self):
+        profiler.disable_profiling()
+
+    def test_disabled(self):
+        cursor = self._make_cursor(([1], False))
+        self.assertEqual(len(list(cursor)), 1)
+        self.assertIsNone(cursor._execution)
+
+    def test_records_execution(self):
+        with profiler.profiling(slow_threshold=60) as query_profiler:
+            for cursor in (self._make_cursor(([1, 2], True), ([3], False)), self._make_cursor(([4], False))):
+                list(cursor)
+        self.assertIsNone(profiler.get_profiler())
+
+        shape, = query_profiler.report()
+        self.assertEqual(shape['shape'], 'Person WHERE name = ?')
+        self.assertEqual((shape['count'], shape['pages'], shape['entities']), (2, 3, 4))
+        self.assertEqual(shape['bytes'], 4 * self._entity_result(1).ByteSize())
+        self.assertGreaterEqual(shape['total_time'], shape['network_time'] + shape['decode_time'])
+        (caller, count), = shape['callers']
+        self.assertIn('test_profiler.py', caller)
+        self.assertIn('test_records_execution', caller)
+        self.assertEqual(count, 2)
+        self.assertEqual(query_profiler.slow_queries(), [])
+
+    def test_stopped_early(self):
+        query_profiler = profiler.enable_profiling()
+        cursor = iter(self._make_cursor(([1, 2], True), ([3], False)))
+        next(cursor)
+        cursor.close()
+        shape, = query_profiler.report()
+        self.assertEqual((shape['count'], shape['pages'], shape['entities']), (1, 1, 2))
+
+    def test_slow_query_log(self):
+        query_profiler = profiler.enable_profiling(slow_threshold=-1)
+        with patch.object(profiler.logger, 'warning') as warning:
+            list(self._make_cursor(([1], False)))
+        execution, = query_profiler.slow_queries()
+        self.assertEqual(execution.shape, 'Person WHERE name = ?')
+        self.assertEqual(execution.entities, 1)
+        self.assertTrue(warning.called)
+
+        query_profiler.reset()
+        self.assertEqual((query_profiler.report(), query_profiler.slow_queries()), ([], []))
+
+    def test_ranked_by_total_time(self):
+        query_profiler = profiler.QueryProfiler(slow_threshold=60)
+        for shape, total in (('A', 1.0), ('B', 3.0), ('A', 1.5)):
+            execution = MagicMock(
+                shape=shape, fingerprint=shape, caller='here', pages=1, entities=1, bytes=1, network_time=0,
+                decode_time=0, _started=0
+            )
+            with patch.object(profiler, '_clock', return_value=total):
+                query_profiler.finish(execution)
+        self.assertEqual([(s['shape'], s['total_time']) for s in query_profiler.report()], [('B', 3.0), ('A', 2.5)])
+        self.assertEqual(len(query_profiler.report(limit=1)), 1)
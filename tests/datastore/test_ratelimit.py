@@ -0,0 +1,98 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+import unittest2
+
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore.ratelimit import TokenBucket, WriteRateLimiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateLimitTestCase(unittest2.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patches = [
+            patch('gcloudoem.datastore.ratelimit._clock', self.clock),
+            patch('gcloudoem.datastore.ratelimit.time.sleep', side_effect=self.clock.sleep),
+        ]
+        self.sleep = [p.start() for p in self.patches][1]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+
+class TestTokenBucket(RateLimitTestCase):
+    def test_acquire(self):
+        bucket = TokenBucket(10, capacity=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(5), 0.5)  # Goes into debt
+        self.assertAlmostEqual(bucket.reserve(), 0.6)
+        self.clock.now += 10
+        self.assertEqual(bucket.acquire(2), 0)  # Never refills past capacity
+
+
+class TestWriteRateLimiter(RateLimitTestCase):
+    def _request(self, *paths):
+        request = datastore_pb.CommitRequest()
+        for path in paths:
+            key = request.mutations.add().upsert.key
+            for kind, id in path:
+                element = key.path.add(kind=kind)
+                if id:
+                    element.id = id
+        return request
+
+    def test_kind_ramp_up(self):
+        limiter = WriteRateLimiter(initial_rate=10, ramp_interval=300)
+        request = self._request(*[[('Kind', None)] for _ in range(20)])
+        self.assertEqual(limiter.acquire(request), 1.0)  # 10 writes over the burst at 10/s
+        self.assertEqual(limiter.stats(), {'throttled': 1, 'waited': 1.0})
+
+        for _ in range(10):
+            self.clock.now += 60
+            limiter.acquire(self._request([('Kind', None)]))
+        self.assertEqual(limiter.kind_rate('Kind'), 22.5)  # 10 minutes in, so 10 * 1.5 * 1.5
+        self.assertEqual(limiter.kind_rate('Other'), 10)
+
+        self.clock.now += 301  # Idle for a whole interval, so start again
+        limiter.acquire(self._request([('Kind', None)]))
+        self.assertEqual(limiter.kind_rate('Kind'), 10)
+
+    def test_entity_group(self):
+        limiter = WriteRateLimiter(entity_group_rate=1, entity_group_burst=2)
+        group = [('Parent', 1), ('Child', None)]
+        self.assertEqual(limiter.acquire(self._request(group, group)), 0)  # One write to the group
+        self.assertEqual(limiter.acquire(self._request(group)), 0)
+        self.assertEqual(limiter.acquire(self._request(group)), 1.0)
+        self.assertEqual(limiter.acquire(self._request([('Parent', 2)])), 0)  # A different group
+        for _ in range(10):  # New root entities don't share a group
+            self.assertEqual(limiter.acquire(self._request([('Parent', None)])), 0)
+
+    def test_connection_commit(self):
+        limiter = MagicMock(spec=WriteRateLimiter)
+        connection = Connection('DATASET', 'TEST', rate_limiter=limiter)
+        request = self._request([('Kind', 1)])
+        with patch.object(connection, '_rpc') as rpc:
+            connection.commit(request)
+        limiter.acquire.assert_called_once_with(request)
+        self.assertTrue(rpc.called)
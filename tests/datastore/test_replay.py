@@ -0,0 +1,111 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+
+import unittest2
+
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore._generated import entity_pb2 as entity_pb
+from gcloudoem.datastore.connection import Connection
+from gcloudoem.datastore.fakeserver import FakeDatastoreServer, FaultInjector
+from gcloudoem.datastore.replay import Exchange, RecordingHttp, ReplayHttp, load_recording
+from gcloudoem.datastore.retry import RetryPolicy
+from gcloudoem.exceptions import NotFound, ReplayError
+
+
+def _key(name):
+    key = entity_pb.Key()
+    key.partition_id.project_id = 'project'
+    key.partition_id.namespace_id = 'default'
+    key.path.add(kind='Person', name=name)
+    return key
+
+
+def _upsert(name, age):
+    request = datastore_pb.CommitRequest()
+    entity = request.mutations.add().upsert
+    entity.key.CopyFrom(_key(name))
+    entity.properties['age'].integer_value = age
+    return request
+
+
+def _connection(http):
+    return Connection('project', 'default', http=http, retry_policy=RetryPolicy(max_attempts=1))
+
+
+class TestRecordAndReplay(unittest2.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'traffic.rec')
+
+        with FakeDatastoreServer(faults=FaultInjector(latency=0.02)) as server:
+            with RecordingHttp(self.path) as http:
+                connection = _connection(http)
+                connection.api_base_url = server.http_url
+                connection.commit(_upsert('alice', 30))
+                connection.lookup([_key('alice')])
+                connection.lookup([_key('bob')])
+                request = datastore_pb.CommitRequest()
+                request.mutations.add().update.key.CopyFrom(_key('nobody'))
+                with self.assertRaises(NotFound):
+                    connection.commit(request)
+            self.assertEqual(http.count, 4)
+
+    def test_recording(self):
+        exchanges = load_recording(self.path)
+        self.assertEqual([exchange.method for exchange in exchanges], ['commit', 'lookup', 'lookup', 'commit'])
+        self.assertEqual([exchange.status for exchange in exchanges], [200, 200, 200, 404])
+        self.assertTrue(all(exchange.elapsed >= 0.02 for exchange in exchanges))
+        request = datastore_pb.LookupRequest.FromString(exchanges[1].request)
+        self.assertEqual(request.keys[0].path[0].name, 'alice')
+
+    def test_replay(self):
+        http = ReplayHttp(self.path)
+        connection = _connection(http)
+        connection.commit(_upsert('alice', 30))
+        found, _, _ = connection.lookup([_key('alice')])
+        self.assertEqual(found[0].properties['age'].integer_value, 30)
+        found, missing, _ = connection.lookup([_key('bob')])
+        self.assertEqual((len(found), len(missing)), (0, 1))
+        with self.assertRaises(NotFound):
+            connection.commit(_upsert('nobody', 1))
+        self.assertEqual(http.remaining(), 0)
+
+        with self.assertRaises(ReplayError):
+            connection.lookup([_key('alice')])
+        http.rewind()
+        self.assertEqual(http.remaining(), 4)
+
+    def test_replay_is_fast_unless_realtime(self):
+        connection = _connection(ReplayHttp(self.path))
+        started = time.time()
+        connection.lookup([_key('alice')])
+        self.assertLess(time.time() - started, 0.02)
+
+        connection = _connection(ReplayHttp(self.path, realtime=True))
+        started = time.time()
+        connection.lookup([_key('alice')])
+        self.assertGreaterEqual(time.time() - started, 0.02)
+
+    def test_check_requests(self):
+        connection = _connection(ReplayHttp(self.path, check_requests=True))
+        connection.lookup([_key('alice')])
+        with self.assertRaises(ReplayError):
+            connection.lookup([_key('carol')])
+
+    def test_not_a_recording(self):
+        with open(self.path, 'wb') as stream:
+            stream.write(b'nope')
+        with self.assertRaises(ReplayError):
+            load_recording(self.path)
+
+    def test_replay_exchanges(self):
+        response = datastore_pb.AllocateIdsResponse(keys=[_key('x')]).SerializeToString()
+        connection = _connection(ReplayHttp([Exchange('allocateIds', b'', 200, response, 0.0)]))
+        self.assertEqual(connection.allocate_ids([_key('x')])[0].path[0].name, 'x')
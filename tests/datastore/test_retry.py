@@ -0,0 +1,168 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import httplib2
+import unittest2
+
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore.retry import CircuitBreaker, RetryPolicy
+from gcloudoem.exceptions import (
+    BadRequest, CircuitOpen, DeadlineExceeded, InternalServerError, ServiceUnavailable, TooManyRequests
+)
+
+
+class Http(object):
+    """Responds to each request with the next of ``responses``: a status code, or an exception to raise."""
+    def __init__(self, *responses):
+        self._responses = list(responses)
+        self.requests = []
+
+    def request(self, **kw):
+        self.requests.append(kw)
+        response = self._responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return httplib2.Response({'status': str(response)}), b'CONTENT' if response == 200 else b'error'
+
+
+class TestRetryPolicy(unittest2.TestCase):
+    def test_is_idempotent(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_idempotent('lookup', datastore_pb.LookupRequest()))
+        self.assertTrue(policy.is_idempotent('runQuery', datastore_pb.RunQueryRequest()))
+
+        request = datastore_pb.CommitRequest()
+        request.mutations.add().upsert.key.path.add(kind='Kind', id=1)
+        request.mutations.add().delete.path.add(kind='Kind', id=2)
+        self.assertTrue(policy.is_idempotent('commit', request))
+        request.transaction = b'TXN'
+        self.assertFalse(policy.is_idempotent('commit', request))
+        request.ClearField('transaction')
+        request.mutations.add().insert.key.path.add(kind='Kind', id=3)
+        self.assertFalse(policy.is_idempotent('commit', request))
+
+    def test_should_retry(self):
+        policy = RetryPolicy(max_attempts=3)
+        self.assertTrue(policy.should_retry(ServiceUnavailable('x'), 1, True))
+        self.assertFalse(policy.should_retry(ServiceUnavailable('x'), 1, False))
+        self.assertTrue(policy.should_retry(TooManyRequests('x'), 1, False))
+        self.assertFalse(policy.should_retry(BadRequest('x'), 1, True))
+        self.assertTrue(policy.should_retry(socket.timeout(), 1, True))
+        self.assertFalse(policy.should_retry(socket.timeout(), 1, False))
+        self.assertFalse(policy.should_retry(ValueError(), 1, True))
+        self.assertFalse(policy.should_retry(ServiceUnavailable('x'), 3, True))
+
+    def test_backoff(self):
+        policy = RetryPolicy(initial_delay=1, max_delay=3)
+        with patch('gcloudoem.datastore.retry.random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual([policy.backoff(attempt) for attempt in range(1, 5)], [1, 2, 3, 3])
+
+    def test_deadlines(self):
+        policy = RetryPolicy(deadline=30, deadlines={'commit': 5})
+        self.assertEqual(policy.deadline_for('commit'), 5)
+        self.assertEqual(policy.deadline_for('lookup'), 30)
+
+
+class TestCircuitBreaker(unittest2.TestCase):
+    def test_opens_and_resets(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        with patch('gcloudoem.datastore.retry._clock', lambda: now[0]):
+            breaker.before_request()
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertRaises(CircuitOpen, breaker.before_request)
+
+            now[0] = 10
+            breaker.before_request()  # The trial request
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertRaises(CircuitOpen, breaker.before_request)
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+            now[0] = 20
+            breaker.before_request()
+            breaker.record_success()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            breaker.before_request()
+
+
+@patch('gcloudoem.datastore.connection.time.sleep')
+class TestConnectionRetries(unittest2.TestCase):
+    def _make_connection(self, http, **kwargs):
+        connection = Connection('DATASET', 'TEST', **kwargs)
+        connection._http = http
+        return connection
+
+    def test_retries_idempotent(self, sleep):
+        http = Http(503, socket.error(), 200)
+        connection = self._make_connection(http)
+        self.assertEqual(connection._request('lookup', b'DATA', idempotent=True), b'CONTENT')
+        self.assertEqual(len(http.requests), 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(http.requests[2]['headers']['Content-Type'], 'application/x-protobuf')
+
+    def test_no_retry_when_not_idempotent(self, sleep):
+        connection = self._make_connection(Http(500, 200))
+        self.assertRaises(InternalServerError, connection._request, 'commit', b'DATA')
+        connection = self._make_connection(Http(429, 200))
+        self.assertEqual(connection._request('commit', b'DATA'), b'CONTENT')
+
+    def test_max_attempts(self, sleep):
+        http = Http(503, 503, 503, 200)
+        connection = self._make_connection(http, retry_policy=RetryPolicy(max_attempts=3))
+        self.assertRaises(ServiceUnavailable, connection._request, 'lookup', b'DATA', True)
+        self.assertEqual(len(http.requests), 3)
+
+    def test_deadline(self, sleep):
+        connection = self._make_connection(Http(503, 200), retry_policy=RetryPolicy(initial_delay=10, deadline=1))
+        with patch('gcloudoem.datastore.retry.random.uniform', return_value=5):
+            self.assertRaises(DeadlineExceeded, connection._request, 'lookup', b'DATA', True)
+        self.assertFalse(sleep.called)
+
+    def test_circuit_breaker(self, sleep):
+        breaker = CircuitBreaker(failure_threshold=2)
+        http = Http(503, 503, 200)
+        connection = self._make_connection(http, circuit_breaker=breaker)
+        self.assertRaises(CircuitOpen, connection._request, 'lookup', b'DATA', True)
+        self.assertEqual(len(http.requests), 2)
+        self.assertRaises(CircuitOpen, connection._request, 'lookup', b'DATA', True)
+        self.assertEqual(len(http.requests), 2)
+
+    def test_replaced_policy_timeout(self, sleep):
+        connection = Connection('DATASET', 'TEST', retry_policy=RetryPolicy(attempt_timeout=5))
+        self.assertEqual(connection.http.timeout, 5)
+        connection.retry_policy = RetryPolicy(attempt_timeout=1)
+        self.assertEqual(connection.timeout, 1)
+        self.assertEqual(connection.http.timeout, 1)
+
+    def test_deprecated_constants(self, sleep):
+        self.assertEqual(Connection.RETRY_STATUSES, list(RetryPolicy.RETRY_STATUSES))
+        self.assertEqual(Connection.MAX_RETRIES, RetryPolicy().max_attempts - 1)
+
+        class OldConnection(Connection):
+            MAX_RETRIES = 0
+            RETRY_STATUSES = ['500']
+        connection = OldConnection('DATASET', 'TEST')
+        self.assertEqual(connection.retry_policy.max_attempts, 1)
+        connection._http = http = Http(503, 200)
+        self.assertRaises(ServiceUnavailable, connection._request, 'lookup', b'DATA', True)
+        self.assertEqual(len(http.requests), 1)
+        self.assertFalse(connection.retry_policy.should_retry(ServiceUnavailable('down'), 0, True))
+
+    def test_rpc_checks_idempotency(self, sleep):
+        connection = self._make_connection(Http(503, 200))
+        request = datastore_pb.CommitRequest()
+        request.mutations.add().insert.key.path.add(kind='Kind')
+        self.assertRaises(ServiceUnavailable, connection._rpc, 'commit', request, datastore_pb.CommitResponse)
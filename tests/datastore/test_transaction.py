@@ -23,7 +23,8 @@ from unittest.mock import MagicMock, patch
 import unittest2
 
 from gcloudoem import Transaction, Entity, TextProperty, KeyProperty
-from gcloudoem.datastore import Connection, datastore_v1_pb2 as datastore_pb
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
 from gcloudoem.exceptions import ConnectionError
 
 
@@ -41,7 +42,7 @@ class TestTransaction(unittest2.TestCase):
             Transaction(Transaction.SNAPSHOT)
 
     def test_txn_init(self):
-        from gcloudoem.datastore.datastore_v1_pb2 import Mutation
+        from gcloudoem.datastore._generated.datastore_pb2 import CommitRequest as Mutation
 
         connection = MagicMock(spec=Connection)
         connection.dataset = 'DATASET'
@@ -75,6 +76,47 @@ class TestTransaction(unittest2.TestCase):
             self.assertTrue(txn1.current() is None)
             self.assertTrue(txn2.current() is None)
 
+    def test_txn_current_per_context(self):
+        import contextvars
+
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection):
+            txn1 = Transaction(Transaction.NONE)
+            txn2 = Transaction(Transaction.NONE)
+            with txn1:
+                # A task started now inherits the outer transaction, but its own transactions aren't seen outside it.
+                def task():
+                    self.assertIs(Transaction.current(), txn1)
+                    with txn2:
+                        self.assertIs(Transaction.current(), txn2)
+                        contextvars.copy_context().run(lambda: self.assertIs(Transaction.current(), txn2))
+                        self.assertIs(outer.run(Transaction.current), txn1)
+                outer = contextvars.copy_context()
+                contextvars.copy_context().run(task)
+                self.assertIs(Transaction.current(), txn1)
+
+    def test_entity_save_joins_current(self):
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        connection.commit.return_value = datastore_pb.CommitResponse()
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            with Transaction(Transaction.SNAPSHOT) as txn:
+                self.TestEntity(key=1).save()
+                self.TestEntity(key=2).save(force_insert=True)
+                self.TestEntity(key=3).delete()
+                self.assertFalse(connection.commit.called)
+            self.assertEqual(connection.begin_transaction.call_count, 1)
+            self.assertEqual(connection.commit.call_count, 1)
+            self.assertEqual(
+                [m.WhichOneof('operation') for m in txn._mutation.mutations], ['upsert', 'insert', 'delete']
+            )
+
+            self.TestEntity(key=4).save()
+            self.assertEqual(connection.begin_transaction.call_count, 2)
+
     def test_txn_begin(self):
         connection = MagicMock(spec=Connection)
         connection.dataset = 'DATASET'
@@ -139,9 +181,9 @@ class TestTransaction(unittest2.TestCase):
         connection.namespace = 'TEST'
         with patch('gcloudoem.properties.get_connection', return_value=connection):
             resp = datastore_pb.CommitResponse()
-            resp.mutation_result.insert_auto_id_key.extend([self._make_key_pb()])
+            resp.mutation_results.add().key.CopyFrom(self._make_key_pb())
         connection.begin_transaction.return_value = 234
-        connection.commit.return_value = resp.mutation_result
+        connection.commit.return_value = resp
         with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection) as mock:
             txn = Transaction(Transaction.SNAPSHOT)
             self.assertTrue(mock.called)
@@ -186,3 +228,347 @@ class TestTransaction(unittest2.TestCase):
                 self.assertEqual(txn.id, None)
                 self.assertEqual(txn._status, Transaction._ABORTED)
             self.assertEqual(txn.id, None)
+
+    def test_put_w_id_allocator(self):
+        class AllocatedEntity(Entity):
+            first_name = TextProperty()
+
+            class Meta:
+                id_block_size = 2
+
+        from gcloudoem.datastore.allocator import clear_id_allocators
+
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        connection.allocate_ids.side_effect = lambda key_pbs: [self._make_key_pb(id=i + 1) for i in range(len(key_pbs))]
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.datastore.allocator.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            clear_id_allocators()
+            txn = Transaction(Transaction.NONE)
+            entity = AllocatedEntity()
+            txn.put(entity)
+            clear_id_allocators()
+
+        self.assertEqual(entity.key.id, 1)
+        self.assertEqual(len(txn._auto_id_entities), 0)
+        mutation = txn._mutation.mutations[0]
+        self.assertEqual(mutation.WhichOneof('operation'), 'upsert')
+        self.assertEqual(mutation.upsert.key.path[0].id, 1)
+
+    def test_put_if_unchanged(self):
+        from gcloudoem.exceptions import VersionConflict
+
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        resp = datastore_pb.CommitResponse()
+        resp.mutation_results.add(version=8)
+        resp.mutation_results.add(conflict_detected=True)
+        connection.commit.return_value = resp
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            txn = Transaction(Transaction.NONE)
+            unread = self.TestEntity(key=1)
+            self.assertRaises(ValueError, txn.put, unread, if_unchanged=True)
+
+            saved, stale = self.TestEntity(key=2), self.TestEntity(key=3)
+            saved._version, stale._version = 5, 6
+            txn.put(saved, if_unchanged=True)
+            txn.put(stale, if_unchanged=True)
+            self.assertEqual([m.base_version for m in txn._mutation.mutations], [5, 6])
+            with self.assertRaises(VersionConflict) as e:
+                txn.commit()
+
+        self.assertEqual(e.exception.entities, [stale])
+        self.assertEqual(saved.version, 8)
+        self.assertEqual(stale.version, 6)
+
+    def test_put_coalesces_writes(self):
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            txn = Transaction(Transaction.NONE)
+            first, other = self.TestEntity(key=1, first_name='a'), self.TestEntity(key=2)
+            first._version = 3
+            txn.create(first)
+            txn.put(other)
+            txn.delete(other)
+            second = self.TestEntity(key=1, first_name='b')
+            txn.put(second)
+            txn.put(self.TestEntity())
+            txn.put(self.TestEntity())
+
+        mutations = txn._mutation.mutations
+        self.assertEqual(len(mutations), 4)
+        self.assertEqual(mutations[0].WhichOneof('operation'), 'insert')  # Still mustn't already exist
+        self.assertEqual(mutations[0].insert.properties['first_name'].string_value, 'b')
+        self.assertEqual(mutations[1].WhichOneof('operation'), 'delete')
+        self.assertEqual(txn._mutation_entities[:2], [second, None])
+        self.assertEqual(len(txn._auto_id_entities), 2)
+
+    def test_get_reads_buffer(self):
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            txn = Transaction(Transaction.NONE)
+            saved, deleted = self.TestEntity(key=1, first_name='a'), self.TestEntity(key=2)
+            txn.put(saved)
+            txn.delete(deleted)
+            saved.first_name = 'changed after saving'
+            with patch.object(Transaction, 'current', return_value=txn):
+                found = self.TestEntity.objects.get(pk=1)
+                self.assertIsNot(found, saved)
+                self.assertEqual((found.key, found.first_name), (saved.key, 'a'))
+                self.assertRaises(self.TestEntity.DoesNotExist, self.TestEntity.objects.get, pk=2)
+        self.assertFalse(txn.is_buffered(self.TestEntity(key=3).key))
+        self.assertFalse(connection.run_query.called)
+
+    def test_commit_async(self):
+        from concurrent.futures import Future
+        from gcloudoem.datastore.utils import BoundedExecutor
+
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        executor = BoundedExecutor(max_workers=1)
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            resp = datastore_pb.CommitResponse()
+            resp.mutation_results.add().key.CopyFrom(self._make_key_pb(id=99))
+            connection.commit.return_value = resp
+            entity = self.TestEntity()
+            future = entity.save_async(executor=executor)
+            self.assertIsInstance(future, Future)
+            self.assertIsNone(future.result(5))
+            self.assertEqual(entity.key.id, 99)
+            self.assertFalse(connection.begin_transaction.called)
+
+            connection.commit.side_effect = ConnectionError('down')
+            self.assertRaises(ConnectionError, self.TestEntity(key=1).save_async(executor=executor).result, 5)
+
+            connection.commit.side_effect = None
+            with Transaction(Transaction.NONE) as txn:
+                self.assertRaises(ValueError, txn.commit_async, executor)
+        executor.shutdown()
+
+
+class TestBufferedWriter(unittest2.TestCase):
+    class TestEntity(Entity):
+        first_name = TextProperty()
+
+    def _make_connection(self):
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.namespace = 'TEST'
+        connection.commit.side_effect = lambda request, txn_id: self._commit_response(request)
+        return connection
+
+    def _commit_response(self, request):
+        self.committed.append([m.WhichOneof('operation') for m in request.mutations])
+        response = datastore_pb.CommitResponse()
+        for _ in request.mutations:
+            response.mutation_results.add(version=1)
+        return response
+
+    def setUp(self):
+        self.committed = []
+        self.connection = self._make_connection()
+        self.patches = [
+            patch('gcloudoem.datastore.transaction.get_connection', return_value=self.connection),
+            patch('gcloudoem.properties.get_connection', return_value=self.connection),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_flushes_at_max_mutations(self):
+        from gcloudoem.datastore.transaction import BufferedWriter
+
+        with BufferedWriter(max_mutations=2) as writer:
+            for i in range(5):
+                self.TestEntity(key=i + 1).save()
+            self.assertEqual(len(self.committed), 2)
+            self.assertEqual(writer.pending, 1)
+        self.assertEqual(self.committed, [['upsert', 'upsert']] * 2 + [['upsert']])
+        self.assertFalse(self.connection.begin_transaction.called)
+
+    def test_flushes_at_max_bytes(self):
+        from gcloudoem.datastore.transaction import BufferedWriter
+
+        writer = BufferedWriter(max_bytes=100)
+        entity = self.TestEntity(key=1, first_name='x' * 100)
+        writer.put(entity)
+        self.assertEqual(self.committed, [['upsert']])
+        self.assertEqual(entity.version, 1)
+        writer.put(self.TestEntity(key=2))
+        writer.flush()
+        self.assertEqual(len(self.committed), 2)
+        writer.flush()  # Nothing to do
+        self.assertEqual(len(self.committed), 2)
+
+    def test_coalesced_writes_replace_bytes(self):
+        from gcloudoem.datastore.transaction import BufferedWriter
+
+        writer = BufferedWriter(max_bytes=300)
+        for _ in range(5):
+            writer.put(self.TestEntity(key=1, first_name='x' * 100))
+        self.assertEqual(self.committed, [])
+        self.assertEqual(writer._bytes, writer._mutation.mutations[0].ByteSize())
+        writer.delete(self.TestEntity(key=1))
+        self.assertEqual(writer._bytes, writer._mutation.mutations[0].ByteSize())
+        writer.flush()
+        self.assertEqual(self.committed, [['delete']])
+
+    def test_rollback_discards_pending(self):
+        from gcloudoem.datastore.transaction import BufferedWriter
+
+        with self.assertRaises(RuntimeError):
+            with BufferedWriter() as writer:
+                writer.put(self.TestEntity(key=1))
+                raise RuntimeError()
+        self.assertEqual(writer.pending, 0)
+        self.assertFalse(self.connection.commit.called)
+
+    def test_flush_interval(self):
+        import threading
+        from gcloudoem.datastore.transaction import BufferedWriter
+
+        flushed = threading.Event()
+        self.connection.commit.side_effect = lambda request, txn_id: flushed.set() or datastore_pb.CommitResponse()
+        with BufferedWriter(flush_interval=0.01) as writer:
+            writer.put(self.TestEntity(key=1))
+            self.assertTrue(flushed.wait(5))
+            self.assertEqual(writer.pending, 0)
+
+    def test_background_flush_error(self):
+        import threading
+        from gcloudoem.datastore.transaction import BufferedWriter
+        from gcloudoem.exceptions import ServiceUnavailable
+
+        failed = threading.Event()
+
+        def commit(request, txn_id):
+            failed.set()
+            raise ServiceUnavailable('down')
+        self.connection.commit.side_effect = commit
+        writer = BufferedWriter(flush_interval=0.01)
+        writer.put(self.TestEntity(key=1))
+        self.assertTrue(failed.wait(5))
+        writer._stop_timer()
+        self.assertRaises(ServiceUnavailable, writer.put, self.TestEntity(key=2))
+        writer.put(self.TestEntity(key=2))
+
+
+class TestRunInTransaction(unittest2.TestCase):
+    def _make_connection(self, commit_side_effect=None):
+        connection = MagicMock(spec=Connection)
+        connection.dataset = 'DATASET'
+        connection.begin_transaction.return_value = 234
+        connection.commit.side_effect = commit_side_effect
+        return connection
+
+    def test_no_conflict(self):
+        from gcloudoem.datastore.transaction import run_in_transaction
+
+        connection = self._make_connection()
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection):
+            result = run_in_transaction(lambda: Transaction.current().id)
+        self.assertEqual(result, 234)
+        self.assertEqual(connection.commit.call_count, 1)
+
+    @patch('gcloudoem.datastore.transaction.time.sleep')
+    def test_retries_on_conflict(self, sleep):
+        from gcloudoem.datastore.transaction import retry_stats, run_in_transaction
+        from gcloudoem.exceptions import Conflict
+
+        connection = self._make_connection([Conflict('too much contention'), Conflict('again'), MagicMock()])
+        calls = []
+        before = retry_stats()
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection):
+            run_in_transaction(lambda: calls.append(1), retries=2, initial_delay=1, max_delay=1.5)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sleep.call_count, 2)
+        for (delay,), _ in sleep.call_args_list:
+            self.assertTrue(0 <= delay <= 1.5)
+        self.assertEqual(retry_stats()['retries'] - before['retries'], 2)
+
+    @patch('gcloudoem.datastore.transaction.time.sleep')
+    def test_retries_exhausted(self, sleep):
+        from gcloudoem.datastore.transaction import retry_stats, transactional
+        from gcloudoem.exceptions import Conflict
+
+        connection = self._make_connection(Conflict('too much contention'))
+
+        @transactional(retries=1)
+        def func(value):
+            return value
+
+        before = retry_stats()
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection):
+            self.assertRaises(Conflict, func, 1)
+        self.assertEqual(connection.commit.call_count, 2)
+        self.assertEqual(retry_stats()['exhausted'] - before['exhausted'], 1)
+
+    @patch('gcloudoem.datastore.transaction.time.sleep')
+    def test_already_exists_not_retried(self, sleep):
+        from gcloudoem.datastore.transaction import run_in_transaction
+        from gcloudoem.exceptions import Conflict
+
+        connection = self._make_connection(Conflict('Entity already exists: [Person: 1]'))
+        calls = []
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection):
+            self.assertRaises(Conflict, run_in_transaction, lambda: calls.append(1))
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(sleep.called)
+
+    @patch('gcloudoem.datastore.transaction.time.sleep')
+    def test_version_conflict_not_retried(self, sleep):
+        from gcloudoem.datastore.transaction import run_in_transaction
+        from gcloudoem.exceptions import VersionConflict
+
+        class Account(Entity):
+            name = TextProperty()
+
+        connection = self._make_connection()
+        connection.namespace = 'TEST'
+        response = datastore_pb.CommitResponse()
+        response.mutation_results.add(version=2)
+        response.mutation_results.add(conflict_detected=True)
+        connection.commit.return_value = response
+        calls = []
+
+        def transfer():
+            calls.append(1)
+            source, target = Account(key=1), Account(key=2)
+            target._version = 1
+            source.save()
+            target.save(if_unchanged=True)
+
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection), \
+                patch('gcloudoem.properties.get_connection', return_value=connection):
+            self.assertRaises(VersionConflict, run_in_transaction, transfer)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(connection.commit.call_count, 1)
+        self.assertFalse(sleep.called)
+
+    def test_other_errors_not_retried(self):
+        from gcloudoem.datastore.transaction import run_in_transaction
+
+        connection = self._make_connection()
+
+        def func():
+            raise KeyError()
+
+        with patch('gcloudoem.datastore.transaction.get_connection', return_value=connection):
+            self.assertRaises(KeyError, run_in_transaction, func)
+        self.assertEqual(connection.rollback.call_count, 1)
+        self.assertEqual(connection.commit.call_count, 0)
@@ -0,0 +1,133 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+import unittest2
+
+from gcloudoem import Entity, TextProperty
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore._generated import datastore_pb2 as datastore_pb
+from gcloudoem.datastore._generated import entity_pb2 as entity_pb
+from gcloudoem.datastore.allocator import clear_id_allocators
+from gcloudoem.datastore.writebehind import WriteBehindQueue
+from gcloudoem.exceptions import BadRequest, ServiceUnavailable
+
+
+class TestWriteBehindQueue(unittest2.TestCase):
+    class TestEntity(Entity):
+        message = TextProperty()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+        self.committed = []
+        self.connection = MagicMock(spec=Connection)
+        self.connection.dataset = 'DATASET'
+        self.connection.namespace = 'TEST'
+        self.connection.commit.side_effect = self._commit
+        self.patches = [
+            patch('gcloudoem.datastore.transaction.get_connection', return_value=self.connection),
+            patch('gcloudoem.properties.get_connection', return_value=self.connection),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.dir)
+
+    def _commit(self, request, transaction_id):
+        self.assertIsNone(transaction_id)
+        self.committed.append([
+            (m.WhichOneof('operation'), (m.delete if m.HasField('delete') else m.upsert.key).path[0].id)
+            for m in request.mutations
+        ])
+        return datastore_pb.CommitResponse()
+
+    def test_put_and_flush(self):
+        queue = WriteBehindQueue(self.path, connection=self.connection, batch_size=2, flush_interval=60, fsync=False)
+        for i in range(3):
+            queue.put(self.TestEntity(key=i + 1, message='hi'))
+        queue.put(self.TestEntity(key=3, message='again'))
+        queue.delete(self.TestEntity(key=1))
+        self.assertTrue(queue.flush(5))
+        lag = queue.lag()
+        self.assertEqual((lag['pending'], lag['committed'], lag['errors']), (0, 5, 0))
+        self.assertTrue(queue.close(5))
+        self.assertEqual(sum(len(batch) for batch in self.committed), 4)  # The two writes of key 3 were coalesced
+        self.assertEqual(self.committed[0], [('upsert', 1), ('upsert', 2)])
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_replay(self):
+        queue = WriteBehindQueue(self.path, connection=self.connection, fsync=False, start=False)
+        queue.put(self.TestEntity(key=1))
+        queue.put(self.TestEntity(key=2))
+        self.assertEqual(queue.lag()['pending'], 2)
+        queue._journal.close()
+        with open(self.path, 'ab') as f:  # A write that was cut off half way
+            f.write(b'\x00\x00')
+
+        queue = WriteBehindQueue(self.path, connection=self.connection, fsync=False)
+        self.assertEqual(queue.lag()['pending'], 2)
+        self.assertTrue(queue.close(5))
+        self.assertEqual(self.committed, [[('upsert', 1), ('upsert', 2)]])
+
+    def test_errors(self):
+        self.connection.commit.side_effect = [ServiceUnavailable('down'), BadRequest('bad')]
+        queue = WriteBehindQueue(self.path, connection=self.connection, fsync=False, retry_delay=0.01)
+        queue.put(self.TestEntity(key=1))
+        self.assertTrue(queue.flush(5))
+        lag = queue.lag()
+        self.assertEqual((lag['committed'], lag['rejected'], lag['errors']), (0, 1, 1))
+        self.assertIsInstance(lag['last_error'], BadRequest)
+        self.assertGreater(os.path.getsize(self.path + '.rejected'), 0)
+        queue.close(5)
+
+    def test_save_joins_queue(self):
+        queue = WriteBehindQueue(self.path, connection=self.connection, fsync=False, start=False)
+        with queue:
+            self.TestEntity(key=1).save()
+            self.assertRaises(ValueError, self.TestEntity(key=2).save, if_unchanged=True)
+        self.assertEqual(queue.lag()['pending'], 1)
+        self.assertFalse(self.connection.commit.called)
+        queue.start()
+        self.assertTrue(queue.close(5))
+
+    def test_own_connection(self):
+        other = MagicMock(spec=Connection)
+        other.dataset = 'OTHER'
+        other.namespace = 'OTHER_NS'
+        batches = []
+        other.commit.side_effect = lambda request, transaction_id: batches.append(request) or \
+            datastore_pb.CommitResponse()
+
+        def allocate_ids(key_pbs):
+            allocated = []
+            for i, key_pb in enumerate(key_pbs):
+                allocated.append(entity_pb.Key())
+                allocated[-1].CopyFrom(key_pb)
+                allocated[-1].path[-1].id = i + 10
+            return allocated
+        other.allocate_ids.side_effect = allocate_ids
+        self.addCleanup(clear_id_allocators)
+
+        queue = WriteBehindQueue(self.path, connection=other, fsync=False)
+        queue.put(self.TestEntity(message='new'))
+        queue.delete(self.TestEntity(key=2))
+        self.assertTrue(queue.close(5))
+        self.assertFalse(self.connection.allocate_ids.called)
+        self.assertFalse(self.connection.commit.called)
+        upsert, delete = batches[0].mutations
+        self.assertEqual(upsert.upsert.key.path[0].id, 10)
+        for key_pb in (upsert.upsert.key, delete.delete):
+            self.assertEqual((key_pb.partition_id.project_id, key_pb.partition_id.namespace_id), ('OTHER', 'OTHER_NS'))
@@ -0,0 +1,81 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+import pickle
+
+import unittest2 as unittest
+
+from gcloudoem import Key
+
+
+class TestKey(unittest.TestCase):
+    def tearDown(self):
+        Key.clear_interned()
+
+    def test_eq_and_hash(self):
+        parent = Key('Parent', value='p')
+        k1 = Key('Kind', parent=parent, value=1)
+        k2 = Key('Kind', parent=Key('Parent', value='p'), value=1)
+        self.assertEqual(k1, k2)
+        self.assertEqual(hash(k1), hash(k2))
+        self.assertEqual(len({k1, k2}), 1)
+        self.assertNotEqual(k1, Key('Kind', value=1))
+        self.assertNotEqual(k1, Key('Kind', parent=parent, value='1'))
+        self.assertNotEqual(k1, 1)
+        self.assertEqual(k1.flat_path, ((u'Parent', 'p'), (u'Kind', 1)))
+
+    def test_partial_keys_compare_by_identity(self):
+        k1 = Key('Kind')
+        k2 = Key('Kind')
+        self.assertEqual(k1, k1)
+        self.assertNotEqual(k1, k2)
+        self.assertEqual(len({k1, k2}), 2)
+
+    def test_intern(self):
+        k1 = Key('Kind', value=1)
+        k2 = Key('Kind', value=1)
+        self.assertIs(Key.intern(k1), k1)
+        self.assertIs(Key.intern(k2), k1)
+        partial = Key('Kind')
+        self.assertIs(Key.intern(partial), partial)
+
+    def test_to_protobuf_cached(self):
+        key = Key('Kind', parent=Key('Parent', value='p'), value=1)
+        pb = key.to_protobuf('DATASET', 'NS')
+        self.assertIs(key.to_protobuf('DATASET', 'NS'), pb)
+        self.assertIsNot(key.to_protobuf('DATASET', 'OTHER'), pb)
+        self.assertEqual(pb.partition_id.project_id, 'DATASET')
+        self.assertEqual(pb.partition_id.namespace_id, 'NS')
+        self.assertEqual([(e.kind, e.name or e.id) for e in pb.path], [('Parent', 'p'), ('Kind', 1)])
+
+    def test_to_protobuf_partial_not_cached(self):
+        key = Key('Kind')
+        pb = key.to_protobuf('DATASET', 'NS')
+        self.assertIsNot(key.to_protobuf('DATASET', 'NS'), pb)
+        key._complete(1234)
+        self.assertEqual(key.to_protobuf('DATASET', 'NS').path[0].id, 1234)
+
+    def test_partial_ancestor(self):
+        parent = Key('Parent')
+        child = Key('Kind', parent=parent, value=1)
+        self.assertFalse(child.is_partial)
+        self.assertFalse(child.is_complete)
+        self.assertNotEqual(child, Key('Kind', parent=parent, value=1))
+        self.assertIs(Key.intern(child), child)
+        pb = child.to_protobuf('DATASET', 'NS')
+        self.assertIsNot(child.to_protobuf('DATASET', 'NS'), pb)
+
+        parent._complete(5)
+        self.assertTrue(child.is_complete)
+        self.assertEqual(child.to_protobuf('DATASET', 'NS').path[0].id, 5)
+        same = Key('Kind', parent=Key('Parent', value=5), value=1)
+        self.assertEqual(child, same)
+        self.assertIn(same, {child})
+
+    def test_pickle_drops_cache(self):
+        key = Key('Kind', value=1)
+        key.to_protobuf('DATASET', 'NS')
+        data = pickle.dumps(key, protocol=2)
+        restored = pickle.loads(data)
+        self.assertEqual(restored, key)
+        self.assertEqual(restored._pb_cache, {})
+        self.assertNotIn(b'DATASET', data)
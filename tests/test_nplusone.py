@@ -0,0 +1,119 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import warnings
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+import unittest2
+
+from gcloudoem import Entity, Key, ListProperty, ReferenceProperty, TextProperty
+from gcloudoem.datastore import Connection
+from gcloudoem.datastore._generated import query_pb2 as query_pb
+from gcloudoem.exceptions import NPlusOneError, NPlusOneWarning
+from gcloudoem.queryset import QuerySet
+from gcloudoem.queryset.nplusone import NPlusOneDetector, prefetch_related_objects
+
+
+class Author(Entity):
+    name = TextProperty()
+
+
+class Book(Entity):
+    author = ReferenceProperty(Author)
+    editors = ListProperty(ReferenceProperty(Author))
+
+
+def _books(count):
+    return [Book(key=i, author=Key('Author', value=i % 2 + 1)) for i in range(1, count + 1)]
+
+
+@patch.object(QuerySet, 'get', side_effect=lambda pk: Author(key=pk, name='Alice'))
+class TestNPlusOneDetector(unittest2.TestCase):
+    def test_warns(self, get):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with NPlusOneDetector(threshold=2) as detector:
+                for book in _books(4):
+                    self.assertEqual(book.author.name, 'Alice')
+        self.assertEqual(get.call_count, 4)
+        warning, = caught
+        self.assertIs(warning.category, NPlusOneWarning)
+        self.assertIn("Book.objects.prefetch_related('author')", str(warning.message))
+        self.assertIn('test_nplusone.py', str(warning.message))
+        self.assertEqual(warning.filename, __file__.replace('.pyc', '.py'))
+
+        (site, entity_cls, name, count), = detector.report()
+        self.assertIn('in test_warns', site)
+        self.assertEqual((entity_cls, name, count), (Book, 'author', 4))
+
+    def test_list_property(self, get):
+        book = Book(key=1, editors=[Key('Author', value=i) for i in range(3)])
+        with NPlusOneDetector(threshold=2, raise_error=True):
+            self.assertRaises(NPlusOneError, lambda: book.editors)
+
+    def test_raises(self, get):
+        with NPlusOneDetector(threshold=2, raise_error=True):
+            books = iter(_books(3))
+            read = lambda: next(books).author
+            read()
+            read()
+            self.assertRaises(NPlusOneError, read)
+
+    def test_inactive(self, get):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for book in _books(10):
+                book.author
+        self.assertEqual(caught, [])
+
+
+@patch('gcloudoem.queryset.nplusone.get_connection')
+class TestPrefetchRelated(unittest2.TestCase):
+    def _connection(self, get_connection):
+        def lookup(key_pbs, transaction_id=None, entity_results=False):
+            found = []
+            for key_pb in key_pbs:
+                result = query_pb.EntityResult(version=7)
+                result.entity.key.CopyFrom(key_pb)
+                result.entity.properties['name'].string_value = 'Author %d' % key_pb.path[0].id
+                found.append(result)
+            return found, [], []
+
+        connection = get_connection.return_value = MagicMock(spec=Connection, dataset='DATASET', namespace='NS')
+        connection.lookup.side_effect = lookup
+        return connection
+
+    @patch.object(QuerySet, 'get')
+    def test_prefetch_related_objects(self, get, get_connection):
+        connection = self._connection(get_connection)
+        books = _books(4)
+        books[0].editors = [books[1]._data['author'], Key('Author', value=3)]
+        prefetch_related_objects(books, 'author', 'editors')
+
+        self.assertEqual(connection.lookup.call_count, 2)
+        key_pbs = connection.lookup.call_args_list[0][0][0]
+        self.assertEqual(sorted(key_pb.path[0].id for key_pb in key_pbs), [1, 2])
+        with NPlusOneDetector(threshold=0, raise_error=True):
+            self.assertEqual([book.author.name for book in books], ['Author 2', 'Author 1', 'Author 2', 'Author 1'])
+            self.assertEqual([author.name for author in books[0].editors], ['Author 1', 'Author 3'])
+        self.assertEqual(books[0].author.version, 7)
+        self.assertFalse(get.called)
+
+    def test_not_a_reference(self, get_connection):
+        self.assertRaises(ValueError, prefetch_related_objects, _books(1), 'key')
+
+    def test_queryset(self, get_connection):
+        connection = self._connection(get_connection)
+        queryset = QuerySet(Book).prefetch_related('author')
+        self.assertEqual(queryset._prefetch_related, ('author',))
+        self.assertEqual(queryset.all()._prefetch_related, ('author',))
+        self.assertEqual(queryset.prefetch_related()._prefetch_related, ())
+        with patch.object(QuerySet, 'iterator', return_value=iter(_books(3))):
+            books = list(queryset)
+        self.assertEqual(connection.lookup.call_count, 1)
+        self.assertIsInstance(books[0]._data['author'], Author)
@@ -0,0 +1,316 @@
+# Copyright (c) 2012-2015 Kapiche Ltd.
+# Author: Ryan Stuart<ryan@kapiche.com>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+
+import pytz
+import unittest2
+
+from gcloudoem import (
+    BooleanProperty, DateProperty, DateTimeProperty, Entity, FloatProperty, IntegerProperty, TextProperty
+)
+from gcloudoem.datastore import connection as connection_module
+from gcloudoem.datastore.memory import InMemoryDatastore, connect_in_memory
+from gcloudoem.datastore.query import Cursor, Query
+from gcloudoem.datastore.transaction import Transaction
+from gcloudoem.exceptions import InvalidQueryError
+from gcloudoem.queryset import Avg, Count, Max, Min, Sum, aggregates
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Person(Entity):
+    name = TextProperty()
+    age = IntegerProperty()
+
+
+class Reading(Entity):
+    sensor = TextProperty()
+    count = IntegerProperty()
+    value = FloatProperty()
+    ok = BooleanProperty()
+    at = DateTimeProperty()
+    day = DateProperty()
+
+
+class TestQueryProtobuf(unittest2.TestCase):
+    def test_built_once(self):
+        query = Query(Person, filters=[('age', '>', 3)], order=['age'])
+        with patch.object(Query, 'to_protobuf', wraps=query.to_protobuf) as to_protobuf:
+            first = query.cached_protobuf()
+            second = query.cached_protobuf()
+        self.assertEqual(to_protobuf.call_count, 1)
+        self.assertIs(first, second)
+        self.assertEqual(first, query.to_protobuf())
+        self.assertIsNot(first, query.to_protobuf())
+
+    def test_changes_rebuild(self):
+        query = Query(Person)
+        self.assertEqual(len(query.cached_protobuf().order), 0)
+        query.order = ['-age']
+        self.assertEqual(query.cached_protobuf().order[0].property.name, 'age')
+        query.add_filter('name', '=', 'Alice')
+        self.assertEqual(
+            query.cached_protobuf().filter.composite_filter.filters[0].property_filter.property.name, 'name'
+        )
+        query.projection = ['name']
+        self.assertEqual(query.cached_protobuf().projection[0].property.name, 'name')
+        query.keys_only()
+        self.assertEqual(query.cached_protobuf().projection[0].property.name, '__key__')
+
+
+class TestPagination(unittest2.TestCase):
+    def setUp(self):
+        self.store = InMemoryDatastore(max_batch_size=3)
+        self.connection = connect_in_memory(store=self.store)
+        self.addCleanup(connection_module.disconnect)
+        with Transaction(Transaction.NONE) as transaction:
+            for i in range(10):
+                transaction.put(Person(key=i + 1, name='p%d' % i, age=i))
+
+    def _ages(self, query, **kwargs):
+        return [person.age for person in Cursor(query, self.connection, **kwargs)]
+
+    def test_pages(self):
+        query = Query(Person, order=['age'])
+        with patch.object(Query, 'to_protobuf', wraps=query.to_protobuf) as to_protobuf:
+            self.assertEqual(self._ages(query), list(range(10)))
+        self.assertEqual(to_protobuf.call_count, 1)
+
+    def test_limit_and_offset_span_pages(self):
+        query = Query(Person, order=['age'])
+        self.assertEqual(self._ages(query, limit=5), [0, 1, 2, 3, 4])
+        self.assertEqual(self._ages(query, offset=4), [4, 5, 6, 7, 8, 9])
+        self.assertEqual(self._ages(query, limit=4, offset=2), [2, 3, 4, 5])
+        self.assertEqual(self._ages(query, limit=0), [])
+
+    def test_end_cursor(self):
+        cursor = Cursor(Query(Person, order=['age']), self.connection, limit=5)
+        list(cursor)
+        end = cursor._start_cursor
+        self.assertEqual(self._ages(Query(Person, order=['age']), end_cursor=end), [0, 1, 2, 3, 4])
+
+    def test_queryset(self):
+        self.assertEqual(sorted(person.age for person in Person.objects.all()), list(range(10)))
+        older = Person.objects.filter(age__gte=2).order_by('-age')
+        oldest = older.filter(age__gte=8)
+        self.assertEqual([person.age for person in oldest], [9, 8])
+        self.assertEqual(len(older), 8)  # Not narrowed by filtering its clone
+        self.assertEqual([person.age for person in older.filter(age__lte=8)][:2], [8, 7])  # Order is kept
+
+        self.assertEqual(sorted(person.age for person in Person.objects.filter(name__in=['p1', 'p2', 'nope'])), [1, 2])
+        self.assertEqual([p.age for p in Person.objects.filter(age__gte=2).filter(name__in=['p1', 'p2'])], [2])
+
+    def test_queryset_reevaluation_reuses_protobufs(self):
+        queryset = Person.objects.filter(age__gte=2).order_by('age')
+        list(queryset.iterator())
+        with patch.object(Query, 'to_protobuf') as to_protobuf:
+            self.assertEqual(len(list(queryset.iterator())), 8)
+        self.assertFalse(to_protobuf.called)
+
+
+class TestDistinct(unittest2.TestCase):
+    def setUp(self):
+        connect_in_memory(store=InMemoryDatastore())
+        self.addCleanup(connection_module.disconnect)
+        with Transaction(Transaction.NONE) as transaction:
+            for i in range(9):
+                transaction.put(Person(key=i + 1, name='p%d' % (i % 2), age=i % 3))
+
+    def test_protobuf(self):
+        pb = Query(Person, projection=['age'], group_by=['age']).to_protobuf()
+        self.assertEqual([reference.name for reference in pb.distinct_on], ['age'])
+
+    def test_distinct(self):
+        self.assertEqual(sorted(person.age for person in Person.objects.distinct('age')), [0, 1, 2])
+        pairs = Person.objects.projection('name').distinct('age')
+        self.assertEqual(sorted((person.name, person.age) for person in pairs), [('p0', 0), ('p0', 2), ('p1', 1)])
+        query = pairs._get_prepared_queries()[0]
+        self.assertEqual((query.projection, query.group_by), (['name', 'age'], ['age']))
+
+    def test_distinct_across_queries(self):
+        queryset = Person.objects.filter(name__in=['p0', 'p1']).distinct('age')
+        self.assertEqual(sorted(person.age for person in queryset), [0, 1, 2])
+
+
+class TestValues(unittest2.TestCase):
+    def setUp(self):
+        connect_in_memory(store=InMemoryDatastore())
+        self.addCleanup(connection_module.disconnect)
+        with Transaction(Transaction.NONE) as transaction:
+            for i in range(4):
+                transaction.put(Person(key=i + 1, name='p%d' % i, age=i))
+
+    def test_values(self):
+        with patch.object(Person, 'from_protobuf') as from_protobuf:
+            rows = list(Person.objects.filter(age__gte=2).order_by('age').values('name', 'age'))
+        self.assertFalse(from_protobuf.called)
+        self.assertEqual(rows, [{'name': 'p2', 'age': 2}, {'name': 'p3', 'age': 3}])
+        query = Person.objects.values('name')._get_prepared_queries()[0]
+        self.assertEqual(query.projection, ['name'])
+
+    def test_all_values(self):
+        row = Person.objects.filter(age=1).values()[0]
+        self.assertEqual(row['key'].name_or_id, 2)
+        self.assertEqual((row['name'], row['age']), ('p1', 1))
+        self.assertFalse(Person.objects.values()._get_prepared_queries()[0].projection)
+
+    def test_values_list(self):
+        queryset = Person.objects.order_by('age')
+        self.assertEqual(list(queryset.values_list('age', 'name'))[:2], [(0, 'p0'), (1, 'p1')])
+        self.assertEqual(list(queryset.values_list('age', flat=True)), [0, 1, 2, 3])
+        row = queryset.values_list('name', 'age', named=True)[3]
+        self.assertEqual((row.name, row.age), ('p3', 3))
+        self.assertEqual(
+            sorted(key.name_or_id for key in Person.objects.values_list('key', flat=True)), [1, 2, 3, 4]
+        )
+        self.assertEqual(Person.objects.values_list('key', flat=True)._get_prepared_queries()[0].projection,
+                         ['__key__'])
+
+    def test_values_list_errors(self):
+        self.assertRaises(TypeError, Person.objects.values_list, 'name', 'age', flat=True)
+        self.assertRaises(TypeError, Person.objects.values_list, 'name', flat=True, named=True)
+        self.assertRaises(TypeError, Person.objects.values_list, 'name', nope=True)
+        self.assertRaises(InvalidQueryError, Person.objects.values, 'nope')
+        self.assertRaises(TypeError, Person.objects.values('name').delete)
+
+    def test_distinct_values(self):
+        with Transaction(Transaction.NONE) as transaction:
+            transaction.put(Person(key=10, name='p1', age=1))
+        ages = Person.objects.filter(name__in=['p1', 'p2']).distinct('age').values_list('age', flat=True)
+        self.assertEqual(sorted(ages), [1, 2])
+
+
+@unittest2.skipIf(numpy is None, 'NumPy is not installed')
+class TestColumns(unittest2.TestCase):
+    def setUp(self):
+        connect_in_memory(store=InMemoryDatastore(max_batch_size=2))
+        self.addCleanup(connection_module.disconnect)
+        self.start = datetime.datetime(2016, 1, 1, tzinfo=pytz.utc)
+        with Transaction(Transaction.NONE) as transaction:
+            for i in range(5):
+                transaction.put(Reading(
+                    key=i + 1, sensor='s%d' % i, count=i, value=i / 2, ok=i % 2 == 0,
+                    at=self.start + datetime.timedelta(seconds=i), day=datetime.datetime(2016, 1, i + 1)
+                ))
+
+    def test_columns(self):
+        with patch.object(Reading, 'from_protobuf') as from_protobuf:
+            columns = Reading.objects.order_by('count').to_columns(['count', 'value', 'ok', 'at', 'day', 'sensor'])
+        self.assertFalse(from_protobuf.called)
+        self.assertEqual(list(columns), ['count', 'value', 'ok', 'at', 'day', 'sensor'])
+        self.assertEqual(columns['count'].dtype, numpy.int64)
+        self.assertEqual(columns['count'].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(columns['value'].tolist(), [0, 0.5, 1, 1.5, 2])
+        self.assertEqual(columns['ok'].tolist(), [True, False, True, False, True])
+        self.assertEqual(columns['at'].dtype, numpy.dtype('datetime64[us]'))
+        self.assertEqual(columns['at'][1], numpy.datetime64('2016-01-01T00:00:01'))
+        self.assertEqual(columns['day'][4], numpy.datetime64('2016-01-05'))
+        self.assertEqual(columns['sensor'].dtype, object)
+        self.assertEqual(columns['sensor'][0], 's0')
+
+    def test_missing_values(self):
+        with Transaction(Transaction.NONE) as transaction:
+            transaction.put(Reading(key=10, sensor='empty'))
+        columns = Reading.objects.order_by('sensor').to_columns(['count', 'ok', 'at', 'key'], projection=False)
+        self.assertTrue(numpy.isnan(columns['count'][0]))
+        self.assertEqual(columns['count'][1:].tolist(), [0, 1, 2, 3, 4])
+        self.assertIsNone(columns['ok'][0])
+        self.assertTrue(numpy.isnat(columns['at'][0]))
+        self.assertEqual(columns['key'][0].name_or_id, 10)
+
+    def test_structured(self):
+        result = Reading.objects.filter(count__gte=3).to_columns(['count', 'value'], structured=True)
+        self.assertEqual(result.dtype.names, ('count', 'value'))
+        self.assertEqual(sorted(result['count'].tolist()), [3, 4])
+        self.assertEqual(len(Reading.objects.to_columns(projection=False)['sensor']), 5)
+        self.assertRaises(InvalidQueryError, Reading.objects.to_columns, ['nope'])
+
+
+class TestAggregates(unittest2.TestCase):
+    def setUp(self):
+        connect_in_memory(store=InMemoryDatastore(max_batch_size=3))
+        self.addCleanup(connection_module.disconnect)
+        self.start = datetime.datetime(2016, 1, 1, tzinfo=pytz.utc)
+        with Transaction(Transaction.NONE) as transaction:
+            for i in range(7):
+                transaction.put(Reading(
+                    key=i + 1, sensor='s%d' % (i % 2), count=i, value=i / 2, at=self.start + datetime.timedelta(days=i)
+                ))
+        patcher = patch.object(aggregates, 'CHUNK_SIZE', 2)  # Fold several chunks
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_aggregate(self):
+        with patch.object(Reading, 'from_protobuf') as from_protobuf:
+            result = Reading.objects.aggregate(
+                Sum('count'), avg=Avg('value'), n=Count(), low=Min('at'), high=Max('count'), sensors=Count('sensor')
+            )
+        self.assertFalse(from_protobuf.called)
+        self.assertEqual(result, {
+            'count__sum': 21, 'avg': 1.5, 'n': 7, 'low': self.start, 'high': 6, 'sensors': 7
+        })
+        self.assertIsInstance(result['count__sum'], int)
+        self.assertEqual(Reading.objects.filter(count__gte=5).aggregate(Min('value'))['value__min'], 2.5)
+
+    def test_empty(self):
+        result = Reading.objects.filter(count__gt=10).aggregate(Sum('count'), Avg('count'), Max('at'), Count())
+        self.assertEqual(result, {'count__sum': 0, 'count__avg': None, 'at__max': None, 'count': 0})
+
+    def test_projection(self):
+        queries = []
+        real = Cursor.__init__
+
+        def record(cursor, query, *args, **kwargs):
+            queries.append(query)
+            real(cursor, query, *args, **kwargs)
+        with patch.object(Cursor, '__init__', record):
+            Reading.objects.aggregate(Count())
+            Reading.objects.aggregate(Sum('count'), Max('count'))
+        self.assertEqual([query.projection for query in queries], [['__key__'], ['count']])
+
+    def test_missing_values(self):
+        with Transaction(Transaction.NONE) as transaction:
+            transaction.put(Reading(key=10, sensor='s0', count=100))
+            transaction.put(Reading(key=11, sensor='s2', value=10.0))
+        self.assertEqual(Reading.objects.aggregate(total=Sum('count')), {'total': 121})
+        result = Reading.objects.aggregate(total=Sum('count'), avg=Avg('value'), n=Count())
+        self.assertEqual(result, {'total': 121, 'avg': 20.5 / 8, 'n': 9})
+        rows = Reading.objects.values_list('sensor').annotate(total=Sum('count'), avg=Avg('value'), n=Count())
+        self.assertEqual(sorted(rows), [('s0', 112, 1.5, 5), ('s1', 9, 1.5, 3), ('s2', 0, 10.0, 1)])
+
+    def test_annotate(self):
+        rows = Reading.objects.order_by('sensor').values('sensor').annotate(Sum('count'), n=Count(), avg=Avg('value'))
+        self.assertEqual(list(rows), [
+            {'sensor': 's0', 'count__sum': 12, 'n': 4, 'avg': 1.5},
+            {'sensor': 's1', 'count__sum': 9, 'n': 3, 'avg': 1.5},
+        ])
+        rows = Reading.objects.values_list('sensor').annotate(high=Max('count')).annotate(low=Min('at'))
+        self.assertEqual(sorted(rows), [
+            ('s0', 6, self.start), ('s1', 5, self.start + datetime.timedelta(days=1))
+        ])
+        row = Reading.objects.values_list('sensor', named=True).annotate(n=Count()).filter(sensor='s1')[0]
+        self.assertEqual((row.sensor, row.n), ('s1', 3))
+
+    def test_errors(self):
+        self.assertRaises(TypeError, Reading.objects.aggregate, Count)
+        self.assertRaises(TypeError, Reading.objects.aggregate, Sum())
+        self.assertRaises(InvalidQueryError, Reading.objects.aggregate, Sum('nope'))
+        self.assertRaises(AssertionError, Reading.objects.annotate, n=Count())
+        self.assertRaises(AssertionError, Reading.objects.values_list('sensor', flat=True).annotate, n=Count())
+
+    def test_without_numpy(self):
+        with patch('gcloudoem.queryset.columns.numpy', None):
+            result = Reading.objects.aggregate(Sum('count'), Avg('value'), Max('at'))
+        self.assertEqual(result, {
+            'count__sum': 21, 'value__avg': 1.5, 'at__max': self.start + datetime.timedelta(days=6)
+        })